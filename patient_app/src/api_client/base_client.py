@@ -1,7 +1,16 @@
 from concrete.ml.deployment import FHEModelClient
 from api_client.key_manager import KeyManager
+from api_client.framing import unpack_frames
+from api_client.predict_protocol import PREDICT_CONTENT_TYPE, accepts_predict_protocol, pack_predict_request
+from api_client import payload_codec
+from pathlib import Path
+from urllib.parse import urljoin
 import requests
+import hashlib
 import logging
+import json
+import time
+import uuid
 
 logger = logging.getLogger(__name__)
 
@@ -12,16 +21,39 @@ class BaseClient:
     It is designed to be extended by specific model clients.
     """
 
-    def __init__(self, base_url, fhe_directory, key_directory):
+    def __init__(self, base_url, fhe_directory, key_directory, compress_uploads=True, compression_level=None,
+                 max_busy_retries=3, max_retry_after_seconds=60, max_network_retries=2, use_binary_protocol=True,
+                 upload_chunk_bytes=1024 * 1024):
         """
         Initialize the API client with the base URL and FHE model client.
 
         :param base_url: The base URL of the REST API.
         :param fhe_directory: Directory for FHE client-server files.
         :param key_directory: Directory for FHE keys.
-        :param key_manager: Key manager for handling encryption keys.
+        :param compress_uploads: Compress ciphertexts and evaluation keys with an encoding the server accepts.
+        :param compression_level: Compression level for uploads (default: the encoding's default level).
+        :param max_busy_retries: How many times a prediction is retried when the server is busy (429/503 with Retry-After).
+        :param max_retry_after_seconds: Longest Retry-After delay the client waits before giving up.
+        :param max_network_retries: How many times a prediction is resent, with the same single-use key and
+            idempotency key, after a connection error or timeout. The server answers a retry of a finished
+            prediction with the stored result.
+        :param use_binary_protocol: Send single predictions in the provider's compact binary encoding
+            when the server advertises it, instead of multipart/form-data.
+        :param upload_chunk_bytes: Size of the chunks of resumable evaluation key uploads. Smaller chunks
+            waste less when a flaky connection drops; the server may impose a smaller size.
         """
         self.base_url = base_url
+        self.key_directory = key_directory
+        self.compress_uploads = compress_uploads
+        self.compression_level = compression_level
+        self.upload_encoding = None
+        self.use_binary_protocol = use_binary_protocol
+        self.upload_chunk_bytes = upload_chunk_bytes
+        self.binary_protocol = False
+        self.max_busy_retries = max_busy_retries
+        self.max_retry_after_seconds = max_retry_after_seconds
+        self.max_network_retries = max_network_retries
+        self._metadata_cache = {}
         self.client = FHEModelClient(path_dir=fhe_directory, key_dir=key_directory)
         self.service_name = self._get_service_name()
         self.key_manager = KeyManager(self.service_name)
@@ -29,27 +61,49 @@ class BaseClient:
     def _get_service_name(self):
         """
         Get the service name from the server.
+        Also picks the upload encoding from the part encodings the server advertises,
+        and whether predictions are sent in the binary protocol (listed in its 'Accept-Post' header).
 
         :return: Service name as a string.
         :raises ValueError: If the response format is unexpected.
         """
         logger.info(f"Requesting service name from {self.base_url}/additional_service_info")
-        response = requests.get(f"{self.base_url}/additional_service_info")
-        response.raise_for_status()
-        data = response.json()
+        data, response = self._get_metadata("/additional_service_info")
+        if self.compress_uploads:
+            server_encodings = payload_codec.parse_accept_encoding(response.headers.get('Accept-Encoding'))
+            self.upload_encoding = payload_codec.negotiate(server_encodings)
+        if self.use_binary_protocol:
+            self.binary_protocol = accepts_predict_protocol(response.headers.get('Accept-Post'))
         if not isinstance(data, dict) or 'service_name' not in data:
             raise ValueError("Unexpected response format: missing service_name")
         return data['service_name']
 
+    def _get_metadata(self, path):
+        """
+        GET a metadata endpoint, revalidating the copy received earlier with its ETag,
+        so unchanged metadata is answered with an empty 304.
+
+        :param path: Endpoint path, e.g. "/omop_requirements".
+        :return: The decoded JSON and the response.
+        """
+        cached = self._metadata_cache.get(path)
+        headers = {'If-None-Match': cached[0]} if cached else {}
+        response = requests.get(f"{self.base_url}{path}", headers=headers)
+        if cached and response.status_code == 304:
+            return cached[1], response
+        response.raise_for_status()
+        data = response.json()
+        if response.headers.get('ETag'):
+            self._metadata_cache[path] = (response.headers['ETag'], data)
+        return data, response
+
     def _get_label_meanings(self):
         """
         Get the meanings of the labels used in the model.
 
         :return: Dictionary mapping labels to their meanings.
         """
-        response = requests.get(f"{self.base_url}/additional_service_info")
-        response.raise_for_status()
-        data = response.json()
+        data, _ = self._get_metadata("/additional_service_info")
         if not isinstance(data, dict) or 'label_meanings' not in data:
             raise ValueError("Unexpected response format: missing label_meanings")
         return data['label_meanings']
@@ -61,9 +115,7 @@ class BaseClient:
         :return: Metadata about the expected input features.
         :raises ValueError: If the response format is unexpected.
         """
-        response = requests.get(f"{self.base_url}/omop_requirements")
-        response.raise_for_status()
-        metadata = response.json()
+        metadata, _ = self._get_metadata("/omop_requirements")
         return metadata
     
     def request_additional_info(self):
@@ -74,44 +126,329 @@ class BaseClient:
         :raises ValueError: If the response format is unexpected.
         """
         logger.info(f"Requesting additional service info from {self.base_url}/additional_service_info")
-        response = requests.get(f"{self.base_url}/additional_service_info")
-        response.raise_for_status()
-        metadata = response.json()
+        metadata, _ = self._get_metadata("/additional_service_info")
         return metadata
     
 
-    def request_prediction(self, X_new):
+    def _file_part(self, filename, data):
+        """
+        Build a multipart file tuple, compressed with the negotiated upload encoding when that makes it smaller.
+
+        :param filename: Filename of the part.
+        :param data: Payload of the part.
+        :return: Tuple accepted by `requests` in `files`.
+        """
+        if self.upload_encoding:
+            compressed = payload_codec.compress(data, self.upload_encoding, self.compression_level)
+            logger.info(f"Part {filename}: {len(data)} -> {len(compressed)} bytes ({self.upload_encoding}).")
+            if len(compressed) < len(data):
+                return (filename, compressed, 'application/octet-stream', {'Content-Encoding': self.upload_encoding})
+        return (filename, data, 'application/octet-stream')
+
+    def _binary_request(self, single_use_key, encrypted_data, evaluation_keys_id):
+        """
+        Build the body and headers of a prediction in the binary protocol. The whole body is
+        compressed with the negotiated upload encoding when that makes it smaller.
+
+        :param single_use_key: The single-use key of the prediction.
+        :param encrypted_data: The serialized ciphertext.
+        :param evaluation_keys_id: The id of the registered evaluation keys.
+        :return: Tuple (body, headers).
+        """
+        body = pack_predict_request(single_use_key, encrypted_data, evaluation_keys_id=evaluation_keys_id)
+        headers = {'Content-Type': PREDICT_CONTENT_TYPE}
+        if self.upload_encoding:
+            compressed = payload_codec.compress(body, self.upload_encoding, self.compression_level)
+            logger.info(f"Prediction body: {len(body)} -> {len(compressed)} bytes ({self.upload_encoding}).")
+            if len(compressed) < len(body):
+                body = compressed
+                headers['Content-Encoding'] = self.upload_encoding
+        return body, headers
+
+    def _log_response_size(self, response):
+        """
+        Log the size of a binary response on the wire and once decoded (requests decodes gzip/zstd transparently).
+
+        :param response: The response.
+        """
+        encoding = response.headers.get('Content-Encoding', 'identity')
+        wire_size = response.headers.get('Content-Length', 'unknown')
+        logger.info(f"Response from {response.url}: {wire_size} bytes on the wire ({encoding}), {len(response.content)} bytes decoded.")
+
+    def _get_evaluation_keys_id(self, force_register=False):
+        """
+        Get the id under which the server stores this client's evaluation keys, registering them if needed.
+        Ids are remembered per server in the FHE key directory, next to the keys they were computed from.
+
+        :param force_register: Upload the keys even if an id is already known (e.g. the server lost them).
+        :return: The evaluation keys id.
+        """
+        registry_path = Path(self.key_directory) / "registered_evaluation_keys.json"
+        registry = {}
+        if registry_path.exists():
+            try:
+                registry = json.loads(registry_path.read_text())
+            except (IOError, json.JSONDecodeError):
+                registry = {}
+        if not force_register and self.base_url in registry:
+            return registry[self.base_url]
+
+        serialized_evaluation_keys = self.client.get_serialized_evaluation_keys()
+        key_id = self._upload_evaluation_keys(serialized_evaluation_keys)
+        if key_id is None:
+            logger.info(f"Registering evaluation keys ({len(serialized_evaluation_keys)} bytes) at {self.base_url}/register_evaluation_keys")
+            files = {'evaluation_keys': self._file_part('evaluation_keys.bin', serialized_evaluation_keys)}
+            response = requests.post(f"{self.base_url}/register_evaluation_keys", files=files)
+            response.raise_for_status()
+            key_id = response.json()['key_id']
+
+        registry[self.base_url] = key_id
+        registry_path.parent.mkdir(parents=True, exist_ok=True)
+        registry_path.write_text(json.dumps(registry, indent=4))
+        return key_id
+
+    def _upload_evaluation_keys(self, serialized_evaluation_keys):
+        """
+        Register evaluation keys through a resumable upload, sent in chunks.
+        After a connection error the upload resumes from the last chunk the server acknowledged, and an
+        upload interrupted in an earlier session (e.g. the app was closed) is resumed from the offset the
+        server reports. Uploads in progress are remembered per server in the FHE key directory.
+
+        :param serialized_evaluation_keys: The serialized evaluation keys.
+        :return: The evaluation keys id, or None if the server does not support resumable uploads.
+        :raises requests.RequestException: If the upload fails more than `max_network_retries` times in a row.
+        """
+        payload, encoding = serialized_evaluation_keys, None
+        if self.upload_encoding:
+            compressed = payload_codec.compress(payload, self.upload_encoding, self.compression_level)
+            if len(compressed) < len(payload):
+                payload, encoding = compressed, self.upload_encoding
+        digest = hashlib.sha256(payload).hexdigest()
+
+        state_path = Path(self.key_directory) / "evaluation_key_uploads.json"
+        uploads = {}
+        if state_path.exists():
+            try:
+                uploads = json.loads(state_path.read_text())
+            except (IOError, json.JSONDecodeError):
+                uploads = {}
+        upload = uploads.get(self.base_url)
+        offset = None
+        if upload and upload.get('sha256') == digest:
+            try:
+                response = requests.get(urljoin(f"{self.base_url}/", upload['upload_url']))
+                if response.status_code == 200:
+                    offset = response.json()['next_offset']
+                    logger.info(f"Resuming the upload of evaluation keys to {self.base_url} at {offset} of {len(payload)} bytes.")
+            except (requests.ConnectionError, requests.Timeout) as e:
+                logger.info(f"Could not query the upload in progress at {self.base_url} ({e}), starting a new one.")
+        if offset is None:
+            response = requests.post(f"{self.base_url}/evaluation_key_uploads",
+                                     json={'size': len(payload), 'sha256': digest, 'encoding': encoding})
+            if response.status_code in (404, 405):
+                return None
+            response.raise_for_status()
+            created = response.json()
+            upload = {'upload_url': created['upload_url'], 'sha256': digest,
+                      'chunk_bytes': min(self.upload_chunk_bytes, created['max_chunk_bytes'])}
+            uploads[self.base_url] = upload
+            state_path.parent.mkdir(parents=True, exist_ok=True)
+            state_path.write_text(json.dumps(uploads, indent=4))
+            offset = 0
+
+        upload_url = urljoin(f"{self.base_url}/", upload['upload_url'])
+        logger.info(f"Uploading evaluation keys ({len(payload)} bytes, {encoding or 'identity'}) to {upload_url}")
+        failures = 0
+        while True:
+            try:
+                if offset < len(payload):
+                    chunk = payload[offset:offset + upload['chunk_bytes']]
+                    headers = {'Content-Range': f"bytes {offset}-{offset + len(chunk) - 1}/{len(payload)}"}
+                    response = requests.put(upload_url, data=chunk, headers=headers)
+                    response.raise_for_status()
+                    offset = response.json()['next_offset']
+                else:
+                    response = requests.post(f"{upload_url}/finalize")
+                    if response.status_code != 409:
+                        break
+                    offset = response.json()['next_offset']
+                failures = 0
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if failures >= self.max_network_retries:
+                    raise
+                failures += 1
+                logger.info(f"Evaluation key upload interrupted at {offset} bytes ({e}), resuming (attempt {failures}).")
+                time.sleep(failures)
+        response.raise_for_status()
+
+        uploads.pop(self.base_url, None)
+        state_path.write_text(json.dumps(uploads, indent=4))
+        return response.json()['key_id']
+
+    def _post_with_evaluation_keys_id(self, endpoint, files=None, prediction=None):
+        """
+        POST a prediction request referencing the registered evaluation keys, either as multipart
+        `files` or, for a single `prediction`, in the binary protocol.
+        If the server no longer knows the id, the keys are registered again and the request is retried once.
+        If the server is busy, the request is retried after the delay it asks for.
+        Every attempt carries the same 'Idempotency-Key', so a retry of a prediction whose response
+        was lost gets the stored result instead of a new FHE evaluation.
+
+        :param endpoint: Endpoint path, e.g. "/predict".
+        :param files: Multipart files of the request (without the evaluation keys).
+        :param prediction: Tuple (single_use_key, encrypted_data), sent in the binary protocol instead of `files`.
+        :return: The successful response.
+        """
+        idempotency_key = uuid.uuid4().hex
+        for force_register in (False, True):
+            key_id = self._get_evaluation_keys_id(force_register=force_register)
+            headers = {'Idempotency-Key': idempotency_key}
+            if prediction is not None:
+                body, body_headers = self._binary_request(*prediction, evaluation_keys_id=key_id)
+                request = {'data': body, 'headers': {**headers, **body_headers}}
+            else:
+                request = {'files': files, 'data': {'evaluation_keys_id': key_id}, 'headers': headers}
+            response = self._post_with_backoff(f"{self.base_url}{endpoint}", **request)
+            if response.status_code != 404:
+                break
+            logger.info(f"Evaluation keys unknown to {self.base_url}, registering them again.")
+        response.raise_for_status()
+        return response
+
+    def _post_with_backoff(self, url, **kwargs):
+        """
+        POST a request, retrying while the server answers 429/503 with a Retry-After header,
+        and resending it unchanged after connection errors and timeouts.
+
+        :param url: The URL.
+        :param kwargs: Arguments of `requests.post`.
+        :return: The last response.
+        """
+        network_retries = 0
+        for attempt in range(self.max_busy_retries + 1):
+            while True:
+                try:
+                    response = requests.post(url, **kwargs)
+                    break
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    if network_retries >= self.max_network_retries:
+                        raise
+                    network_retries += 1
+                    logger.info(f"Request to {url} failed ({e}), resending it (attempt {network_retries}).")
+                    time.sleep(network_retries)
+            retry_after = response.headers.get('Retry-After')
+            if response.status_code not in (429, 503) or not retry_after or not retry_after.isdigit():
+                return response
+            delay = int(retry_after)
+            if attempt == self.max_busy_retries or delay > self.max_retry_after_seconds:
+                return response
+            logger.info(f"{url} is busy ({response.status_code}), retrying in {delay} s.")
+            time.sleep(delay)
+        return response
+
+    def _run_prediction_job(self, files=None, prediction=None, poll_wait_seconds=25):
+        """
+        Submit a prediction job and long-poll it until the encrypted result is available.
+
+        :param files: Multipart files of the request (without the evaluation keys).
+        :param prediction: Tuple (single_use_key, encrypted_data), sent in the binary protocol instead of `files`.
+        :param poll_wait_seconds: Seconds the server may hold each status request open.
+        :return: The response carrying the encrypted result.
+        :raises ValueError: If the job fails or expires.
+        """
+        submission_response = self._post_with_evaluation_keys_id("/jobs", files=files, prediction=prediction)
+        if submission_response.status_code == 200:
+            logger.info(f"Received the stored result of an earlier submission from {self.base_url}")
+            return submission_response
+        submission = submission_response.json()
+        job_url = urljoin(f"{self.base_url}/", submission['status_url'])
+        logger.info(f"Prediction job {submission['job_id']} submitted to {self.base_url}")
+        while True:
+            response = requests.get(job_url, params={'wait': poll_wait_seconds}, timeout=poll_wait_seconds + 30)
+            if response.status_code == 200:
+                return response
+            if response.status_code != 202:
+                raise ValueError(f"Prediction job {submission['job_id']} failed: {response.text}")
+
+    def request_prediction(self, X_new, use_job=False):
         """
         Encrypt data, send it to the server, and decrypt the response.
 
         :param X_new: Input data as a NumPy array.
+        :param use_job: Submit the prediction as an asynchronous job and poll for its result,
+            instead of holding the request open while the server runs the FHE circuit.
         :return: Decrypted prediction result as a boolean indicating risk.
         """
         encrypted_data = self.client.quantize_encrypt_serialize(X_new)
-        serialized_evaluation_keys = self.client.get_serialized_evaluation_keys()
         serialized_single_use_key = self.key_manager.get_single_use_key()
 
-        files = {
-            'encrypted_data': ('encrypted_data.bin', encrypted_data, 'application/octet-stream'),
-            'evaluation_keys': ('evaluation_keys.bin', serialized_evaluation_keys, 'application/octet-stream'),
-            'single_use_key': ('single_use_key.bin', serialized_single_use_key, 'application/octet-stream')
-        }
+        if self.binary_protocol:
+            request = {'prediction': (serialized_single_use_key, encrypted_data)}
+        else:
+            request = {'files': {
+                'encrypted_data': self._file_part('encrypted_data.bin', encrypted_data),
+                'single_use_key': ('single_use_key.bin', serialized_single_use_key, 'application/octet-stream')
+            }}
 
-        response = requests.post(f"{self.base_url}/predict", files=files)
-        response.raise_for_status()
+        if use_job:
+            response = self._run_prediction_job(**request)
+        else:
+            response = self._post_with_evaluation_keys_id("/predict", **request)
 
         if response.status_code != 200:
             raise ValueError(f"Unexpected response status code: {response.status_code}")
-
+        self._log_response_size(response)
 
         response = self.client.deserialize_decrypt_dequantize(response.content)
         label_meanings = self._get_label_meanings()
         logger.info(f"Response: {response}, Label Meanings: {label_meanings}")
+        return self._is_risk(response, label_meanings)
+
+    def request_batch_prediction(self, X_rows):
+        """
+        Encrypt several samples, send them to the server in one request under the
+        registered evaluation keys, and decrypt the responses.
+
+        :param X_rows: Sequence of input samples, each shaped like the input of `request_prediction`.
+        :return: List of booleans indicating risk, one per sample.
+        :raises ValueError: If there are not enough single-use keys or the response is malformed.
+        """
+        X_rows = list(X_rows)
+        single_use_keys = self.key_manager.get_single_use_keys(len(X_rows))
+        if len(single_use_keys) < len(X_rows):
+            raise ValueError(f"Not enough single-use keys for a batch of {len(X_rows)} samples.")
 
+        files = []
+        for i, (X_new, single_use_key) in enumerate(zip(X_rows, single_use_keys)):
+            encrypted_data = self.client.quantize_encrypt_serialize(X_new)
+            files.append(('encrypted_data', self._file_part(f'encrypted_data_{i}.bin', encrypted_data)))
+            files.append(('single_use_key', (f'single_use_key_{i}.bin', single_use_key, 'application/octet-stream')))
+
+        response = self._post_with_evaluation_keys_id("/predict_batch", files)
+        self._log_response_size(response)
+
+        encrypted_results = unpack_frames(response.content)
+        if len(encrypted_results) != len(X_rows):
+            raise ValueError(f"Expected {len(X_rows)} results, received {len(encrypted_results)}")
+
+        label_meanings = self._get_label_meanings()
+        return [
+            self._is_risk(self.client.deserialize_decrypt_dequantize(encrypted_result), label_meanings)
+            for encrypted_result in encrypted_results
+        ]
+
+    def _is_risk(self, response, label_meanings):
+        """
+        Map a decrypted model output to the risk label.
+
+        :param response: Decrypted and dequantized model output.
+        :param label_meanings: Dictionary mapping labels to their meanings.
+        :return: True if the predicted label means "Risk".
+        """
         if response[0][0] > response[0][1]:
             prediction_result = 0
         else:
             prediction_result = 1
         prediction_label = label_meanings.get(str(prediction_result))
         logger.info(f"Prediction Result: {prediction_result}, Label: {prediction_label}")
-        return prediction_label == "Risk"
\ No newline at end of file
+        return prediction_label == "Risk"
@@ -0,0 +1,37 @@
+import struct
+from typing import List
+
+FRAMES_CONTENT_TYPE = "application/x-agedap-frames"
+
+_COUNT = struct.Struct(">I")
+_LENGTH = struct.Struct(">Q")
+
+
+def unpack_frames(body: bytes) -> List[bytes]:
+    """
+    Split a framed response body from the provider into its payloads.
+    The layout is a 4-byte big-endian frame count followed, for each frame,
+    by an 8-byte big-endian length and the raw payload bytes.
+
+    :param body: The framed response body.
+    :return: List of payloads, in order.
+    :raises ValueError: If the body is truncated or has trailing bytes.
+    """
+    view = memoryview(body)
+    if len(view) < _COUNT.size:
+        raise ValueError("Framed body is too short to contain a frame count.")
+    (count,) = _COUNT.unpack_from(view, 0)
+    offset = _COUNT.size
+    payloads = []
+    for _ in range(count):
+        if offset + _LENGTH.size > len(view):
+            raise ValueError("Framed body is truncated (missing frame length).")
+        (length,) = _LENGTH.unpack_from(view, offset)
+        offset += _LENGTH.size
+        if offset + length > len(view):
+            raise ValueError("Framed body is truncated (incomplete frame payload).")
+        payloads.append(bytes(view[offset:offset + length]))
+        offset += length
+    if offset != len(view):
+        raise ValueError("Framed body has trailing bytes after the last frame.")
+    return payloads
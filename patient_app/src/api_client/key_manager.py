@@ -49,4 +49,18 @@ class KeyManager:
         self.valid_keys = self._load_valid_keys()
         if not self.valid_keys:
             return None
-        return self.valid_keys.pop(0)
\ No newline at end of file
+        return self.valid_keys.pop(0)
+
+    def get_single_use_keys(self, count: int) -> list[str]:
+        """
+        Proporciona varias claves válidas distintas, una por cada predicción de un lote.
+        
+        Args:
+            count (int): Número de claves solicitadas.
+        
+        Returns:
+            list[str]: Las claves disponibles (puede contener menos de `count` si no hay suficientes).
+        """
+        self.valid_keys = self._load_valid_keys()
+        keys, self.valid_keys = self.valid_keys[:count], self.valid_keys[count:]
+        return keys
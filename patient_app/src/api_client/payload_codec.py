@@ -0,0 +1,65 @@
+import gzip
+from typing import List, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_LEVELS = {"zstd": 3, "gzip": 6}
+
+
+def available_encodings() -> List[str]:
+    """
+    Encodings this client can produce, in order of preference.
+    `gzip` is always available; `zstd` needs the optional `zstandard` package.
+    """
+    return ["zstd", "gzip"] if zstandard else ["gzip"]
+
+
+def parse_accept_encoding(header: Optional[str]) -> List[str]:
+    """
+    Parse the `Accept-Encoding` response header with which the provider advertises
+    the part encodings it accepts in uploads (RFC 7694).
+
+    :param header: The header value, or None if the server did not send it.
+    :return: The advertised encodings, in the server's order (empty if none or only identity).
+    """
+    encodings = []
+    for item in (header or "").split(","):
+        name, _, params = item.partition(";")
+        name = name.strip().lower()
+        quality = params.strip().lower()
+        if quality.startswith("q=") and quality[2:].strip().rstrip("0").rstrip(".") in ("", "0"):
+            continue
+        if name and name != "identity":
+            encodings.append(name)
+    return encodings
+
+
+def negotiate(server_encodings: List[str]) -> Optional[str]:
+    """
+    Pick the encoding for uploads: the first of this client's encodings the server accepts.
+
+    :param server_encodings: Encodings advertised by the server.
+    :return: The encoding, or None to send parts uncompressed.
+    """
+    return next((e for e in available_encodings() if e in server_encodings), None)
+
+
+def compress(data: bytes, encoding: str, level: Optional[int] = None) -> bytes:
+    """
+    Compress a payload.
+
+    :param data: The payload.
+    :param encoding: 'zstd' or 'gzip'.
+    :param level: Compression level, DEFAULT_LEVELS[encoding] when omitted.
+    :return: The compressed payload.
+    :raises ValueError: If the encoding is not supported.
+    """
+    level = DEFAULT_LEVELS.get(encoding) if level is None else level
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    if encoding == "zstd" and zstandard:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    raise ValueError(f"Unsupported content encoding '{encoding}'")
@@ -0,0 +1,50 @@
+import struct
+from typing import Optional
+
+PREDICT_CONTENT_TYPE = "application/x-agedap-predict"
+MAGIC = b"AGDP"
+VERSION = 1
+
+_HEADER = struct.Struct(">4sB")
+_SHORT = struct.Struct(">H")
+_LONG = struct.Struct(">Q")
+
+
+def accepts_predict_protocol(accept_post: Optional[str]) -> bool:
+    """
+    Check whether a server accepts the binary prediction protocol, from its 'Accept-Post' header.
+
+    :param accept_post: Value of the 'Accept-Post' response header, if any.
+    :return: True if the header lists `PREDICT_CONTENT_TYPE`.
+    """
+    media_types = [item.split(";")[0].strip().lower() for item in (accept_post or "").split(",")]
+    return PREDICT_CONTENT_TYPE in media_types
+
+
+def pack_predict_request(single_use_key: str, encrypted_data: bytes, evaluation_keys: Optional[bytes] = None,
+                         evaluation_keys_id: Optional[str] = None) -> bytes:
+    """
+    Encode a prediction request in the provider's binary protocol.
+    The layout is the 4-byte magic b"AGDP" and a 1-byte version, then the single-use key and the
+    evaluation keys id (2-byte big-endian length + text), the ciphertext and the evaluation keys
+    (8-byte big-endian length + bytes). Exactly one of the evaluation keys and their id is non-empty.
+
+    :param single_use_key: The single-use key of the prediction.
+    :param encrypted_data: The serialized ciphertext.
+    :param evaluation_keys: The serialized evaluation keys, sent inline.
+    :param evaluation_keys_id: The id of registered evaluation keys, instead of the keys.
+    :return: The request body.
+    :raises ValueError: If both or none of `evaluation_keys` and `evaluation_keys_id` are given.
+    """
+    if (evaluation_keys is None) == (evaluation_keys_id is None):
+        raise ValueError("Give either the evaluation keys or their id.")
+    key = single_use_key.encode("utf-8")
+    key_id = (evaluation_keys_id or "").encode("ascii")
+    evaluation_keys = evaluation_keys if evaluation_keys is not None else b""
+    return b"".join([
+        _HEADER.pack(MAGIC, VERSION),
+        _SHORT.pack(len(key)), key,
+        _SHORT.pack(len(key_id)), key_id,
+        _LONG.pack(len(encrypted_data)), encrypted_data,
+        _LONG.pack(len(evaluation_keys)), evaluation_keys,
+    ])
@@ -0,0 +1,93 @@
+'''
+Serves the configured services from an asyncio (ASGI) server, uvicorn.
+Uploads are received and parsed on the event loop, so thousands of idle or slow clients do
+not hold OS threads. Only the views that block (key checks and the FHE evaluation) run on a
+bounded thread executor, and metadata routes stay fast while FHE jobs run.
+
+    python provider/asgi_host.py                                      # every service, as in model_host.py
+    python provider/asgi_host.py --service "Breast Cancer Screening"   # one service on its server_port
+'''
+
+import argparse
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+provider_dir = os.path.join(project_root, "provider")
+if provider_dir not in sys.path:
+    sys.path.insert(0, provider_dir)
+
+import yaml
+
+from model_host import CONFIG_PATH, ModelHost
+from asgi_app import AsgiDispatcher, AsgiServiceApp
+from model_reload import install_reload_signal
+
+logger = logging.getLogger(__name__)
+
+
+def create_asgi_app(host, executor, service_name=None):
+    """Build the ASGI application for a ModelHost.
+    Args:
+        host (ModelHost): The host with its services built.
+        executor (concurrent.futures.Executor): Runs the blocking views of every service.
+        service_name (Optional[str]): Serve only this service, at the root path.
+    Returns:
+        The ASGI application.
+    """
+    if service_name:
+        service = next(s for s in host.services.values() if s.service_name == service_name)
+        return service.create_asgi_app(executor)
+    return AsgiDispatcher(
+        AsgiServiceApp(host.app, executor, inline_paths=("/services", "/status", "/metrics", "/healthz", "/readyz")),
+        {f"/services/{slug}": service.create_asgi_app(executor) for slug, service in host.services.items()}
+    )
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Serve the FHE services from an asyncio server.")
+    parser.add_argument("--service", default=None, help="Serve only this service (by service_name) on its server_port")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=None, help="Defaults to the service's server_port, or model_host.port")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Executor threads for the blocking views. Defaults to model_host.executor_threads, or cores + 4")
+    args = parser.parse_args()
+
+    try:
+        import uvicorn
+    except ImportError:
+        parser.error("the ASGI mode needs uvicorn (pip install uvicorn).")
+
+    with open(CONFIG_PATH, 'r') as file:
+        config = yaml.safe_load(file)
+    host_config = config.get("model_host", {})
+
+    if args.service:
+        config["datasets"] = [d for d in config.get("datasets", []) if d.get("service_name") == args.service]
+        if not config["datasets"]:
+            parser.error(f"No configuration found for service {args.service}")
+        port = args.port or config["datasets"][0].get("server_port")
+    else:
+        port = args.port or host_config.get("port", 5000)
+
+    host = ModelHost(config)
+    if args.service and not host.services:
+        logger.error(f"Service {args.service} could not be started.")
+        sys.exit(1)
+
+    threads = args.threads or host_config.get("executor_threads") or (os.cpu_count() or 1) + 4
+    executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="fhe-view")
+    install_reload_signal(host.reload_models)
+    logger.info(f"ASGI host serving {len(host.services)} services on http://{args.host}:{port} with {threads} executor threads")
+    try:
+        uvicorn.run(create_asgi_app(host, executor, args.service), host=args.host, port=port)
+    finally:
+        executor.shutdown(wait=False)
+        host.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+'''
+This script hosts every service declared in training_config.yaml in a single process.
+Each service is mounted under /services/<slug>/ and all of them share one pool of FHE
+worker processes and one job manager, instead of paying for a full interpreter and
+concrete-ml import per model.
+'''
+
+import argparse
+import importlib
+import logging
+import os
+import re
+import sys
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+services_dir = os.path.join(project_root, "provider", "services")
+for path in (project_root, services_dir):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import yaml
+from flask import Flask, Response, jsonify
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
+from werkzeug.serving import run_simple
+
+from execution import FHEWorkerPool, ProcessPoolExecutionBackend
+from job_queue import JobManager
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsRegistry
+from model_reload import install_reload_signal
+
+logger = logging.getLogger(__name__)
+
+CONFIG_PATH = os.path.join(project_root, "provider", "training_config.yaml")
+
+
+def service_slug(service_config):
+    """URL path segment of a service: 'slug' from the config, or the service name in kebab case."""
+    if service_config.get("slug"):
+        return service_config["slug"]
+    return re.sub(r"[^a-z0-9]+", "-", service_config["service_name"].lower()).strip("-")
+
+
+def model_exists(service_config):
+    """Check that the FHE artifacts of a service have been generated."""
+    return os.path.isfile(os.path.join(service_config["output_directory"], "server.zip"))
+
+
+def load_service_class(service_config):
+    """Import the AIServiceEndpoint subclass named by 'service_class' ("module.path.ClassName")."""
+    module_name, class_name = service_config["service_class"].rsplit(".", 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+class ModelHost:
+    """
+    Builds every configured service and mounts it under /services/<slug>/ of a single WSGI app.
+    Services with a `service_class` use their dedicated class; the others are built as a
+    GenericService from their YAML entry.
+    Attributes:
+        services (Dict[str, AIServiceEndpoint]): Mounted services by slug.
+        worker_pool (Optional[FHEWorkerPool]): Process pool shared by all services.
+        job_manager (JobManager): Job manager shared by all services.
+        metrics_registry (MetricsRegistry): Metrics of all services, summed over the processes
+            sharing `model_host.metrics_directory` when it is set.
+        wsgi_app: The WSGI application to serve.
+    """
+    def __init__(self, config, execution_backend=None, defer_start=False):
+        """
+        Args:
+            config (dict): The parsed training_config.yaml.
+            execution_backend (Optional[str]): Overrides `model_host.execution_backend`. The
+                pre-fork launcher uses 'inline', the forked workers being the parallelism.
+            defer_start (bool): Do not warm the services up nor watch their models while building them; call `start` later.
+        """
+        host_config = config.get("model_host", {})
+        service_configs = [c for c in config.get("datasets", []) if self._is_servable(c)]
+
+        self.services = {}
+        self.defer_start = defer_start
+        self.worker_processes = host_config.get("worker_processes", 1)
+        self.execution_backend = execution_backend or host_config.get("execution_backend", "process")
+        self.job_manager = JobManager(
+            max_workers=host_config.get("job_workers", 4),
+            max_pending=host_config.get("max_pending_jobs", 128),
+            result_ttl_seconds=host_config.get("job_result_ttl_seconds", 600),
+            spool_directory=host_config.get("job_spool_directory")
+        )
+        self.metrics_registry = MetricsRegistry(directory=host_config.get("metrics_directory"))
+        self.worker_pool = None
+        if self.execution_backend == "process" and service_configs:
+            workers = host_config.get("execution_workers") or os.cpu_count() or 1
+            self.worker_pool = FHEWorkerPool(
+                fhe_directories={c["service_name"]: c["output_directory"] for c in service_configs},
+                workers=workers,
+                evaluation_keys_cache_bytes=host_config.get("evaluation_keys_cache_bytes", 512 * 1024 * 1024)
+            )
+            self.worker_pool.start()
+            logger.info(f"Started {workers} FHE worker processes shared by {len(service_configs)} services.")
+
+        for service_config in service_configs:
+            slug = service_slug(service_config)
+            try:
+                self.services[slug] = self._create_service(service_config)
+                logger.info(f"Mounted {service_config['service_name']} under /services/{slug}/")
+            except Exception as e:
+                logger.error(f"Failed to create service {service_config['service_name']}: {e}", exc_info=True)
+
+        self.app = Flask("model_host")
+        self.app.add_url_rule("/services", view_func=self.list_services, methods=["GET"])
+        self.app.add_url_rule("/status", view_func=self.status, methods=["GET"])
+        self.app.add_url_rule("/metrics", view_func=self.metrics, methods=["GET"])
+        self.app.add_url_rule("/healthz", view_func=self.healthz, methods=["GET"])
+        self.app.add_url_rule("/readyz", view_func=self.readyz, methods=["GET"])
+        self.wsgi_app = DispatcherMiddleware(
+            self.app,
+            {f"/services/{slug}": service.app for slug, service in self.services.items()}
+        )
+
+    @staticmethod
+    def _is_servable(service_config):
+        if not service_config.get("service_name") or not service_config.get("output_directory"):
+            logger.warning(f"Skipping dataset {service_config.get('dataset_id')}: missing service_name or output_directory.")
+            return False
+        if not model_exists(service_config):
+            logger.error(f"Skipping {service_config['service_name']}: no server.zip in {service_config['output_directory']}.")
+            return False
+        return True
+
+    def _create_service(self, service_config):
+        shared = {"job_manager": self.job_manager, "execution_backend": self.execution_backend,
+                  "metrics_registry": self.metrics_registry, "defer_start": self.defer_start,
+                  "worker_processes": self.worker_processes}
+        if self.worker_pool:
+            shared["execution_backend"] = ProcessPoolExecutionBackend(self.worker_pool, service_config["service_name"])
+        if service_config.get("service_class"):
+            return load_service_class(service_config)(**shared)
+        from generic_service import GenericService
+        return GenericService(service_config["service_name"], **shared)
+
+    def list_services(self):
+        """Lists the mounted services and their base paths."""
+        return jsonify([
+            {"service_name": service.service_name, "path": f"/services/{slug}/"}
+            for slug, service in self.services.items()
+        ])
+
+    def status(self):
+        """Reports the shared worker pool, the job queue and per-service state."""
+        return jsonify({
+            "execution_workers": self.worker_pool.workers if self.worker_pool else 0,
+            "pending_jobs": self.job_manager.pending,
+            "rejected_jobs": self.job_manager.rejected,
+            "services": {
+                slug: {
+                    "service_name": service.service_name,
+                    "model_loaded": service.execution_backend is not None,
+                    "ready": service.is_ready()[0],
+                    "model_version": service.model_version,
+                    "execution_mode": service.execution_mode,
+                    "cached_evaluation_keys_bytes": service.evaluation_key_store.cached_bytes,
+                    "predictions": service.admission.stats()
+                }
+                for slug, service in self.services.items()
+            }
+        })
+
+    def start(self, watch_models=True):
+        """Warm up every service and watch their models (for hosts built with `defer_start`).
+        Args:
+            watch_models (bool): Start the model watchers (pre-forked workers leave them to the master, see `watch_models`).
+        """
+        for service in self.services.values():
+            service.start(watch_model=watch_models)
+
+    def watch_models(self, on_reload):
+        """Watch the models of every service from this process (the pre-fork master): a retrained
+        model is reloaded here, without a warm-up, then `on_reload` is called to replace the
+        workers, which inherit it copy-on-write instead of each loading it into private memory."""
+        for service in self.services.values():
+            service.start_model_watcher(lambda service=service: service.reload_model(warm_up=False) and on_reload())
+
+    def reload_models(self, warm_up=True):
+        """Reload the services whose model was retrained (see `AIServiceEndpoint.reload_model`).
+        Returns:
+            List[str]: Slugs of the services that swapped in a new model version.
+        """
+        return [slug for slug, service in self.services.items() if service.reload_model(warm_up=warm_up)]
+
+    def healthz(self):
+        """Liveness probe of the host process."""
+        return jsonify({"status": "ok"}), 200
+
+    def readyz(self):
+        """Readiness probe: 200 once every mounted service is loaded and warmed up, 503 otherwise."""
+        services = {}
+        for slug, service in self.services.items():
+            ready, reason = service.is_ready()
+            services[slug] = {"ready": ready, **({"reason": reason} if reason else {})}
+        ready = bool(services) and all(s["ready"] for s in services.values())
+        return jsonify({"ready": ready, "services": services}), 200 if ready else 503
+
+    def metrics(self):
+        """Exposes the metrics of every service, from the shared registry, in the Prometheus text format."""
+        return Response(self.metrics_registry.render(), content_type=METRICS_CONTENT_TYPE)
+
+    def shutdown(self, wait=False):
+        """Stop the shared job manager and worker pool, and save the usage and consumed keys
+        of every service (see `AIServiceEndpoint.shutdown`).
+        Args:
+            wait (bool): Wait for queued and running jobs to finish.
+        """
+        self.job_manager.shutdown(wait=wait)
+        for slug, service in self.services.items():
+            try:
+                service.shutdown()
+            except Exception as e:
+                logger.error(f"Failed to shut down service {slug}: {e}", exc_info=True)
+        self.metrics_registry.flush()
+        if self.worker_pool:
+            self.worker_pool.shutdown()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Serve all configured FHE services from one process.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=None, help="Defaults to model_host.port in the config, or 5000")
+    args = parser.parse_args()
+
+    with open(CONFIG_PATH, 'r') as file:
+        config = yaml.safe_load(file)
+    port = args.port or config.get("model_host", {}).get("port", 5000)
+
+    host = ModelHost(config)
+    install_reload_signal(host.reload_models)
+    logger.info(f"Model host serving {len(host.services)} services on http://{args.host}:{port}")
+    try:
+        run_simple(args.host, port, host.wsgi_app, threaded=True)
+    finally:
+        host.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+'''
+Production launcher for the FHE services, using a pre-fork process model.
+The master process builds the services, loading every FHEModelServer once, and opens the
+listening socket. It then forks the workers, so the compiled circuits are shared
+copy-on-write instead of being loaded again by each worker. Every worker serves requests
+on the inherited socket with werkzeug's threaded server and runs the FHE circuits inline.
+After `max_requests` requests (plus a random jitter, so that workers do not all restart
+together) a worker finishes its in-flight requests and jobs, exits, and is replaced.
+
+    python provider/prefork.py                                     # every service, as in model_host.py
+    python provider/prefork.py --service "Breast Cancer Screening"  # one service on its server_port
+
+SIGTERM and SIGINT stop the server gracefully; SIGHUP replaces all the workers. The master
+watches the models: when one is retrained, it reloads it and replaces all the workers too.
+'''
+
+import argparse
+import logging
+import os
+import random
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+provider_dir = os.path.join(project_root, "provider")
+if provider_dir not in sys.path:
+    sys.path.insert(0, provider_dir)
+
+import yaml
+from werkzeug.serving import make_server, select_address_family
+from werkzeug.wsgi import ClosingIterator
+
+from model_host import CONFIG_PATH, ModelHost
+
+logger = logging.getLogger(__name__)
+
+
+def available_cores():
+    """Number of cores this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def default_worker_count(servers=1):
+    """Workers per server when `servers` pre-fork servers share the machine: one per available core."""
+    return max(available_cores() // max(servers, 1), 1)
+
+
+class RequestCounter:
+    """
+    WSGI middleware that counts the requests served by a worker and tracks the ones in flight.
+    `on_limit` is called once, when the `max_requests`-th request starts (0 disables it), so
+    the worker stops accepting connections while that last request is being answered.
+    """
+    def __init__(self, app, max_requests, on_limit):
+        self.app = app
+        self.max_requests = max_requests
+        self.on_limit = on_limit
+        self.started = 0
+        self.served = 0
+        self.active = 0
+        self._idle = threading.Condition()
+
+    def __call__(self, environ, start_response):
+        with self._idle:
+            self.active += 1
+            self.started += 1
+            limit_reached = self.max_requests and self.started == self.max_requests
+        if limit_reached:
+            self.on_limit()
+        try:
+            app_iter = self.app(environ, start_response)
+        except BaseException:
+            self._finish()
+            raise
+        return ClosingIterator(app_iter, self._finish)
+
+    def _finish(self):
+        with self._idle:
+            self.active -= 1
+            self.served += 1
+            self._idle.notify_all()
+
+    def wait_idle(self, timeout):
+        """Wait until no request is in flight. Returns False if `timeout` seconds passed first."""
+        with self._idle:
+            return self._idle.wait_for(lambda: self.active == 0, timeout)
+
+
+class PreforkServer:
+    """
+    Forks `workers` processes serving a WSGI app on a socket opened by the master, and
+    replaces them when they exit.
+    Attributes:
+        app: The WSGI application, built in the master before forking.
+        host (str): Interface to listen on.
+        port (int): Port to listen on (0 picks a free port, available once `listen` ran).
+        workers (int): Number of worker processes.
+        max_requests (int): Requests served by a worker before it is replaced (0: never).
+        max_requests_jitter (int): Random extra requests added to `max_requests` per worker.
+        graceful_timeout (float): Seconds a stopping worker waits for its in-flight requests.
+        on_reload (Optional[Callable[[], None]]): Called in the master on SIGHUP, before the workers are replaced.
+        on_worker_start (Optional[Callable[[], None]]): Called in a worker before it accepts requests.
+        on_worker_exit (Optional[Callable[[], None]]): Called in a worker before it exits.
+    """
+    def __init__(self, app, host, port, workers, max_requests=0, max_requests_jitter=0,
+                 graceful_timeout=60, on_reload=None, on_worker_start=None, on_worker_exit=None):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self.on_reload = on_reload
+        self.on_worker_start = on_worker_start
+        self.on_worker_exit = on_worker_exit
+        self.socket = None
+        self._workers = {}
+        self._running = False
+        self._reload_requested = False
+        self._replace_requested = False
+
+    def listen(self):
+        """Open the listening socket shared by all workers."""
+        self.socket = socket.create_server(
+            (self.host, self.port),
+            family=select_address_family(self.host, self.port),
+            backlog=2048
+        )
+        self.port = self.socket.getsockname()[1]
+
+    def run(self):
+        """Fork the workers and supervise them until SIGTERM or SIGINT."""
+        if self.socket is None:
+            self.listen()
+        self._running = True
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_reload)
+        logger.info(f"Pre-fork master {os.getpid()} listening on http://{self.host}:{self.port} with {self.workers} workers.")
+        try:
+            while self._running:
+                self._reap_workers()
+                if self._reload_requested:
+                    self._reload_requested = False
+                    if self.on_reload:
+                        self.on_reload()
+                    self._replace_requested = True
+                if self._replace_requested:
+                    self._replace_requested = False
+                    logger.info("Replacing all workers.")
+                    self._signal_workers(signal.SIGTERM)
+                while self._running and len(self._workers) < self.workers:
+                    self._spawn_worker()
+                time.sleep(0.2)
+        finally:
+            self._stop_workers()
+            self.socket.close()
+
+    def _handle_stop(self, signum, frame):
+        self._running = False
+
+    def _handle_reload(self, signum, frame):
+        self._reload_requested = True
+
+    def replace_workers(self):
+        """Replace all the workers, e.g. after the master reloaded a model (callable from any thread)."""
+        self._replace_requested = True
+
+    def _signal_workers(self, signum):
+        for pid in list(self._workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _reap_workers(self):
+        while self._workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self._workers.clear()
+                return
+            if pid == 0:
+                return
+            if self._workers.pop(pid, None) is not None:
+                exit_code = os.waitstatus_to_exitcode(status)
+                log = logger.info if exit_code == 0 else logger.warning
+                log(f"Worker {pid} exited with code {exit_code}.")
+
+    def _stop_workers(self):
+        """Ask the workers to finish their in-flight requests, then kill the ones that do not exit in time."""
+        self._signal_workers(signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout + 5
+        while self._workers and time.monotonic() < deadline:
+            self._reap_workers()
+            time.sleep(0.1)
+        if self._workers:
+            logger.warning(f"Killing {len(self._workers)} workers that did not stop in time.")
+            self._signal_workers(signal.SIGKILL)
+            for pid in list(self._workers):
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+            self._workers.clear()
+
+    def _spawn_worker(self):
+        pid = os.fork()
+        if pid:
+            self._workers[pid] = time.monotonic()
+            return
+        exit_code = 1
+        try:
+            exit_code = self._worker_main()
+        except BaseException:
+            logger.exception(f"Worker {os.getpid()} crashed.")
+        finally:
+            os._exit(exit_code)
+
+    def _worker_main(self):
+        """Serve requests until SIGTERM or until `max_requests` requests have been served."""
+        # Ctrl-C reaches the whole process group: let the master stop the workers.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        max_requests = self.max_requests
+        if max_requests:
+            max_requests += random.randint(0, self.max_requests_jitter)
+
+        if self.on_worker_start:
+            self.on_worker_start()
+        stopping = threading.Event()
+
+        def stop(*args):
+            if not stopping.is_set():
+                stopping.set()
+                # shutdown() blocks until serve_forever returns, so it cannot run in the serving thread.
+                threading.Thread(target=server.shutdown, daemon=True).start()
+
+        counter = RequestCounter(self.app, max_requests, on_limit=stop)
+        server = make_server(self.host, self.port, counter, threaded=True, fd=self.socket.fileno())
+        signal.signal(signal.SIGTERM, stop)
+        logger.info(f"Worker {os.getpid()} started (max_requests={max_requests or 'unlimited'}).")
+
+        server.serve_forever()
+        if not counter.wait_idle(self.graceful_timeout):
+            logger.warning(f"Worker {os.getpid()} exiting with {counter.active} requests in flight.")
+        if self.on_worker_exit:
+            self.on_worker_exit()
+        logger.info(f"Worker {os.getpid()} stopping after {counter.served} requests.")
+        return 0
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(process)d - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Serve the FHE services with pre-forked worker processes.")
+    parser.add_argument("--service", default=None, help="Serve only this service (by service_name) on its server_port")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=None, help="Defaults to the service's server_port, or model_host.port")
+    parser.add_argument("--workers", type=int, default=None, help="Defaults to prefork.workers in the config, or one per available core")
+    parser.add_argument("--max-requests", type=int, default=None, help="Requests served by a worker before it is replaced (0: never)")
+    parser.add_argument("--max-requests-jitter", type=int, default=None)
+    parser.add_argument("--graceful-timeout", type=float, default=None)
+    args = parser.parse_args()
+
+    if not hasattr(os, "fork"):
+        parser.error("pre-fork mode requires os.fork; use model_host.py on this platform.")
+
+    with open(CONFIG_PATH, 'r') as file:
+        config = yaml.safe_load(file)
+    prefork_config = config.get("prefork", {})
+
+    if args.service:
+        config["datasets"] = [d for d in config.get("datasets", []) if d.get("service_name") == args.service]
+        if not config["datasets"]:
+            parser.error(f"No configuration found for service {args.service}")
+        port = args.port or config["datasets"][0].get("server_port")
+    else:
+        port = args.port or config.get("model_host", {}).get("port", 5000)
+
+    workers = args.workers or prefork_config.get("workers") or default_worker_count()
+    # The workers split the admission limits of each service (max_concurrent_predictions is per host).
+    config.setdefault("model_host", {})["worker_processes"] = workers
+    # Jobs run in the worker that accepted them; their state is spooled so any worker can answer polls.
+    spool_directory = tempfile.mkdtemp(prefix="agedap-jobs-")
+    config["model_host"]["job_spool_directory"] = spool_directory
+    # Each worker writes its metrics there too, so that /metrics sums those of all workers.
+    config["model_host"]["metrics_directory"] = os.path.join(spool_directory, "metrics")
+    # The FHE runtime is warmed up in each worker: its threads would not survive the fork.
+    # The master watches the models (see below); on SIGHUP it reloads them before forking new workers.
+    host = ModelHost(config, execution_backend="inline", defer_start=True)
+    if args.service:
+        if not host.services:
+            logger.error(f"Service {args.service} could not be started.")
+            sys.exit(1)
+        app = next(iter(host.services.values())).app
+    else:
+        app = host.wsgi_app
+
+    server = PreforkServer(
+        app,
+        host=args.host,
+        port=port,
+        workers=workers,
+        max_requests=args.max_requests if args.max_requests is not None else prefork_config.get("max_requests", 1000),
+        max_requests_jitter=args.max_requests_jitter if args.max_requests_jitter is not None else prefork_config.get("max_requests_jitter", 100),
+        graceful_timeout=args.graceful_timeout or prefork_config.get("graceful_timeout", 120),
+        on_reload=lambda: host.reload_models(warm_up=False),
+        on_worker_start=lambda: host.start(watch_models=False),
+        on_worker_exit=lambda: host.shutdown(wait=True)
+    )
+    # A retrained model is loaded once, in the master, and shared copy-on-write by the new workers.
+    host.watch_models(on_reload=server.replace_workers)
+    try:
+        server.run()
+    finally:
+        shutil.rmtree(spool_directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
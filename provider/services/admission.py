@@ -0,0 +1,130 @@
+from contextlib import contextmanager
+import math
+import threading
+import time
+
+
+class AdmissionRejectedError(Exception):
+    """Raised when a prediction cannot be admitted, because the queue is full or the wait timed out.
+    Attributes:
+        status_code (int): HTTP status code of the rejection.
+        retry_after (int): Seconds after which the client should retry.
+    """
+    def __init__(self, message, status_code, retry_after):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Bounds the number of predictions a service runs at once.
+    Up to `max_in_flight` predictions run concurrently and up to `max_queued` more wait for a
+    slot, for at most `queue_timeout_seconds`. Requests beyond that are rejected right away
+    with a retry delay estimated from the moving average (EWMA) of the prediction latency.
+    Attributes:
+        max_in_flight (int): Maximum number of predictions running at once.
+        max_queued (int): Maximum number of predictions waiting for a slot.
+        queue_timeout_seconds (float): Maximum time a prediction waits for a slot.
+        reject_status (int): Status code for requests rejected because the queue is full (429 or 503).
+        latency_alpha (float): Weight of the latest sample in the latency moving average.
+        latency_seconds (float): Moving average of the prediction latency.
+    """
+    def __init__(self, max_in_flight, max_queued, queue_timeout_seconds=30, reject_status=503,
+                 latency_alpha=0.2, initial_latency_seconds=1.0):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.queue_timeout_seconds = queue_timeout_seconds
+        self.reject_status = reject_status
+        self.latency_alpha = latency_alpha
+        self.latency_seconds = initial_latency_seconds
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self._condition = threading.Condition()
+
+    def retry_after(self):
+        """Estimate when a new prediction would get a slot.
+        Returns:
+            int: Whole seconds, at least 1.
+        """
+        with self._condition:
+            return self._retry_after()
+
+    def _retry_after(self):
+        rounds = math.ceil((self.queued + 1) / self.max_in_flight)
+        return max(1, math.ceil(rounds * self.latency_seconds))
+
+    def acquire(self):
+        """Take a slot, waiting in the queue if all slots are in use.
+        Raises:
+            AdmissionRejectedError: If the queue is full, or no slot frees up within `queue_timeout_seconds`.
+        """
+        with self._condition:
+            if self.in_flight >= self.max_in_flight:
+                if self.queued >= self.max_queued:
+                    self.rejected_queue_full += 1
+                    raise AdmissionRejectedError(
+                        f"Too many predictions in progress ({self.in_flight} running, {self.queued} queued).",
+                        self.reject_status, self._retry_after()
+                    )
+                self.queued += 1
+                try:
+                    admitted = self._condition.wait_for(lambda: self.in_flight < self.max_in_flight, self.queue_timeout_seconds)
+                finally:
+                    self.queued -= 1
+                if not admitted:
+                    self.rejected_timeout += 1
+                    raise AdmissionRejectedError(
+                        f"No prediction slot became free within {self.queue_timeout_seconds} seconds.",
+                        503, self._retry_after()
+                    )
+            self.in_flight += 1
+            self.admitted += 1
+
+    def release(self):
+        """Give back a slot taken with `acquire`."""
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    @contextmanager
+    def slot(self):
+        """Hold a slot for the duration of the block (see `acquire`)."""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def record_latency(self, seconds):
+        """Add a prediction latency sample to the moving average."""
+        with self._condition:
+            self.latency_seconds += self.latency_alpha * (seconds - self.latency_seconds)
+
+    @contextmanager
+    def measure(self):
+        """Record the duration of the block as a latency sample, unless it raises."""
+        start = time.monotonic()
+        yield
+        self.record_latency(time.monotonic() - start)
+
+    def stats(self):
+        """Snapshot of the queue, for monitoring.
+        Returns:
+            dict: Current depth, limits, counters and latency estimate.
+        """
+        with self._condition:
+            return {
+                "in_flight": self.in_flight,
+                "queued": self.queued,
+                "max_in_flight": self.max_in_flight,
+                "max_queued": self.max_queued,
+                "admitted": self.admitted,
+                "rejected_queue_full": self.rejected_queue_full,
+                "rejected_timeout": self.rejected_timeout,
+                "latency_ewma_seconds": round(self.latency_seconds, 3),
+                "retry_after_seconds": self._retry_after()
+            }
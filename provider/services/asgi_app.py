@@ -0,0 +1,354 @@
+"""
+ASGI front end for the provider services.
+
+`AsgiServiceApp` serves the Flask app of a service from an asyncio server (e.g. uvicorn).
+Request bodies are received, and multipart uploads parsed, on the event loop, so a slow
+client uploading evaluation keys only costs a coroutine instead of an OS thread. Other bodies
+(the binary predict protocol, resumable upload chunks) are spooled as they arrive, like file
+parts. The parsed request is then handed to the Flask view on a thread executor, where the key checks and the
+FHE evaluation block. Cheap metadata routes and prediction job long-polls are answered on the
+event loop without taking an executor thread.
+"""
+
+import asyncio
+import io
+import json
+import re
+import shutil
+import sys
+from urllib.parse import parse_qsl, urlencode
+
+from flask import Request, current_app
+from werkzeug.datastructures import FileStorage, Headers, MultiDict
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+from uploads import DEFAULT_SPOOL_THRESHOLD, SpooledPart
+
+PREPARSED_FORM_KEY = "agedap.preparsed_form"
+PREPARSED_BODY_KEY = "agedap.preparsed_body"
+METADATA_PATHS = ("/omop_requirements", "/additional_service_info", "/queue_stats", "/metrics", "/healthz", "/readyz")
+_JOB_PATH = re.compile(r"^/jobs/(?P<job_id>[^/]+)$")
+
+
+class ClientDisconnected(Exception):
+    """Raised when the client goes away before its request body was received."""
+
+
+class PreparsedRequest(Request):
+    """Flask request class of the services. It uses the form data parsed by the ASGI front end
+    when there is one, and stores file parts as SpooledPart within the app's upload limits."""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        config = current_app.config if current_app else {}
+        return SpooledPart(
+            config.get("UPLOAD_SPOOL_THRESHOLD", DEFAULT_SPOOL_THRESHOLD),
+            config.get("UPLOAD_MAX_PART_BYTES")
+        )
+
+    def _load_form_data(self):
+        preparsed = self.environ.get(PREPARSED_FORM_KEY)
+        if preparsed is None or "form" in self.__dict__:
+            return super()._load_form_data()
+        d = self.__dict__
+        d["stream"], (d["form"], d["files"]) = io.BytesIO(), preparsed
+
+    def body_part(self):
+        """The request body as a SpooledPart, for bodies that are not forms: the one spooled by
+        the ASGI front end, otherwise the input stream spooled within MAX_CONTENT_LENGTH.
+        Raises:
+            RequestEntityTooLarge: If the body is over MAX_CONTENT_LENGTH.
+        """
+        body = self.environ.get(PREPARSED_BODY_KEY)
+        if body is None:
+            config = current_app.config if current_app else {}
+            body = SpooledPart(config.get("UPLOAD_SPOOL_THRESHOLD", DEFAULT_SPOOL_THRESHOLD), config.get("MAX_CONTENT_LENGTH"))
+            shutil.copyfileobj(self.stream, body, 1024 * 1024)
+            body.seek(0)
+        return body
+
+
+async def receive_body_chunks(receive, max_size=None):
+    """Yield the chunks of an ASGI request body as they arrive, raising
+    RequestEntityTooLarge once more than `max_size` bytes were received."""
+    received = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ClientDisconnected()
+        chunk = message.get("body", b"")
+        received += len(chunk)
+        if max_size is not None and received > max_size:
+            raise RequestEntityTooLarge()
+        yield chunk
+        if not message.get("more_body", False):
+            return
+
+
+async def read_body(receive, max_size=None):
+    """Receive a whole ASGI request body."""
+    return b"".join([chunk async for chunk in receive_body_chunks(receive, max_size)])
+
+
+async def spool_body(receive, spool_threshold=DEFAULT_SPOOL_THRESHOLD, max_size=None):
+    """Receive a whole ASGI request body into a SpooledPart, spooled to disk past `spool_threshold`.
+    Raises:
+        RequestEntityTooLarge: If the body is over `max_size`.
+        ClientDisconnected: If the client went away before the end of the body.
+    """
+    body = SpooledPart(spool_threshold, max_size)
+    try:
+        async for chunk in receive_body_chunks(receive, max_size):
+            body.write(chunk)
+    except BaseException:
+        body.close()
+        raise
+    body.seek(0)
+    return body
+
+
+async def parse_multipart(receive, boundary, spool_threshold=DEFAULT_SPOOL_THRESHOLD, max_part_size=None, max_size=None):
+    """Parse a multipart/form-data body while it is received.
+    File parts are stored as SpooledPart, like the Flask request class of the services does.
+    Args:
+        receive: The ASGI receive callable.
+        boundary (bytes): The multipart boundary.
+        spool_threshold (int): Size from which a file part is spooled to disk.
+        max_part_size (Optional[int]): Maximum size of a file part.
+        max_size (Optional[int]): Maximum size of the whole body.
+    Returns:
+        Tuple[MultiDict, MultiDict]: The form fields and the uploaded files, as Flask parses them.
+    Raises:
+        ValueError: If the body is not valid multipart data.
+        RequestEntityTooLarge: If a part or the whole body is over its limit.
+        ClientDisconnected: If the client went away before the end of the body.
+    """
+    decoder = MultipartDecoder(boundary)
+    fields, files = [], []
+    current_part, container = None, None
+
+    async def chunks():
+        async for chunk in receive_body_chunks(receive, max_size):
+            if chunk:
+                yield chunk
+        yield None
+
+    try:
+        async for data in chunks():
+            decoder.receive_data(data)
+            event = decoder.next_event()
+            while not isinstance(event, (Epilogue, NeedData)):
+                if isinstance(event, Field):
+                    current_part, container = event, []
+                elif isinstance(event, File):
+                    current_part = event
+                    container = SpooledPart(spool_threshold, max_part_size)
+                elif isinstance(event, Data):
+                    if isinstance(current_part, Field):
+                        container.append(event.data)
+                    else:
+                        container.write(event.data)
+                    if not event.more_data:
+                        if isinstance(current_part, Field):
+                            _, options = parse_options_header(current_part.headers.get("content-type", ""))
+                            value = b"".join(container).decode(options.get("charset", "utf-8"), "replace")
+                            fields.append((current_part.name, value))
+                        else:
+                            container.seek(0)
+                            files.append((current_part.name, FileStorage(
+                                container, current_part.filename, current_part.name, headers=current_part.headers
+                            )))
+                event = decoder.next_event()
+    except BaseException:
+        # Size limit, malformed body or disconnect: free the parts spooled so far (temporary files).
+        if isinstance(container, SpooledPart):
+            container.close()
+        for _, file_storage in files:
+            file_storage.stream.close()
+        raise
+    return MultiDict(fields), MultiDict(files)
+
+
+def build_environ(scope, body=b""):
+    """Build the WSGI environ of an ASGI HTTP request, whose body (bytes or a readable file
+    object) was received in full.
+    `scope["path"]` is taken relative to `scope["root_path"]`, as set by `AsgiDispatcher`.
+    """
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": str(server_name),
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body) if isinstance(body, (bytes, bytearray)) else body,
+        "wsgi.input_terminated": True,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    for raw_name, raw_value in scope.get("headers", []):
+        name, value = raw_name.decode("latin-1").upper().replace("-", "_"), raw_value.decode("latin-1")
+        key = name if name in ("CONTENT_TYPE", "CONTENT_LENGTH") else f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def call_wsgi(wsgi_app, environ):
+    """Run a WSGI app to completion.
+    Returns:
+        Tuple[int, list, bytes]: Status code, headers and body of the response.
+    """
+    response, chunks = {}, []
+
+    def start_response(status, headers, exc_info=None):
+        response["status"], response["headers"] = int(status.split(" ", 1)[0]), headers
+        return chunks.append
+
+    app_iter = wsgi_app(environ, start_response)
+    try:
+        chunks.extend(app_iter)
+    finally:
+        if hasattr(app_iter, "close"):
+            app_iter.close()
+    return response["status"], response["headers"], b"".join(chunks)
+
+
+async def send_response(send, status, headers, body):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(name.lower().encode("latin-1"), str(value).encode("latin-1")) for name, value in headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def serve_lifespan(receive, send):
+    """Answer the ASGI lifespan protocol: nothing to set up, everything is built beforehand."""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+class AsgiServiceApp:
+    """
+    ASGI application serving a Flask (WSGI) app with its request bodies handled on the event loop.
+    Attributes:
+        wsgi_app: The Flask app of the service. Its `request_class` should be `PreparsedRequest`.
+        executor (concurrent.futures.Executor): Runs the views that block (key checks, FHE evaluation).
+        inline_paths (Tuple[str, ...]): GET routes cheap enough to be answered on the event loop.
+        job_manager (Optional[JobManager]): Lets `GET /jobs/<job_id>?wait=N` long-poll on the event loop.
+        max_job_wait_seconds (float): Cap on the long-poll duration.
+    """
+    def __init__(self, wsgi_app, executor, inline_paths=METADATA_PATHS, job_manager=None,
+                 max_job_wait_seconds=30, job_poll_interval=0.1):
+        self.wsgi_app = wsgi_app
+        self.executor = executor
+        self.inline_paths = tuple(inline_paths)
+        self.job_manager = job_manager
+        self.max_job_wait_seconds = max_job_wait_seconds
+        self.job_poll_interval = job_poll_interval
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await serve_lifespan(receive, send)
+        if scope["type"] != "http":
+            raise ValueError(f"Unsupported ASGI scope type: {scope['type']}")
+        job_path = _JOB_PATH.match(scope["path"]) if self.job_manager else None
+        if scope["method"] == "GET" and scope["path"] in self.inline_paths:
+            response = call_wsgi(self.wsgi_app, build_environ(scope))
+        elif scope["method"] == "GET" and job_path:
+            response = await self._long_poll_job(scope, job_path["job_id"])
+        else:
+            try:
+                environ = await self._receive_request(scope, receive)
+            except ClientDisconnected:
+                return
+            except RequestEntityTooLarge as e:
+                body = json.dumps({"error": e.description}).encode()
+                return await send_response(send, 413, [("Content-Type", "application/json")], body)
+            except ValueError as e:
+                body = json.dumps({"error": f"Malformed request body: {e}"}).encode()
+                return await send_response(send, 400, [("Content-Type", "application/json")], body)
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(self.executor, call_wsgi, self.wsgi_app, environ)
+        await send_response(send, *response)
+
+    async def _receive_request(self, scope, receive):
+        """Receive the request body, parsing multipart uploads into the environ as they arrive
+        and spooling other bodies (see `PreparsedRequest.body_part`).
+        The upload limits are those of the Flask app (MAX_CONTENT_LENGTH, UPLOAD_MAX_PART_BYTES
+        and UPLOAD_SPOOL_THRESHOLD)."""
+        headers = Headers([(name.decode("latin-1"), value.decode("latin-1")) for name, value in scope.get("headers", [])])
+        config = getattr(self.wsgi_app, "config", {})
+        max_size = config.get("MAX_CONTENT_LENGTH")
+        content_length = headers.get("content-length", type=int)
+        if max_size is not None and content_length is not None and content_length > max_size:
+            raise RequestEntityTooLarge()
+        spool_threshold = config.get("UPLOAD_SPOOL_THRESHOLD", DEFAULT_SPOOL_THRESHOLD)
+        mimetype, options = parse_options_header(headers.get("content-type", ""))
+        if mimetype == "multipart/form-data" and options.get("boundary"):
+            preparsed = await parse_multipart(
+                receive,
+                options["boundary"].encode("latin-1"),
+                spool_threshold=spool_threshold,
+                max_part_size=config.get("UPLOAD_MAX_PART_BYTES"),
+                max_size=max_size
+            )
+            environ = build_environ(scope)
+            environ[PREPARSED_FORM_KEY] = preparsed
+            return environ
+        body = await spool_body(receive, spool_threshold=spool_threshold, max_size=max_size)
+        environ = build_environ(scope, body)
+        environ[PREPARSED_BODY_KEY] = body
+        return environ
+
+    async def _long_poll_job(self, scope, job_id):
+        """Wait on the event loop until the job finishes or the requested wait expires,
+        then let the Flask view answer with the job's current state."""
+        query = parse_qsl(scope.get("query_string", b"").decode("latin-1"))
+        try:
+            wait_seconds = min(float(dict(query).get("wait", 0)), self.max_job_wait_seconds)
+        except ValueError:
+            wait_seconds = 0
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait_seconds
+        while True:
+            job = self.job_manager.get(job_id)
+            remaining = deadline - loop.time()
+            if job is None or job.finished or remaining <= 0:
+                break
+            await asyncio.sleep(min(self.job_poll_interval, remaining))
+        scope = dict(scope, query_string=urlencode([(k, v) for k, v in query if k != "wait"]).encode("latin-1"))
+        return call_wsgi(self.wsgi_app, build_environ(scope))
+
+
+class AsgiDispatcher:
+    """
+    Routes ASGI requests to the application mounted at the longest matching path prefix,
+    like werkzeug's DispatcherMiddleware. The prefix is moved from `path` to `root_path`.
+    """
+    def __init__(self, default_app, mounts):
+        self.default_app = default_app
+        self.mounts = dict(mounts)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await serve_lifespan(receive, send)
+        path = scope["path"]
+        for prefix in sorted(self.mounts, key=len, reverse=True):
+            if path == prefix or path.startswith(prefix + "/"):
+                scope = dict(scope, root_path=scope.get("root_path", "") + prefix, path=path[len(prefix):] or "/")
+                return await self.mounts[prefix](scope, receive, send)
+        return await self.default_app(scope, receive, send)
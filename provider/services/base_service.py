@@ -1,25 +1,161 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, has_request_context, request, jsonify, url_for
 from abc import ABC, abstractmethod
 from key_manager import KeyManager
+from sqlite_key_store import SQLiteKeyManager
+from framing import pack_frames, FRAMES_CONTENT_TYPE
+from evaluation_key_store import EvaluationKeyStore
+from resumable_uploads import ResumableUploadStore, UploadError
+from execution import (
+    ClearExecutionBackend, EchoExecutionBackend, FHEWorkerPool, InlineExecutionBackend, ProcessPoolExecutionBackend
+)
+from job_queue import JobManager, JobQueueFullError
+from admission import AdmissionController, AdmissionRejectedError
+from idempotency_cache import IdempotencyCache, IdempotencyConflictError
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsRegistry, ServiceMetrics
+from asgi_app import AsgiServiceApp, PreparsedRequest
+from uploads import DEFAULT_SPOOL_THRESHOLD, BufferPart, read_part
+from predict_protocol import PREDICT_CONTENT_TYPE, parse_predict_request
+from payload_codec import DEFAULT_LEVELS, available_encodings, compress, decompress_stream
+from model_reload import ModelWatcher, install_reload_signal, model_version
+from usage_meter import UsageMeter
+from slow_requests import DEFAULT_LOG_DIRECTORY as SLOW_REQUEST_LOG_DIRECTORY, SlowRequestLog, SlowRequestProfiler, StackSampler
+from werkzeug.datastructures import FileStorage, MultiDict
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import parse_content_range_header
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import datetime
+import hashlib
+import io
+import json
 import logging
+import os
+import tempfile
+import threading
+import time
 import yaml
 from pathlib import Path
 
 
+class PredictionRequestError(Exception):
+    """Raised while reading a prediction request that must be rejected.
+    Attributes:
+        status_code (int): HTTP status code of the error response.
+        headers (dict): Extra headers of the error response.
+        details (dict): Extra fields added to the JSON error body.
+    """
+    def __init__(self, message, status_code, headers=None, **details):
+        super().__init__(message)
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.details = details
+
+    def to_response(self):
+        """Build the Flask JSON error response."""
+        return jsonify({"error": str(self), **self.details}), self.status_code, self.headers
+
+
 class AIServiceEndpoint(ABC):
-    def __init__(self, service_name):
+    # Endpoints timed, counted in flight and counted on errors by the request metrics.
+    METERED_ENDPOINTS = (
+        "predict", "predict_batch", "submit_prediction_job", "register_evaluation_keys", "finalize_evaluation_key_upload"
+    )
+    # Endpoints whose usage is charged to the key account of their single-use keys (one per service xPub).
+    USAGE_METERED_ENDPOINTS = ("predict", "predict_batch")
+    # Endpoints profiled by the slow-request profiler.
+    PROFILED_ENDPOINTS = ("predict", "predict_batch")
+    # 'execute' runs the FHE circuit; the others are non-production modes for load testing.
+    EXECUTION_MODES = ("execute", "echo", "clear")
+
+    def __init__(self, service_name, execution_backend=None, job_manager=None, metrics_registry=None,
+                 defer_start=False, worker_processes=1):
+        """
+        Args:
+            service_name (str): Name of the service, as in training_config.yaml.
+            execution_backend (Optional): Backend to run the FHE circuit on, e.g. one bound to a
+                worker pool shared by several services, or the name of the backend to create
+                instead of the configured one ('inline' or 'process'). Created from the config when omitted.
+            job_manager (Optional[JobManager]): Job manager shared by several services.
+                Created from the config when omitted.
+            metrics_registry (Optional[MetricsRegistry]): Registry shared by several services,
+                exposed at `/metrics`. Created when omitted.
+            defer_start (bool): Leave the warm-up and the model watcher to the caller (`start`),
+                e.g. to run them in each pre-forked worker rather than in the master.
+            worker_processes (int): Processes serving the service (pre-forked workers). They share the
+                admission limits, each one admitting its share of the predictions.
+        """
         self.service_name = service_name
-        self.fhe_directory = self.load_service_config(service_name)
+        self.service_config = self.load_service_config(service_name)
+        self.fhe_directory = self.service_config['output_directory']
+        self.max_batch_size = self.service_config.get('max_batch_size', 32)
+        self.execution_mode = self.service_config.get('execution_mode', 'execute')
+        if self.execution_mode == 'simulate':
+            raise ValueError(
+                f"execution_mode 'simulate' is not supported for service {service_name}: the deployment artifacts do not "
+                "carry the compiled circuit that FHE simulation needs. Use 'echo' (ciphertexts echoed back, the model is "
+                "not run) or 'clear' (the quantized model evaluated on cleartext inputs) for load testing."
+            )
+        if self.execution_mode not in self.EXECUTION_MODES:
+            raise ValueError(f"Unknown execution_mode '{self.execution_mode}' for service {service_name}")
         self.server = None
-        self.key_manager = KeyManager(service_name)
+        self.execution_backend = None
+        self.model_version = None
+        self.model_watcher = None
+        self._reload_lock = threading.Lock()
+        self.key_manager = self.create_key_manager()
+        self.evaluation_key_store = self.create_evaluation_key_store()
+        self.evaluation_key_uploads = self.create_evaluation_key_upload_store()
+        self.job_manager = job_manager or JobManager(
+            max_workers=self.service_config.get('job_workers', 2),
+            max_pending=self.service_config.get('max_pending_jobs', 64),
+            result_ttl_seconds=self.service_config.get('job_result_ttl_seconds', 600)
+        )
+        self.max_job_wait_seconds = self.service_config.get('max_job_wait_seconds', 30)
+        self.metrics = ServiceMetrics(metrics_registry or MetricsRegistry(), service_name)
+        self.idempotency_cache = self.create_idempotency_cache()
+        max_in_flight = self.service_config.get('max_concurrent_predictions') or self.service_config.get('execution_workers') or os.cpu_count() or 1
+        self.admission = AdmissionController(
+            max_in_flight=max(1, max_in_flight // worker_processes),
+            max_queued=-(-self.service_config.get('max_queued_predictions', 16) // worker_processes),
+            queue_timeout_seconds=self.service_config.get('admission_timeout_seconds', 30),
+            reject_status=self.service_config.get('admission_reject_status', 503)
+        )
+        self.metrics.gauge_function("fhe_predictions_running", "Predictions holding an admission slot.", lambda: self.admission.in_flight)
+        self.metrics.gauge_function("fhe_predictions_queued", "Predictions waiting for an admission slot.", lambda: self.admission.queued)
+        self.slow_request_profiler = self.create_slow_request_profiler()
+        self.usage_meter = self.create_usage_meter()
+        self.compression_encodings = [
+            e for e in self.service_config.get('compression_encodings', available_encodings()) if e in available_encodings()
+        ]
+        self.compression_levels = {**DEFAULT_LEVELS, **self.service_config.get('compression_levels', {})}
+        self.compression_min_bytes = self.service_config.get('compression_min_bytes', 1024)
+        self.metadata_max_age_seconds = self.service_config.get('metadata_max_age_seconds', 300)
+        self._metadata_responses = {}
+        self._metadata_lock = threading.Lock()
+        self.warmed_up = False
+        self.warm_up_error = None
         self.app = self.create_app()
         self.configure_logging()
 
         try:
-            self.server = self.create_server()
+            self.model_version = model_version(self.fhe_directory)
+            if self.execution_mode != 'execute':
+                self.execution_backend = self.create_load_test_backend()
+            elif execution_backend is None or isinstance(execution_backend, str):
+                self.server = self.create_server()
+                self.execution_backend = self.create_execution_backend(execution_backend)
+            else:
+                self.server = self.create_server()
+                self.execution_backend = execution_backend
         except Exception as e:
             self.app.logger.error(f"Failed to initialize FHEModelServer for {self.service_name}: {e}", exc_info=True)
 
+        if not self.service_config.get('warm_up', True) or self.execution_mode != 'execute':
+            self.warmed_up = True
+        if not defer_start:
+            self.start()
+
         self.add_routes()
 
     def configure_logging(self):
@@ -45,16 +181,265 @@ class AIServiceEndpoint(ABC):
         self.app.logger.info(f"FHEModelServer for {self.service_name} loaded successfully.")
         return server
 
+    def create_execution_backend(self, backend=None):
+        """Create the backend that runs the FHE circuit, as configured by 'execution_backend'.
+        'inline' (default) runs it in the request thread; 'process' runs it on a pool of
+        'execution_workers' processes (default: one per core), each preloaded with the model.
+        Args:
+            backend (Optional[str]): Backend name overriding the configured one.
+        """
+        backend = backend or self.service_config.get('execution_backend', 'inline')
+        if backend == 'inline':
+            return InlineExecutionBackend(self.server)
+        if backend == 'process':
+            workers = self.service_config.get('execution_workers') or os.cpu_count() or 1
+            pool = FHEWorkerPool(
+                fhe_directories={self.service_name: self.fhe_directory},
+                workers=workers,
+                evaluation_keys_cache_bytes=self.evaluation_key_store.max_cache_bytes
+            )
+            pool.start()
+            self.app.logger.info(f"Started {workers} FHE worker processes for {self.service_name}.")
+            return ProcessPoolExecutionBackend(pool, self.service_name, owns_pool=True)
+        raise ValueError(f"Unknown execution_backend '{backend}' for service {self.service_name}")
+
+    def start(self, watch_model=True):
+        """Warm the model up and start watching its artifacts for a retrained version.
+        Args:
+            watch_model (bool): Start the model watcher. Pre-forked workers pass False: the master
+                watches the model and replaces them when it changes.
+        """
+        self.run_warm_up()
+        if watch_model:
+            self.start_model_watcher()
+
+    def create_load_test_backend(self):
+        """Create the stand-in backend of a non-production execution mode, with the artificial
+        delay of 'simulated_latency_seconds' per row. Logged loudly: predictions are not real."""
+        delay = self.service_config.get('simulated_latency_seconds', 0.0)
+        self.app.logger.warning(
+            f"*** {self.service_name} runs in NON-PRODUCTION execution_mode '{self.execution_mode}' "
+            f"(artificial delay {delay} s per row): predictions are NOT evaluated under FHE. For load testing only. ***"
+        )
+        if self.execution_mode == 'echo':
+            return EchoExecutionBackend(delay)
+        return ClearExecutionBackend(self.fhe_directory, delay)
+
+    def run_warm_up(self):
+        """Warm the service up (see `warm_up`), recording a failure instead of raising it."""
+        if not self.execution_backend or self.warmed_up:
+            return
+        try:
+            self.warm_up()
+            self.warmed_up = True
+        except Exception as e:
+            self.warm_up_error = str(e)
+            self.app.logger.error(f"Warm-up failed for {self.service_name}: {e}", exc_info=True)
+
+    def warm_up(self, backend=None):
+        """Run a synthetic encryption and evaluation round trip on the loaded model, so the
+        one-time costs (lazy imports, runtime and circuit initialization) are paid before the
+        service reports ready rather than on a patient's first request.
+        Throwaway client keys are generated in a temporary directory and an all-zero sample is
+        evaluated concurrently once per worker process of the execution backend.
+        Args:
+            backend (Optional): Backend to warm up, e.g. a reloaded model not swapped in yet.
+                Defaults to the active one.
+        """
+        import numpy
+        backend = backend or self.execution_backend
+        from concrete.ml.deployment import FHEModelClient
+        started_at = time.perf_counter()
+        with tempfile.TemporaryDirectory() as key_directory:
+            client = FHEModelClient(path_dir=self.fhe_directory, key_dir=key_directory)
+            client.generate_private_and_evaluation_keys()
+            serialized_evaluation_keys = client.get_serialized_evaluation_keys()
+            n_features = getattr(client.model, 'n_features_in_', None) or len(client.model.input_quantizers)
+            encrypted_data = client.quantize_encrypt_serialize(numpy.zeros((1, n_features)))
+            rounds = getattr(getattr(backend, 'pool', None), 'workers', 1)
+            with ThreadPoolExecutor(max_workers=rounds) as executor:
+                encrypted_results = list(executor.map(
+                    lambda _: backend.run(encrypted_data, serialized_evaluation_keys), range(rounds)
+                ))
+            client.deserialize_decrypt_dequantize(encrypted_results[0])
+        self.app.logger.info(f"Warm-up round trip for {self.service_name} done in {time.perf_counter() - started_at:.2f} s.")
+
+    def start_model_watcher(self, on_change=None):
+        """Poll server.zip every 'model_watch_interval_seconds' (default 10, 0 disables) and
+        reload the model when a retrained one is saved (see `reload_model`).
+        Args:
+            on_change (Optional[Callable[[], None]]): Called instead of `reload_model` when server.zip changed.
+        """
+        interval = self.service_config.get('model_watch_interval_seconds', 10)
+        if interval and self.model_watcher is None:
+            self.model_watcher = ModelWatcher(self.fhe_directory, interval, on_change or self.reload_model)
+            self.model_watcher.start()
+
+    def reload_model(self, warm_up=True):
+        """Load the model saved in `output_directory` and swap it in if it is a new version.
+        The new model is loaded and warmed up next to the active one, then replaces it at once:
+        requests already running finish on the model they started with. If loading fails, the
+        active model is kept.
+        Args:
+            warm_up (bool): Warm the new model up before swapping it in. The pre-fork master
+                passes False and leaves the warm-up to the workers it forks.
+        Returns:
+            bool: Whether a new model version was swapped in.
+        """
+        if not self._reload_lock.acquire(blocking=False):
+            self.app.logger.info(f"A model reload is already running for {self.service_name}.")
+            return False
+        try:
+            version = model_version(self.fhe_directory)
+            if version is None or version == self.model_version:
+                return False
+            self.app.logger.info(f"Loading model version {version} for {self.service_name}...")
+            if self.execution_mode != 'execute':
+                server, backend = None, self.create_load_test_backend()
+            else:
+                server = self.create_server()
+                backend = self._create_reloaded_backend(server, version)
+            warm_up_enabled = self.service_config.get('warm_up', True) and self.execution_mode == 'execute'
+            if warm_up and warm_up_enabled:
+                self.warm_up(backend)
+            previous_version = self.model_version
+            self.server, self.model_version = server, version
+            self.execution_backend = backend
+            self.warmed_up, self.warm_up_error = warm_up or not warm_up_enabled, None
+            self.prepare_metadata(refresh=True)
+            self.app.logger.info(f"Model of {self.service_name} reloaded: version {previous_version} -> {version}.")
+            return True
+        except Exception as e:
+            self.app.logger.error(f"Reloading the model of {self.service_name} failed, keeping version {self.model_version}: {e}", exc_info=True)
+            return False
+        finally:
+            self._reload_lock.release()
+
+    def _create_reloaded_backend(self, server, version):
+        """Create a backend like the active one for a reloaded model.
+        Process pools keep their workers, which load the new version under its own model id."""
+        backend = self.execution_backend
+        if isinstance(backend, ProcessPoolExecutionBackend):
+            return ProcessPoolExecutionBackend(
+                backend.pool, f"{self.service_name}@{version}", owns_pool=backend.owns_pool, fhe_directory=self.fhe_directory
+            )
+        if isinstance(backend, InlineExecutionBackend):
+            return InlineExecutionBackend(server)
+        self.server = server
+        return self.create_execution_backend()
+
+    def is_ready(self):
+        """Check whether the service can take predictions: model loaded and warmed up.
+        Returns:
+            Tuple[bool, Optional[str]]: Readiness, and the reason when not ready.
+        """
+        if not self.execution_backend:
+            return False, "FHE Model Server not loaded or failed to initialize."
+        if not self.warmed_up:
+            return False, f"Warm-up failed: {self.warm_up_error}" if self.warm_up_error else "Warming up."
+        return True, None
+
+    def create_key_manager(self):
+        """Create the single-use key manager, as configured by 'key_store': 'json' (default) keeps the keys
+        in JSON files under a file lock, 'sqlite' in a SQLite database the worker processes update concurrently."""
+        key_store = self.service_config.get('key_store', 'json')
+        if key_store == 'json':
+            return KeyManager(self.service_name)
+        if key_store == 'sqlite':
+            return SQLiteKeyManager(self.service_name)
+        raise ValueError(f"Unknown key_store '{key_store}' for service {self.service_name}")
+
+    def create_evaluation_key_store(self):
+        """Create the content-addressed store for registered evaluation keys."""
+        default_directory = Path(__file__).resolve().parent.parent.parent / "keys" / self.service_name / "evaluation_keys"
+        return EvaluationKeyStore(
+            directory=self.service_config.get('evaluation_keys_directory', default_directory),
+            max_cache_bytes=self.service_config.get('evaluation_keys_cache_bytes', 256 * 1024 * 1024),
+            loader=lambda serialized_keys: self.execution_backend.prepare_evaluation_keys(serialized_keys)
+        )
+
+    def create_evaluation_key_upload_store(self):
+        """Create the store of resumable evaluation key uploads in progress."""
+        default_directory = Path(__file__).resolve().parent.parent.parent / "keys" / self.service_name / "evaluation_key_uploads"
+        return ResumableUploadStore(
+            directory=self.service_config.get('evaluation_key_upload_directory', default_directory),
+            max_upload_bytes=self.service_config.get('max_upload_part_bytes', 256 * 1024 * 1024),
+            max_chunk_bytes=self.service_config.get('evaluation_key_upload_chunk_bytes', 8 * 1024 * 1024),
+            expiry_seconds=self.service_config.get('evaluation_key_upload_expiry_seconds', 24 * 3600)
+        )
+
+    def create_idempotency_cache(self):
+        """Create the cache of recent results replayed to retried requests. It is spooled to
+        'idempotency_spool_directory', by default next to the jobs when the job manager spools them
+        (pre-forked workers), so that a retry served by another worker finds the result."""
+        spool_directory = self.service_config.get('idempotency_spool_directory')
+        if spool_directory is None and self.job_manager.spool_directory:
+            spool_directory = self.job_manager.spool_directory / "idempotency" / self.service_name
+        return IdempotencyCache(
+            max_bytes=self.service_config.get('idempotency_cache_bytes', 64 * 1024 * 1024),
+            ttl_seconds=self.service_config.get('idempotency_ttl_seconds', 600),
+            spool_directory=spool_directory,
+            spool_max_bytes=self.service_config.get('idempotency_spool_bytes')
+        )
+
+    def create_usage_meter(self):
+        """Create the usage meter of the service, storing to 'usage_directory' ('usage_metering': false disables it)."""
+        if not self.service_config.get('usage_metering', True):
+            return None
+        default_directory = Path(__file__).resolve().parent.parent.parent / "usage" / self.service_name
+        return UsageMeter(
+            self.service_config.get('usage_directory', default_directory),
+            flush_interval_seconds=self.service_config.get('usage_flush_interval_seconds', 10)
+        )
+
+    def create_slow_request_profiler(self):
+        """Create the profiler recording predictions slower than 'slow_request_threshold_seconds'
+        (default 10, 0 disables it) to 'slow_request_log_directory'."""
+        threshold = self.service_config.get('slow_request_threshold_seconds', 10)
+        if not threshold:
+            return None
+        default_directory = SLOW_REQUEST_LOG_DIRECTORY / self.service_name
+        return SlowRequestProfiler(
+            threshold,
+            SlowRequestLog(
+                self.service_config.get('slow_request_log_directory', default_directory),
+                max_entries=self.service_config.get('slow_request_log_max_entries', 100)
+            ),
+            StackSampler(interval_seconds=self.service_config.get('slow_request_sample_interval_seconds', 0.01))
+        )
+
     def create_app(self):
         """Create a Flask app for this service."""
         app = Flask(self.service_name)
+        # Spools large file parts to disk, and uses the form data parsed on the event loop
+        # when served by `create_asgi_app`.
+        app.request_class = PreparsedRequest
+        app.config["MAX_CONTENT_LENGTH"] = self.service_config.get('max_request_bytes', 512 * 1024 * 1024)
+        app.config["UPLOAD_MAX_PART_BYTES"] = self.service_config.get('max_upload_part_bytes', 256 * 1024 * 1024)
+        app.config["UPLOAD_SPOOL_THRESHOLD"] = self.service_config.get('upload_spool_threshold_bytes', DEFAULT_SPOOL_THRESHOLD)
         return app
 
+    def create_asgi_app(self, executor):
+        """Wrap the Flask app for an asyncio server: uploads are received and parsed on the event loop,
+        metadata routes and job long-polls answered there, and the other views run on `executor`.
+        Args:
+            executor (concurrent.futures.Executor): Runs the blocking views (key checks, FHE evaluation).
+        Returns:
+            AsgiServiceApp: The ASGI application.
+        """
+        return AsgiServiceApp(
+            self.app,
+            executor,
+            job_manager=self.job_manager,
+            max_job_wait_seconds=self.max_job_wait_seconds
+        )
+
     @abstractmethod
     def get_omop_requirements(self):
         """
         Subclasses must implement this to define service-specific OMOP requirements,
         including 'required_measurements_by_source_value'.
+        It is called once; the base class serves the serialized result (see `prepare_metadata`).
         :return: A dictionary with required measurements and other metadata.
         e.g.,
         {
@@ -69,6 +454,7 @@ class AIServiceEndpoint(ABC):
     def get_additional_service_info(self):
         """
         Subclasses must implement this to provide any other service-specific metadata.
+        It is called once; the base class serves the serialized result (see `prepare_metadata`).
         :return: A dictionary with additional service information.
         e.g.,
         {
@@ -84,54 +470,831 @@ class AIServiceEndpoint(ABC):
         """
         pass
 
+    def prepare_metadata(self, refresh=False):
+        """Serialize the metadata responses once, with their strong ETags.
+        Subclasses call it at the end of their `__init__`, once their metadata is built;
+        otherwise it runs on the first metadata request. The active model version is added
+        to the additional service information.
+        Args:
+            refresh (bool): Serialize them again, e.g. after a model reload.
+        """
+        with self._metadata_lock:
+            responses = {} if refresh else dict(self._metadata_responses)
+            for name, builder in (("omop_requirements", self.get_omop_requirements),
+                                  ("additional_service_info", self.get_additional_service_info)):
+                if name in responses:
+                    continue
+                metadata = builder()
+                if isinstance(metadata, Response):
+                    body = metadata.get_data()
+                else:
+                    if name == "additional_service_info":
+                        metadata = {**metadata, "model_version": self.model_version, "execution_mode": self.execution_mode}
+                    body = json.dumps(metadata, sort_keys=True, separators=(',', ':')).encode('utf-8')
+                responses[name] = (body, hashlib.sha256(body).hexdigest())
+            self._metadata_responses = responses
+
+    def _serve_metadata(self, name):
+        """Serve a precomputed metadata response, answering 304 when the client's ETag matches."""
+        if name not in self._metadata_responses:
+            self.prepare_metadata()
+        body, etag = self._metadata_responses[name]
+        response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = self.metadata_max_age_seconds
+        return response.make_conditional(request)
+
+    def serve_omop_requirements(self):
+        """Serves the OMOP requirements of the service (`get_omop_requirements`)."""
+        return self._serve_metadata("omop_requirements")
+
+    def serve_additional_service_info(self):
+        """Serves the additional service information (`get_additional_service_info`)."""
+        return self._serve_metadata("additional_service_info")
+
     def predict(self):
         """Handles predictions. This logic is common to all FHE services.
-        It expects the request to contain the encrypted data, evaluation keys, and a single-use key.
+        It expects the request to contain the encrypted data, a single-use key, and either the
+        evaluation keys or the 'evaluation_keys_id' returned by `/register_evaluation_keys`,
+        as multipart/form-data or in the binary protocol (`PREDICT_CONTENT_TYPE`).
         Returns:
             Response: JSON response with prediction results or error message.
         """
-        if not self.server:
+        # Requests finish on the model they started with, even if a reload swaps it meanwhile.
+        backend = self.execution_backend
+        if not backend:
             self.app.logger.error("Prediction attempt failed: FHE Model Server not available.")
             return jsonify({"error": "FHE Model Server not loaded or failed to initialize."}), 503
         
+        single_use_key = None
         try:
-            encrypted_data_file = request.files.get('encrypted_data')
-            evaluation_keys_file = request.files.get('evaluation_keys')
-            single_use_key_file = request.files.get('single_use_key')
-            
-            if not encrypted_data_file or not evaluation_keys_file or not single_use_key_file:
-                self.app.logger.warning("Prediction failed: Missing files in the request.")
-                return jsonify({"error": "Missing files in the request (expected 'encrypted_data', 'evaluation_keys', and 'single_use_key')"}) , 400
+            # The slot is taken before the body is read, including to look up a stored result.
+            with self._admission_slot():
+                request_key, owner, fingerprint, stored_result = self._idempotent_request('predict')
+                if stored_result is not None:
+                    self.app.logger.info(f"Replaying the stored result of a retried prediction for {self.service_name}.")
+                    return self._binary_response(stored_result, 'application/octet-stream', {'Idempotent-Replayed': 'true'})
 
-            encrypted_data = encrypted_data_file.read()
-            serialized_evaluation_keys = evaluation_keys_file.read()
-            single_use_key = single_use_key_file.read().decode('utf-8').strip()
+                encrypted_data, single_use_key, evaluation_keys = self._read_prediction_request(backend)
 
-            if not self.key_manager.validate_key(single_use_key):
-                self.app.logger.warning("Prediction failed: Invalid single-use key.")
-                return jsonify({"error": "Invalid single-use key."}), 403
-            
-            self.app.logger.info(f"Running FHE prediction for {self.service_name}...")
-            encrypted_result = self.server.run(encrypted_data, serialized_evaluation_keys)
-            self.app.logger.info(f"FHE prediction for {self.service_name} successful.")
+                self.app.logger.info(f"Running FHE prediction for {self.service_name}...")
+                usage = {}
+                with self.admission.measure(), self._stage('run'):
+                    encrypted_result = backend.run(encrypted_data, evaluation_keys, usage=usage)
+                self.app.logger.info(f"FHE prediction for {self.service_name} successful.")
+                g.usage_charge = ([single_use_key], usage.get('cpu_seconds', 0.0))
 
-            self.key_manager.mark_key_as_used(single_use_key)
+            with self._stage('mark_used'):
+                self.key_manager.mark_key_as_used(single_use_key)
+            self.idempotency_cache.put(request_key, owner, encrypted_result, fingerprint)
 
-            return encrypted_result, 200, {'Content-Type': 'application/octet-stream'}
+            return self._binary_response(encrypted_result, 'application/octet-stream')
+        except PredictionRequestError as e:
+            self.app.logger.warning(f"Prediction failed: {e}")
+            return e.to_response()
         except Exception as e:
+            if single_use_key:
+                self.key_manager.release_keys([single_use_key])
             self.app.logger.error(f"Prediction error for {self.service_name}: {e}", exc_info=True)
             return jsonify({"error": f"An internal server error occurred during prediction: {str(e)}"}), 500
 
+    @contextmanager
+    def _admission_slot(self):
+        """Hold one of the service's prediction slots, waiting in the bounded queue if needed.
+        Raises:
+            PredictionRequestError: If the queue is full or the wait timed out (429/503 with 'Retry-After').
+        """
+        try:
+            with self._stage('queue'):
+                self.admission.acquire()
+        except AdmissionRejectedError as e:
+            self.app.logger.warning(f"Prediction rejected for {self.service_name}: {e}")
+            raise PredictionRequestError(str(e), e.status_code, headers={'Retry-After': str(e.retry_after)}, retry_after=e.retry_after)
+        try:
+            yield
+        finally:
+            self.admission.release()
+
+    def _read_prediction_request(self, backend):
+        """Read and check the parts of a single prediction request.
+        On success the single-use key is reserved: the caller must mark it as used or release it.
+        Args:
+            backend: The execution backend the prediction will run on.
+        Returns:
+            Tuple[bytes | memoryview, str, bytes | memoryview | fhe.EvaluationKeys]: Encrypted data, single-use key
+                and evaluation keys. Large parts are memory maps of the spooled upload.
+        Raises:
+            PredictionRequestError: If the request is incomplete, the key is invalid, the keys id is unknown
+                or the evaluation keys cannot be read. The key is released on any error after its reservation.
+        """
+        files = self._uploaded_files()
+        encrypted_data_file = files.get('encrypted_data')
+        single_use_key_file = files.get('single_use_key')
+
+        if not encrypted_data_file or not single_use_key_file or not self._has_evaluation_keys():
+            raise PredictionRequestError("Missing files in the request (expected 'encrypted_data', 'evaluation_keys' or 'evaluation_keys_id', and 'single_use_key')", 400)
+
+        encrypted_data = self._read_upload(encrypted_data_file)
+        single_use_key = self._read_single_use_key(single_use_key_file)
+
+        with self._stage('validate_key'):
+            reserved = all(self.key_manager.reserve_keys([single_use_key]))
+        if not reserved:
+            raise PredictionRequestError("Invalid single-use key.", 403)
+
+        try:
+            evaluation_keys = self._resolve_evaluation_keys(backend)
+            if evaluation_keys is None:
+                raise PredictionRequestError("Unknown evaluation keys id, register the evaluation keys again.", 404)
+        except BaseException:
+            self.key_manager.release_keys([single_use_key])
+            raise
+        return encrypted_data, single_use_key, evaluation_keys
+
+    def _read_single_use_key(self, file_storage):
+        """Read a 'single_use_key' part (from its start, so it can be read more than once)."""
+        file_storage.stream.seek(0)
+        return file_storage.read().decode('utf-8').strip()
+
+    def _idempotent_request(self, namespace):
+        """Identify the current request for the idempotency cache and look up its stored result.
+        This happens before the single-use keys are checked: the keys of a request whose response
+        was lost are already used, and its retry must get the stored result back.
+        Args:
+            namespace (str): Kind of result, so that single and batch results are not mixed up.
+        Returns:
+            Tuple[str, str, str, Optional[bytes]]: The request key (the 'Idempotency-Key' header, or the
+                single-use keys), the single-use keys and the content fingerprint the result is bound to,
+                and the stored result if any.
+        Raises:
+            PredictionRequestError: If an 'Idempotency-Key' is reused with the same keys for another content (409).
+        """
+        single_use_keys = [self._read_single_use_key(f) for f in self._uploaded_files().getlist('single_use_key')]
+        owner = '\n'.join(single_use_keys)
+        request_key = f"{namespace}:{request.headers.get('Idempotency-Key', '').strip() or owner}"
+        if not owner:
+            return request_key, owner, '', None
+        fingerprint = self._request_fingerprint()
+        return request_key, owner, fingerprint, self._idempotent_lookup(self.idempotency_cache.get, request_key, owner, fingerprint)
+
+    def _idempotent_lookup(self, lookup, request_key, owner, fingerprint):
+        """Run an idempotency cache lookup. A stored request with the same keys but another content
+        is a conflict (409) under an explicit 'Idempotency-Key'; without one, the keys were consumed
+        by another request and the lookup misses, so the key check rejects them."""
+        try:
+            return lookup(request_key, owner, fingerprint)
+        except IdempotencyConflictError as e:
+            if request.headers.get('Idempotency-Key', '').strip():
+                raise PredictionRequestError(str(e), 409)
+            return None
+
+    def _request_fingerprint(self):
+        """Digest of the content of the current request (ciphertexts, and evaluation keys or their id),
+        which its stored result is bound to. The parts are hashed as received, without decoding them."""
+        form, files = self._request_parts()
+        digest = hashlib.sha256()
+        for name in ('encrypted_data', 'evaluation_keys'):
+            for file_storage in files.getlist(name):
+                content = read_part(file_storage)
+                file_storage.stream.seek(0)
+                digest.update(f"{name} {len(content)}\n".encode('utf-8'))
+                digest.update(content)
+        digest.update(f"evaluation_keys_id {form.get('evaluation_keys_id', '').strip()}".encode('utf-8'))
+        return digest.hexdigest()
+
+    def _request_parts(self):
+        """Parse the request body once and return its form fields and files.
+        Multipart uploads are parsed by Flask, spooling large parts to disk. Bodies in the binary
+        protocol (`PREDICT_CONTENT_TYPE`) are split into views of the received body.
+        Returns:
+            Tuple[MultiDict, MultiDict]: The form fields and the files.
+        Raises:
+            PredictionRequestError: If the body is malformed (400), its encoding unsupported (415),
+                or it or one of its parts is over the configured limits (413).
+        """
+        parts = g.get('request_parts')
+        if parts is not None:
+            return parts
+        try:
+            with self._stage('parse'):
+                if request.mimetype == PREDICT_CONTENT_TYPE:
+                    parts = self._parse_binary_request()
+                else:
+                    parts = request.form, request.files
+        except RequestEntityTooLarge as e:
+            raise PredictionRequestError(e.description, 413)
+        g.request_parts = parts
+        return parts
+
+    def _parse_binary_request(self):
+        """Receive a `PREDICT_CONTENT_TYPE` body (decoding its 'Content-Encoding') and expose its
+        fields as the parts of a multipart upload. The ciphertext and the evaluation keys are
+        memoryview slices of the received body, spooled to disk past the spool threshold.
+        Returns:
+            Tuple[MultiDict, MultiDict]: The form fields and the files.
+        """
+        encoding = request.headers.get('Content-Encoding', 'identity').strip().lower()
+        spool_threshold = self.app.config["UPLOAD_SPOOL_THRESHOLD"]
+        max_size = self.app.config["MAX_CONTENT_LENGTH"]
+        if encoding == 'identity':
+            body = request.body_part()
+        elif encoding in self.compression_encodings:
+            try:
+                body = decompress_stream(request.stream, encoding, spool_threshold=spool_threshold, max_size=max_size)
+            except ValueError as e:
+                raise PredictionRequestError(f"Invalid request body: {e}", 400)
+        else:
+            raise PredictionRequestError(f"Unsupported content encoding '{encoding}'.", 415, accepted_encodings=self.compression_encodings)
+        with body:
+            view = body.view()
+        try:
+            parsed = parse_predict_request(view)
+        except ValueError as e:
+            raise PredictionRequestError(f"Malformed {PREDICT_CONTENT_TYPE} body: {e}", 400)
+
+        files = MultiDict([
+            ('encrypted_data', FileStorage(BufferPart(parsed.encrypted_data), filename='encrypted_data', name='encrypted_data')),
+            ('single_use_key', FileStorage(io.BytesIO(parsed.single_use_key.encode('utf-8')), filename='single_use_key', name='single_use_key'))
+        ])
+        if parsed.evaluation_keys is not None:
+            files.add('evaluation_keys', FileStorage(BufferPart(parsed.evaluation_keys), filename='evaluation_keys', name='evaluation_keys'))
+        form = MultiDict([('evaluation_keys_id', parsed.evaluation_keys_id)] if parsed.evaluation_keys_id else [])
+        return form, files
+
+    def _uploaded_files(self):
+        """Parse the upload (see `_request_parts`) and return its files."""
+        return self._request_parts()[1]
+
+    def _read_upload(self, file_storage):
+        """Get the content of an uploaded file part, decoding its 'Content-Encoding' part header.
+        Compressed parts are decompressed chunk by chunk into a spooled part, bounded by the
+        configured part size.
+        Args:
+            file_storage (FileStorage): The uploaded file.
+        Returns:
+            memoryview | bytes: The (decompressed) content of the part.
+        Raises:
+            PredictionRequestError: If the encoding is not supported (415), the data is corrupt (400)
+                or the decompressed part is over the configured limits (413).
+        """
+        encoding = file_storage.headers.get('Content-Encoding', 'identity').strip().lower()
+        if encoding == 'identity':
+            content = read_part(file_storage)
+            self._observe_payload('request', file_storage.name, len(content))
+            return content
+        if encoding not in self.compression_encodings:
+            raise PredictionRequestError(f"Unsupported part encoding '{encoding}'.", 415, accepted_encodings=self.compression_encodings)
+        try:
+            part = decompress_stream(
+                file_storage.stream,
+                encoding,
+                spool_threshold=self.app.config["UPLOAD_SPOOL_THRESHOLD"],
+                max_size=self.app.config["UPLOAD_MAX_PART_BYTES"]
+            )
+        except ValueError as e:
+            raise PredictionRequestError(f"Invalid '{file_storage.name}' part: {e}", 400)
+        except RequestEntityTooLarge as e:
+            raise PredictionRequestError(e.description, 413)
+        with part:
+            content = part.view()
+        self._observe_payload('request', file_storage.name, part.size)
+        self.app.logger.info(f"Received '{file_storage.name}' part for {self.service_name}: {part.size} bytes ({encoding}-encoded on the wire).")
+        return content
+
+    def _binary_response(self, payload, content_type, headers=None):
+        """Build a binary response, compressed with the best encoding accepted by the client.
+        Payloads under `compression_min_bytes`, or that do not shrink, are sent as is.
+        Args:
+            payload (bytes): The response body.
+            content_type (str): Its content type.
+            headers (Optional[dict]): Extra response headers.
+        Returns:
+            Tuple[bytes, int, dict]: The Flask response.
+        """
+        headers = {**(headers or {}), 'Content-Type': content_type, 'Vary': 'Accept-Encoding'}
+        encoding = request.accept_encodings.best_match(self.compression_encodings) if self.compression_encodings else None
+        if encoding and len(payload) >= self.compression_min_bytes:
+            compressed = compress(payload, encoding, self.compression_levels.get(encoding))
+            self.app.logger.info(f"Encoded response for {self.service_name}: {len(payload)} -> {len(compressed)} bytes ({encoding}).")
+            if len(compressed) < len(payload):
+                headers['Content-Encoding'] = encoding
+                self._observe_payload('response', content_type, len(compressed))
+                return compressed, 200, headers
+        self._observe_payload('response', content_type, len(payload))
+        return payload, 200, headers
+
+    @contextmanager
+    def _stage(self, stage):
+        """Time a stage of a prediction for the metrics and, within a profiled request, for its profile."""
+        started_at = time.perf_counter()
+        try:
+            with self.metrics.stage(stage):
+                yield
+        finally:
+            profile = g.get('request_profile') if has_request_context() else None
+            if profile is not None:
+                profile.add_stage(stage, time.perf_counter() - started_at)
+
+    def _observe_payload(self, direction, part, size):
+        """Record the size of an uploaded part or a response body."""
+        self.metrics.observe_payload(direction, part, size)
+        profile = g.get('request_profile') if has_request_context() else None
+        if profile is not None:
+            profile.add_payload(direction, part, size)
+
+    def _start_request_profile(self):
+        """Start sampling a profiled request, in case it turns out slow."""
+        if self.slow_request_profiler and request.endpoint in self.PROFILED_ENDPOINTS:
+            g.request_profile = self.slow_request_profiler.start()
+
+    def _finish_request_profile(self, response):
+        """Record the profile of a profiled request if it was slower than the threshold."""
+        profile = g.pop('request_profile', None)
+        if profile is not None:
+            record_id = self.slow_request_profiler.finish(
+                profile, service=self.service_name, endpoint=request.endpoint,
+                status=response.status_code, model_version=self.model_version
+            )
+            if record_id:
+                self.app.logger.warning(
+                    f"Slow {request.endpoint} request for {self.service_name} "
+                    f"({time.perf_counter() - profile.started_at:.2f} s), profile recorded as {record_id}."
+                )
+        return response
+
+    def _discard_request_profile(self, exception=None):
+        """Stop sampling a request that ended without a response (unhandled error)."""
+        profile = g.pop('request_profile', None)
+        if profile is not None:
+            self.slow_request_profiler.sampler.stop(profile)
+
+    def _start_request_metrics(self):
+        """Count a metered request in flight and start its timer."""
+        if request.endpoint in self.METERED_ENDPOINTS:
+            g.metrics_started_at = time.perf_counter()
+            self.metrics.request_started(request.endpoint)
+
+    def _finish_request_metrics(self, response):
+        """Record the duration and status of a metered request."""
+        started_at = g.pop('metrics_started_at', None)
+        if started_at is not None:
+            self.metrics.request_finished(request.endpoint, time.perf_counter() - started_at, response.status_code)
+        return response
+
+    def _start_usage_record(self):
+        """Start the wall-time clock of a request whose usage is metered."""
+        if self.usage_meter and request.endpoint in self.USAGE_METERED_ENDPOINTS:
+            g.usage_started_at = time.perf_counter()
+
+    def _finish_usage_record(self, response):
+        """Charge a request that ran the FHE circuit (see `_record_usage`) with its wall time and sizes on the wire."""
+        charge = g.pop('usage_charge', None)
+        started_at = g.pop('usage_started_at', None)
+        if charge is not None and started_at is not None:
+            single_use_keys, cpu_seconds = charge
+            self._record_usage(single_use_keys, cpu_seconds, time.perf_counter() - started_at,
+                               request.content_length or 0, response.calculate_content_length() or 0)
+        return response
+
+    def _record_usage(self, single_use_keys, cpu_seconds, wall_seconds, bytes_in, bytes_out):
+        """Charge a prediction request to the key accounts of its single-use keys, in proportion
+        to their number of predictions. Keys without a known account are charged to 'unknown'."""
+        if not self.usage_meter or not single_use_keys:
+            return
+        accounts = Counter(self.key_manager.key_account(key) or 'unknown' for key in single_use_keys)
+        for account, predictions in accounts.items():
+            share = predictions / len(single_use_keys)
+            self.usage_meter.record(account, predictions, cpu_seconds * share, wall_seconds * share,
+                                    round(bytes_in * share), round(bytes_out * share))
+
+    def get_usage(self):
+        """Reports the usage charged to each key account, heaviest CPU consumers first. The keys of a
+        service share the account of its xPub, so this is the usage of the service (one entry per
+        xPub it used), not of individual clients.
+        Query parameters: 'since' and 'until' (Unix timestamps or ISO 8601 dates, UTC when no
+        offset is given), 'account' and 'by' ('account', the default, or 'hour').
+        Returns:
+            Response: JSON response with the period and one entry per account (and hour), or error message.
+        """
+        if not self.usage_meter:
+            return jsonify({"error": "Usage metering is disabled for this service."}), 404
+        try:
+            since, until = (self._parse_timestamp(request.args.get(name)) for name in ('since', 'until'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        by = request.args.get('by', 'account')
+        if by not in ('account', 'hour'):
+            return jsonify({"error": "'by' must be 'account' or 'hour'."}), 400
+        entries = self.usage_meter.query(since=since, until=until, account=request.args.get('account'), by_hour=by == 'hour')
+        return jsonify({"service_name": self.service_name, "since": since, "until": until, "usage": entries}), 200
+
+    @staticmethod
+    def _parse_timestamp(value):
+        """Parse a Unix timestamp or an ISO 8601 date (UTC unless it has an offset); None stays None."""
+        if value is None or value == '':
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        try:
+            parsed = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f"Invalid timestamp '{value}' (expected a Unix timestamp or an ISO 8601 date).")
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+        return parsed.timestamp()
+
+    def get_metrics(self):
+        """Exposes the metrics of the service (and of the services sharing its registry) in the Prometheus text format."""
+        return Response(self.metrics.registry.render(), content_type=METRICS_CONTENT_TYPE)
+
+    def _advertise_content_types(self, response):
+        """Advertise the request body formats accepted by `/predict` and `/jobs` ('Accept-Post' header)."""
+        response.headers.setdefault('Accept-Post', f"{PREDICT_CONTENT_TYPE}, multipart/form-data")
+        return response
+
+    def _flag_execution_mode(self, response):
+        """Mark every response of a non-production execution mode with an 'X-Execution-Mode' header."""
+        if self.execution_mode != 'execute':
+            response.headers['X-Execution-Mode'] = self.execution_mode
+        return response
+
+    def _advertise_encodings(self, response):
+        """Advertise the part encodings accepted in uploads (RFC 7694 'Accept-Encoding' response header)."""
+        response.headers.setdefault('Accept-Encoding', ', '.join(self.compression_encodings) or 'identity')
+        return response
+
+    def _has_evaluation_keys(self):
+        """Check whether the request carries evaluation keys, either uploaded or by registered id."""
+        form, files = self._request_parts()
+        return bool(files.get('evaluation_keys') or form.get('evaluation_keys_id'))
+
+    def _resolve_evaluation_keys(self, backend):
+        """Get the evaluation keys for the current request, in the form expected by `backend`.
+        Keys uploaded with the request are used as is; otherwise the 'evaluation_keys_id'
+        form field is looked up in the evaluation key store.
+        Returns:
+            bytes | memoryview | fhe.EvaluationKeys | None: The evaluation keys, or None if the id is unknown.
+        """
+        form, files = self._request_parts()
+        evaluation_keys_file = files.get('evaluation_keys')
+        if evaluation_keys_file:
+            return self._read_upload(evaluation_keys_file)
+        key_id = form.get('evaluation_keys_id', '').strip()
+        return backend.resolve_registered_keys(self.evaluation_key_store, key_id)
+
+    def register_evaluation_keys(self):
+        """Stores the client's evaluation keys so later predictions can reference them by id.
+        It expects the request to contain an 'evaluation_keys' file.
+        Returns:
+            Response: JSON response with the 'key_id' or error message.
+        """
+        try:
+            evaluation_keys_file = self._uploaded_files().get('evaluation_keys')
+        except PredictionRequestError as e:
+            self.app.logger.warning(f"Evaluation keys registration failed: {e}")
+            return e.to_response()
+        if not evaluation_keys_file:
+            self.app.logger.warning("Evaluation keys registration failed: Missing 'evaluation_keys' file.")
+            return jsonify({"error": "Missing file in the request (expected 'evaluation_keys')"}), 400
+        try:
+            serialized_evaluation_keys = self._read_upload(evaluation_keys_file)
+        except PredictionRequestError as e:
+            self.app.logger.warning(f"Evaluation keys registration failed: {e}")
+            return e.to_response()
+        try:
+            if not len(serialized_evaluation_keys):
+                return jsonify({"error": "Empty 'evaluation_keys' file."}), 400
+            key_id, created = self.evaluation_key_store.register(serialized_evaluation_keys)
+            self.app.logger.info(f"Evaluation keys {key_id[:12]}... registered for {self.service_name} ({len(serialized_evaluation_keys)} bytes).")
+            return jsonify({"key_id": key_id}), 201 if created else 200
+        except Exception as e:
+            self.app.logger.error(f"Evaluation keys registration error for {self.service_name}: {e}", exc_info=True)
+            return jsonify({"error": f"An internal server error occurred while registering evaluation keys: {str(e)}"}), 500
+
+    def create_evaluation_key_upload(self):
+        """Starts a resumable upload of evaluation keys, for clients whose connection may drop.
+        It expects a JSON body with the 'size' of the upload, and optionally the 'sha256' of the
+        uploaded bytes and their 'encoding' (one of the advertised compression encodings).
+        Returns:
+            Response: JSON response with the 'upload_id', the 'upload_url' and the 'max_chunk_bytes', or error message.
+        """
+        body = request.get_json(silent=True) or {}
+        encoding = body.get('encoding')
+        if encoding is not None and encoding not in self.compression_encodings:
+            return jsonify({"error": f"Unsupported content encoding '{encoding}'.", "accepted_encodings": self.compression_encodings}), 415
+        try:
+            upload_id = self.evaluation_key_uploads.create(body.get('size'), sha256=body.get('sha256'), encoding=encoding)
+        except UploadError as e:
+            self.app.logger.warning(f"Evaluation key upload rejected: {e}")
+            return jsonify({"error": str(e)}), e.status
+        upload_url = url_for('evaluation_key_upload', upload_id=upload_id)
+        return jsonify({
+            "upload_id": upload_id,
+            "upload_url": upload_url,
+            "max_chunk_bytes": self.evaluation_key_uploads.max_chunk_bytes
+        }), 201, {'Location': upload_url}
+
+    def evaluation_key_upload(self, upload_id):
+        """Stores a chunk of a resumable upload (PUT), or reports its progress (GET).
+        A chunk is the request body, placed by its 'Content-Range' header ('bytes <first>-<last>/<size>').
+        Chunks may be sent in any order and sent again; a client resumes after a disconnection
+        from the 'next_offset' reported here.
+        Returns:
+            Response: JSON response with the 'size', the merged 'received' ranges ([start, end)),
+                the 'next_offset' and whether the upload is 'complete', or error message.
+        """
+        try:
+            if request.method == 'GET':
+                return jsonify(self.evaluation_key_uploads.status(upload_id)), 200
+            content_range = parse_content_range_header(request.headers.get('Content-Range'))
+            if content_range is None or content_range.units != 'bytes':
+                return jsonify({"error": "Missing or invalid 'Content-Range' header (expected 'bytes <first>-<last>/<size>')."}), 400
+            if (request.content_length or 0) > self.evaluation_key_uploads.max_chunk_bytes:
+                raise UploadError(f"Chunk over the limit of {self.evaluation_key_uploads.max_chunk_bytes} bytes.", 413)
+            with request.body_part() as body:
+                chunk = body.view()
+            if len(chunk) != content_range.stop - content_range.start:
+                return jsonify({"error": f"Body of {len(chunk)} bytes does not match the 'Content-Range' header."}), 400
+            return jsonify(self.evaluation_key_uploads.write_chunk(upload_id, content_range.start, chunk)), 200
+        except UploadError as e:
+            return jsonify({"error": str(e)}), e.status
+
+    def finalize_evaluation_key_upload(self, upload_id):
+        """Finishes a resumable upload: the uploaded keys are registered as by `/register_evaluation_keys`.
+        Returns:
+            Response: JSON response with the 'key_id', or error message (409 with the upload's
+                progress if chunks are missing).
+        """
+        uploads = self.evaluation_key_uploads
+        try:
+            path, info = uploads.finish(upload_id)
+        except UploadError as e:
+            self.app.logger.warning(f"Evaluation key upload {upload_id} not finalized: {e}")
+            details = uploads.status(upload_id) if e.status == 409 else {}
+            return jsonify({"error": str(e), **details}), e.status
+        try:
+            if info.get('encoding'):
+                with open(path, 'rb') as stream, decompress_stream(
+                        stream, info['encoding'],
+                        spool_threshold=self.app.config["UPLOAD_SPOOL_THRESHOLD"],
+                        max_size=self.app.config["UPLOAD_MAX_PART_BYTES"]) as keys:
+                    key_id, created = self.evaluation_key_store.register(keys.view())
+            else:
+                key_id, created = self.evaluation_key_store.register_file(path)
+        except (ValueError, RequestEntityTooLarge) as e:
+            uploads.remove(upload_id)
+            self.app.logger.warning(f"Evaluation key upload {upload_id} not finalized: {e}")
+            return jsonify({"error": f"Invalid evaluation keys: {e}"}), 400
+        except Exception as e:
+            self.app.logger.error(f"Evaluation key upload error for {self.service_name}: {e}", exc_info=True)
+            return jsonify({"error": f"An internal server error occurred while registering evaluation keys: {str(e)}"}), 500
+        uploads.remove(upload_id)
+        self.app.logger.info(f"Evaluation keys {key_id[:12]}... registered for {self.service_name} from upload {upload_id} ({info['size']} bytes).")
+        return jsonify({"key_id": key_id}), 201 if created else 200
+
+    def predict_batch(self):
+        """Handles batched predictions under a single set of evaluation keys.
+        It expects one or more 'encrypted_data' files, the same number of 'single_use_key' files
+        (paired with the ciphertexts by position) and a single 'evaluation_keys' file or
+        'evaluation_keys_id' form field.
+        All single-use keys are validated together before any FHE work is done.
+        Returns:
+            Response: Framed binary response with one encrypted result per row, or JSON error message.
+        """
+        backend = self.execution_backend
+        if not backend:
+            self.app.logger.error("Batch prediction attempt failed: FHE Model Server not available.")
+            return jsonify({"error": "FHE Model Server not loaded or failed to initialize."}), 503
+
+        single_use_keys = []
+        try:
+            # The slot is taken before the body is read, including to look up a stored result.
+            with self._admission_slot():
+                request_key, owner, fingerprint, stored_result = self._idempotent_request('predict_batch')
+                if stored_result is not None:
+                    self.app.logger.info(f"Replaying the stored result of a retried batch prediction for {self.service_name}.")
+                    return self._binary_response(stored_result, FRAMES_CONTENT_TYPE, {'Idempotent-Replayed': 'true'})
+
+                files = self._uploaded_files()
+                encrypted_data_files = files.getlist('encrypted_data')
+                single_use_key_files = files.getlist('single_use_key')
+
+                if not encrypted_data_files or not single_use_key_files or not self._has_evaluation_keys():
+                    raise PredictionRequestError("Missing files in the request (expected 'encrypted_data', 'evaluation_keys' or 'evaluation_keys_id', and 'single_use_key')", 400)
+                if len(encrypted_data_files) != len(single_use_key_files):
+                    raise PredictionRequestError("Each 'encrypted_data' file must be paired with one 'single_use_key' file.", 400)
+                if len(encrypted_data_files) > self.max_batch_size:
+                    raise PredictionRequestError(f"Batch too large (maximum {self.max_batch_size} rows).", 413)
+
+                requested_keys = [self._read_single_use_key(f) for f in single_use_key_files]
+                with self._stage('validate_key'):
+                    validation = self.key_manager.reserve_keys(requested_keys)
+                invalid_rows = [i for i, is_valid in enumerate(validation) if not is_valid]
+                if invalid_rows:
+                    raise PredictionRequestError("Invalid single-use key.", 403, invalid_rows=invalid_rows)
+                single_use_keys = requested_keys
+
+                evaluation_keys = self._resolve_evaluation_keys(backend)
+                if evaluation_keys is None:
+                    raise PredictionRequestError("Unknown evaluation keys id, register the evaluation keys again.", 404)
+
+                encrypted_rows = [self._read_upload(f) for f in encrypted_data_files]
+
+                self.app.logger.info(f"Running batched FHE prediction of {len(encrypted_rows)} rows for {self.service_name}...")
+                usage = {}
+                with self.admission.measure(), self._stage('run'):
+                    encrypted_results = backend.run_batch(encrypted_rows, evaluation_keys, usage=usage)
+                self.app.logger.info(f"Batched FHE prediction for {self.service_name} successful.")
+                g.usage_charge = (single_use_keys, usage.get('cpu_seconds', 0.0))
+
+            with self._stage('mark_used'):
+                self.key_manager.mark_keys_as_used(single_use_keys)
+            framed_results = pack_frames(encrypted_results)
+            self.idempotency_cache.put(request_key, owner, framed_results, fingerprint)
+
+            return self._binary_response(framed_results, FRAMES_CONTENT_TYPE)
+        except PredictionRequestError as e:
+            self.key_manager.release_keys(single_use_keys)
+            self.app.logger.warning(f"Batch prediction failed: {e}")
+            return e.to_response()
+        except Exception as e:
+            self.key_manager.release_keys(single_use_keys)
+            self.app.logger.error(f"Batch prediction error for {self.service_name}: {e}", exc_info=True)
+            return jsonify({"error": f"An internal server error occurred during batch prediction: {str(e)}"}), 500
+
+    def submit_prediction_job(self):
+        """Queues a prediction and returns immediately with a job id.
+        It expects the same request as `/predict`. The FHE evaluation runs on the job worker
+        pool and its result is fetched with `GET /jobs/<job_id>`.
+        Returns:
+            Response: JSON response with the job id (202) or error message.
+        """
+        backend = self.execution_backend
+        if not backend:
+            self.app.logger.error("Job submission failed: FHE Model Server not available.")
+            return jsonify({"error": "FHE Model Server not loaded or failed to initialize."}), 503
+
+        try:
+            request_key, owner, fingerprint, stored_result = self._idempotent_request('predict')
+            if stored_result is not None:
+                self.app.logger.info(f"Replaying the stored result of a retried job submission for {self.service_name}.")
+                return self._binary_response(stored_result, 'application/octet-stream', {'Idempotent-Replayed': 'true'})
+            running_job_id = self._idempotent_lookup(self.idempotency_cache.get_job, request_key, owner, fingerprint)
+            running_job = self.job_manager.get(running_job_id) if running_job_id else None
+            if running_job is not None:
+                return self._job_accepted_response(running_job)
+            encrypted_data, single_use_key, evaluation_keys = self._read_prediction_request(backend)
+        except PredictionRequestError as e:
+            self.app.logger.warning(f"Job submission failed: {e}")
+            return e.to_response()
+        except Exception as e:
+            self.app.logger.error(f"Job submission error for {self.service_name}: {e}", exc_info=True)
+            return jsonify({"error": f"An internal server error occurred during job submission: {str(e)}"}), 500
+
+        bytes_in = request.content_length or 0
+        usage = {}
+
+        def on_finish(job):
+            # Runs before the outcome is published: if it raises, the job fails (see `JobManager.submit`).
+            self.idempotency_cache.finish_job(request_key)
+            if job.status == JobManager.DONE:
+                try:
+                    with self._stage('mark_used'):
+                        self.key_manager.mark_key_as_used(single_use_key)
+                except Exception:
+                    self.key_manager.release_keys([single_use_key])
+                    raise
+                self.idempotency_cache.put(request_key, owner, job.result, fingerprint)
+                self._record_usage([single_use_key], usage.get('cpu_seconds', 0.0), usage.get('wall_seconds', 0.0),
+                                   bytes_in, len(job.result))
+                self.app.logger.info(f"FHE prediction job {job.job_id} for {self.service_name} successful.")
+            else:
+                self.key_manager.release_keys([single_use_key])
+                self.app.logger.error(f"FHE prediction job {job.job_id} for {self.service_name} failed: {job.error}")
+
+        def run_job():
+            started_at = time.perf_counter()
+            try:
+                with self.admission.measure(), self._stage('run'):
+                    return backend.run(encrypted_data, evaluation_keys, usage=usage)
+            finally:
+                usage['wall_seconds'] = time.perf_counter() - started_at
+
+        try:
+            job = self.job_manager.submit(run_job, on_finish=on_finish)
+        except JobQueueFullError as e:
+            self.key_manager.release_keys([single_use_key])
+            self.app.logger.warning(f"Job submission failed: {e}")
+            retry_after = self.admission.retry_after()
+            return jsonify({"error": str(e), "retry_after": retry_after}), 503, {'Retry-After': str(retry_after)}
+        except Exception as e:
+            self.key_manager.release_keys([single_use_key])
+            self.app.logger.error(f"Job submission error for {self.service_name}: {e}", exc_info=True)
+            return jsonify({"error": f"An internal server error occurred during job submission: {str(e)}"}), 500
+
+        self.idempotency_cache.start_job(request_key, owner, job.job_id, fingerprint)
+        if job.finished:
+            self.idempotency_cache.finish_job(request_key)
+        self.app.logger.info(f"FHE prediction job {job.job_id} queued for {self.service_name}.")
+        return self._job_accepted_response(job)
+
+    def _job_accepted_response(self, job):
+        """Build the 202 response pointing the client to the status of a job."""
+        status_url = url_for('get_prediction_job', job_id=job.job_id)
+        return jsonify({"job_id": job.job_id, "status": job.status, "status_url": status_url}), 202, {'Location': status_url}
+
+    def get_prediction_job(self, job_id):
+        """Returns the status or the result of a prediction job.
+        The optional 'wait' query parameter long-polls for up to that many seconds
+        (capped by `max_job_wait_seconds`) before answering with the current status.
+        Returns:
+            Response: The encrypted result (200), the job status (202), or error message.
+        """
+        wait_seconds = min(request.args.get('wait', 0, type=float), self.max_job_wait_seconds)
+        if wait_seconds > 0:
+            job = self.job_manager.wait(job_id, timeout=wait_seconds)
+        else:
+            job = self.job_manager.get(job_id)
+
+        if job is None:
+            return jsonify({"error": "Unknown or expired job id."}), 404
+        if job.status == JobManager.DONE:
+            return self._binary_response(job.result, 'application/octet-stream')
+        if job.status == JobManager.FAILED:
+            return jsonify({"job_id": job.job_id, "status": job.status, "error": f"An internal server error occurred during prediction: {job.error}"}), 500
+        return jsonify({"job_id": job.job_id, "status": job.status}), 202
+
+    def healthz(self):
+        """Liveness probe: the process is up and answering."""
+        return jsonify({"status": "ok"}), 200
+
+    def readyz(self):
+        """Readiness probe: 200 once the model is loaded and warmed up, 503 otherwise."""
+        ready, reason = self.is_ready()
+        if not ready:
+            return jsonify({"ready": False, "reason": reason}), 503
+        return jsonify({"ready": True}), 200
+
+    def get_queue_stats(self):
+        """Reports the depth of the prediction queue and the rejection counts, for monitoring.
+        Returns:
+            Response: JSON with the admission queue and the job queue state.
+        """
+        return jsonify({
+            "predictions": self.admission.stats(),
+            "jobs": {
+                "pending": self.job_manager.pending,
+                "max_pending": self.job_manager.max_pending,
+                "rejected": self.job_manager.rejected
+            }
+        })
+
     def add_routes(self):
         """Add all relevant routes for the service."""
-        self.app.add_url_rule("/omop_requirements", view_func=self.get_omop_requirements, methods=['GET'])
-        self.app.add_url_rule("/additional_service_info", view_func=self.get_additional_service_info, methods=["GET"])
+        self.app.add_url_rule("/omop_requirements", endpoint="get_omop_requirements", view_func=self.serve_omop_requirements, methods=['GET'])
+        self.app.add_url_rule("/additional_service_info", endpoint="get_additional_service_info", view_func=self.serve_additional_service_info, methods=["GET"])
         self.app.add_url_rule("/predict", view_func=self.predict, methods=["POST"])
+        self.app.add_url_rule("/predict_batch", view_func=self.predict_batch, methods=["POST"])
+        self.app.add_url_rule("/register_evaluation_keys", view_func=self.register_evaluation_keys, methods=["POST"])
+        self.app.add_url_rule("/evaluation_key_uploads", view_func=self.create_evaluation_key_upload, methods=["POST"])
+        self.app.add_url_rule("/evaluation_key_uploads/<upload_id>", view_func=self.evaluation_key_upload, methods=["GET", "PUT"])
+        self.app.add_url_rule("/evaluation_key_uploads/<upload_id>/finalize", view_func=self.finalize_evaluation_key_upload, methods=["POST"])
+        self.app.add_url_rule("/jobs", endpoint="submit_prediction_job", view_func=self.submit_prediction_job, methods=["POST"])
+        self.app.add_url_rule("/jobs/<job_id>", endpoint="get_prediction_job", view_func=self.get_prediction_job, methods=["GET"])
+        self.app.add_url_rule("/queue_stats", view_func=self.get_queue_stats, methods=["GET"])
+        self.app.add_url_rule("/metrics", view_func=self.get_metrics, methods=["GET"])
+        self.app.add_url_rule("/usage", view_func=self.get_usage, methods=["GET"])
+        self.app.add_url_rule("/healthz", view_func=self.healthz, methods=["GET"])
+        self.app.add_url_rule("/readyz", view_func=self.readyz, methods=["GET"])
+        self.app.before_request(self._start_request_metrics)
+        self.app.after_request(self._finish_request_metrics)
+        self.app.after_request(self._advertise_encodings)
+        self.app.after_request(self._advertise_content_types)
+        self.app.after_request(self._flag_execution_mode)
+        self.app.before_request(self._start_request_profile)
+        self.app.before_request(self._start_usage_record)
+        self.app.after_request(self._finish_usage_record)
+        self.app.after_request(self._finish_request_profile)
+        self.app.teardown_request(self._discard_request_profile)
 
     def run(self, port, host='0.0.0.0', debug=False):
         """Run the Flask app for this service."""
         self.app.logger.info(f"Starting {self.model_display_name} service on http://{host}:{port}")
-        self.app.run(host=host, port=port, debug=debug)
+        install_reload_signal(self.reload_model)
+        try:
+            self.app.run(host=host, port=port, debug=debug)
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        """Save the state kept in memory before the process exits: the usage not flushed yet
+        and the journal of consumed keys. Called once no request is running."""
+        if self.usage_meter:
+            self.usage_meter.flush()
+        self.key_manager.close()
 
     def load_service_config(self, service_name):
         """Load service configuration from YAML file.
@@ -140,7 +1303,7 @@ class AIServiceEndpoint(ABC):
             service_name (str): Name of the service to load config for
             
         Returns:
-            str: FHE directory path from config
+            dict: The service entry from the config (including 'output_directory')
             
         Raises:
             ValueError: If no configuration found for service
@@ -154,5 +1317,5 @@ class AIServiceEndpoint(ABC):
             )
             if not dataset_config:
                 raise ValueError(f"No configuration found for service {service_name}")
-            return dataset_config['output_directory']
+            return dataset_config
 
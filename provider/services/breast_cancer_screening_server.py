@@ -1,6 +1,5 @@
 import sys
 sys.path.append("../..")
-from flask import jsonify
 from provider.services.base_service import AIServiceEndpoint
 from standard_definitions.terminology_definitions import ALL_DEFINITIONS
 
@@ -18,9 +17,10 @@ class BreastCancerScreening(AIServiceEndpoint):
         "concave_points3", "symmetry3", "fractal_dimension3"
     ]
 
-    def __init__(self):
-        super().__init__(SERVICE_NAME)
+    def __init__(self, **kwargs):
+        super().__init__(SERVICE_NAME, **kwargs)
         self._omop_metadata = self._generate_omop_requirements()
+        self.prepare_metadata()
 
     def _generate_omop_requirements(self):
         """
@@ -47,7 +47,7 @@ class BreastCancerScreening(AIServiceEndpoint):
         return {"measurement": measurements}
     
     def get_omop_requirements(self):
-        return self._generate_omop_requirements()
+        return self._omop_metadata
 
     def get_additional_service_info(self):
         """Provides additional data about the service."""
@@ -61,7 +61,7 @@ class BreastCancerScreening(AIServiceEndpoint):
                 "1": "Risk"
             }
         }
-        return jsonify(additional_info)
+        return additional_info
 
 if __name__ == "__main__":
     service_instance = BreastCancerScreening()
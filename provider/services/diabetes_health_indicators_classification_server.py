@@ -1,6 +1,5 @@
 import sys
 sys.path.append("../..")
-from flask import jsonify
 from provider.services.base_service import AIServiceEndpoint
 from standard_definitions.terminology_definitions import ALL_DEFINITIONS
 
@@ -22,9 +21,10 @@ class DiabetesClassification(AIServiceEndpoint):
         "body_mass_index"
     ]
 
-    def __init__(self):
-        super().__init__(SERVICE_NAME)
+    def __init__(self, **kwargs):
+        super().__init__(SERVICE_NAME, **kwargs)
         self._omop_metadata = self._generate_omop_requirements()
+        self.prepare_metadata()
 
     def _generate_omop_requirements(self):
         """
@@ -64,7 +64,7 @@ class DiabetesClassification(AIServiceEndpoint):
         return omop_reqs
 
     def get_omop_requirements(self):
-        return self._generate_omop_requirements()
+        return self._omop_metadata
     
     def get_additional_service_info(self):
         """Provides additional data about the service."""
@@ -78,7 +78,7 @@ class DiabetesClassification(AIServiceEndpoint):
                 "1": "Risk"
             }
         }
-        return jsonify(additional_info)
+        return additional_info
     
 if __name__ == "__main__":
     service_instance = DiabetesClassification()
@@ -0,0 +1,141 @@
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Optional, Tuple
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+_KEY_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class EvaluationKeyStore:
+    """
+    EvaluationKeyStore keeps the evaluation keys uploaded by clients so they only
+    have to be sent once per client key set.
+    Keys are stored content-addressed on disk (the key id is the SHA-256 of the
+    serialized keys) and the most recently used ones are kept loaded in memory,
+    in an LRU bounded by the size of the serialized keys.
+    Attributes:
+        directory (Path): Directory where the serialized keys are stored.
+        max_cache_bytes (int): Upper bound for the serialized size of the cached keys.
+        loader (Callable[[bytes], Any]): Turns serialized keys into the object handed to the FHE server.
+    """
+    def __init__(self, directory, max_cache_bytes: int, loader: Callable[[bytes], Any]):
+        """
+        Initialize the store.
+        Args:
+            directory (str | Path): Directory where the serialized keys are stored.
+            max_cache_bytes (int): Upper bound for the serialized size of the cached keys.
+            loader (Callable[[bytes], Any]): Turns serialized keys into the object handed to the FHE server.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_cache_bytes = max_cache_bytes
+        self.loader = loader
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_valid_key_id(key_id: str) -> bool:
+        """Check that a key id has the shape of a SHA-256 hex digest."""
+        return bool(key_id) and bool(_KEY_ID_PATTERN.match(key_id))
+
+    def _path_for(self, key_id: str) -> Path:
+        return self.directory / f"{key_id}.bin"
+
+    def register(self, serialized_evaluation_keys: bytes) -> Tuple[str, bool]:
+        """Store serialized evaluation keys, if not already stored.
+        Args:
+            serialized_evaluation_keys (bytes): Keys from `FHEModelClient.get_serialized_evaluation_keys()`.
+        Returns:
+            Tuple[str, bool]: The key id to use in later predictions, and whether the keys were newly stored.
+        """
+        key_id = hashlib.sha256(serialized_evaluation_keys).hexdigest()
+        path = self._path_for(key_id)
+        if path.exists():
+            return key_id, False
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(serialized_evaluation_keys)
+            os.replace(tmp_path, path)
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+        return key_id, True
+
+    def register_file(self, path) -> Tuple[str, bool]:
+        """Store serialized evaluation keys from a file (e.g. a finished resumable upload), if not already stored.
+        The file is hashed and copied in blocks, so the keys are not loaded in memory.
+        Args:
+            path (str | Path): File holding the serialized keys. It is left in place.
+        Returns:
+            Tuple[str, bool]: The key id, and whether the keys were newly stored.
+        """
+        digest = hashlib.sha256()
+        with open(path, 'rb') as source:
+            for block in iter(lambda: source.read(1024 * 1024), b""):
+                digest.update(block)
+        key_id = digest.hexdigest()
+        key_path = self._path_for(key_id)
+        if key_path.exists():
+            return key_id, False
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f, open(path, 'rb') as source:
+                shutil.copyfileobj(source, f, 1024 * 1024)
+            os.replace(tmp_path, key_path)
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+        return key_id, True
+
+    def contains(self, key_id: str) -> bool:
+        """Check whether keys with the given id are stored."""
+        return self.is_valid_key_id(key_id) and self._path_for(key_id).exists()
+
+    def get(self, key_id: str) -> Optional[Any]:
+        """Return the loaded evaluation keys for a key id.
+        Args:
+            key_id (str): The id returned by `register`.
+        Returns:
+            Any: The loaded keys, or None if the id is unknown.
+        """
+        if not self.is_valid_key_id(key_id):
+            return None
+        with self._lock:
+            if key_id in self._cache:
+                self._cache.move_to_end(key_id)
+                return self._cache[key_id][0]
+
+        path = self._path_for(key_id)
+        try:
+            serialized_evaluation_keys = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        loaded_keys = self.loader(serialized_evaluation_keys)
+        self._put(key_id, loaded_keys, len(serialized_evaluation_keys))
+        return loaded_keys
+
+    def _put(self, key_id: str, loaded_keys: Any, size: int):
+        """Insert loaded keys in the LRU, evicting the least recently used ones to stay within budget."""
+        if size > self.max_cache_bytes:
+            return
+        with self._lock:
+            if key_id in self._cache:
+                self._cache.move_to_end(key_id)
+                return
+            self._cache[key_id] = (loaded_keys, size)
+            self._cache_bytes += size
+            while self._cache_bytes > self.max_cache_bytes:
+                _, (_, evicted_size) = self._cache.popitem(last=False)
+                self._cache_bytes -= evicted_size
+
+    @property
+    def cached_bytes(self) -> int:
+        """Serialized size of the keys currently loaded in memory."""
+        return self._cache_bytes
@@ -0,0 +1,386 @@
+"""
+Helpers and execution backends for running FHE circuits on a loaded FHEModelServer.
+
+`FHEModelServer.run` deserializes the evaluation keys on every call. When several
+ciphertexts are evaluated under the same client keys, the keys are deserialized
+once here and handed to the underlying concrete server for each row.
+
+Services run the circuit through an execution backend: `InlineExecutionBackend`
+evaluates in the request thread, `ProcessPoolExecutionBackend` on an `FHEWorkerPool`
+of worker processes that each preload the models.
+
+`EchoExecutionBackend` and `ClearExecutionBackend` stand in for real FHE when a
+service is load tested (non-production `execution_mode`).
+
+A reloaded model gets a new model id on the pool (`<service>@<version>`): workers load it
+on first use and keep the previous version for the requests still running on it.
+
+Backends add the CPU time of an evaluation to the optional `usage` dict of `run` and
+`run_batch` ('cpu_seconds'), measured in the process that evaluated it. This is process
+CPU time, which includes the threads of the native FHE runtime. With the inline backend,
+predictions that overlap in the same process are each charged the whole process's CPU
+time while they run. Worker processes evaluate one batch at a time, so their figure is exact.
+"""
+
+import time
+
+
+def deserialize_evaluation_keys(serialized_evaluation_keys):
+    """Deserialize evaluation keys produced by `FHEModelClient.get_serialized_evaluation_keys`.
+    Args:
+        serialized_evaluation_keys (bytes): Serialized evaluation keys.
+    Returns:
+        fhe.EvaluationKeys: The deserialized evaluation keys.
+    """
+    from concrete import fhe
+    return fhe.EvaluationKeys.deserialize(bytes(serialized_evaluation_keys))
+
+
+def prepare_evaluation_keys(server, serialized_evaluation_keys):
+    """Prepare evaluation keys for repeated use with `run_fhe`.
+    Keys are deserialized when the model server exposes the underlying concrete server,
+    otherwise they are kept serialized and `FHEModelServer.run` deserializes them per call.
+    Args:
+        server (FHEModelServer): The loaded model server.
+        serialized_evaluation_keys (bytes): Serialized evaluation keys.
+    Returns:
+        bytes | fhe.EvaluationKeys: Keys to pass to `run_fhe`.
+    """
+    if getattr(server, "server", None) is None:
+        return bytes(serialized_evaluation_keys)
+    return deserialize_evaluation_keys(serialized_evaluation_keys)
+
+
+def run_fhe(server, encrypted_data, evaluation_keys):
+    """Run the FHE circuit for one ciphertext.
+    Args:
+        server (FHEModelServer): The loaded model server.
+        encrypted_data (bytes | memoryview): Serialized encrypted quantized input.
+        evaluation_keys (bytes | memoryview | fhe.EvaluationKeys): Serialized or already deserialized evaluation keys.
+    Returns:
+        bytes: Serialized encrypted result.
+    """
+    if isinstance(evaluation_keys, (bytes, bytearray, memoryview)):
+        return server.run(bytes(encrypted_data), bytes(evaluation_keys))
+    from concrete import fhe
+    value = fhe.Value.deserialize(bytes(encrypted_data))
+    return server.server.run(value, evaluation_keys=evaluation_keys).serialize()
+
+
+def measure_cpu(usage, function, *args):
+    """Call `function(*args)` and add the CPU time of this process it took to `usage['cpu_seconds']`.
+    Args:
+        usage (Optional[dict]): Where to add the CPU time; nothing is measured when None.
+    Returns:
+        The result of `function`.
+    """
+    if usage is None:
+        return function(*args)
+    started_at = time.process_time()
+    try:
+        return function(*args)
+    finally:
+        usage['cpu_seconds'] = usage.get('cpu_seconds', 0.0) + time.process_time() - started_at
+
+
+def run_fhe_batch(server, encrypted_rows, evaluation_keys):
+    """Run the FHE circuit for several ciphertexts sharing the same evaluation keys.
+    Serialized evaluation keys are deserialized once for the whole batch.
+    Args:
+        server (FHEModelServer): The loaded model server.
+        encrypted_rows (List[bytes]): Serialized encrypted quantized inputs.
+        evaluation_keys (bytes | fhe.EvaluationKeys): Serialized or already deserialized evaluation keys.
+    Returns:
+        List[bytes]: Serialized encrypted results, in the same order as the inputs.
+    """
+    if isinstance(evaluation_keys, (bytes, bytearray, memoryview)):
+        evaluation_keys = prepare_evaluation_keys(server, evaluation_keys)
+    return [run_fhe(server, row, evaluation_keys) for row in encrypted_rows]
+
+
+class InlineExecutionBackend:
+    """
+    Runs the FHE circuit in the calling thread, on the model server loaded by the service.
+    """
+    def __init__(self, server):
+        self.server = server
+
+    def prepare_evaluation_keys(self, serialized_evaluation_keys):
+        """Loader for the evaluation key store: deserialize once, reuse for every prediction."""
+        return prepare_evaluation_keys(self.server, serialized_evaluation_keys)
+
+    def resolve_registered_keys(self, evaluation_key_store, key_id):
+        """Get registered evaluation keys in the form expected by `run`, or None if unknown."""
+        return evaluation_key_store.get(key_id)
+
+    def run(self, encrypted_data, evaluation_keys, usage=None):
+        return measure_cpu(usage, run_fhe, self.server, encrypted_data, evaluation_keys)
+
+    def run_batch(self, encrypted_rows, evaluation_keys, usage=None):
+        return measure_cpu(usage, run_fhe_batch, self.server, encrypted_rows, evaluation_keys)
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class RegisteredEvaluationKeys:
+    """Reference to evaluation keys stored by an EvaluationKeyStore, sent to worker processes instead of the keys."""
+    __slots__ = ("key_id", "directory")
+
+    def __init__(self, key_id, directory):
+        self.key_id = key_id
+        self.directory = directory
+
+
+class SharedPayload:
+    """Reference to a payload placed in shared memory, sent to worker processes instead of the bytes."""
+    __slots__ = ("name", "size")
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+
+_worker_servers = {}
+_worker_key_stores = {}
+_worker_key_cache_bytes = 0
+
+
+def _init_worker(fhe_directories, evaluation_keys_cache_bytes):
+    """Process pool initializer: load every model server once per worker process."""
+    global _worker_key_cache_bytes
+    from concrete.ml.deployment import FHEModelServer
+    for model_id, fhe_directory in fhe_directories.items():
+        server = FHEModelServer(path_dir=fhe_directory)
+        server.load()
+        _worker_servers[model_id] = server
+    _worker_key_cache_bytes = evaluation_keys_cache_bytes
+
+
+def _worker_server(model_id, fhe_directory):
+    """Get a model server of the worker, loading a reloaded version on first use.
+    Only the two most recent versions of a model are kept loaded."""
+    server = _worker_servers.get(model_id)
+    if server is not None:
+        return server
+    if fhe_directory is None:
+        raise KeyError(f"Model {model_id} is not loaded by this worker.")
+    from concrete.ml.deployment import FHEModelServer
+    server = FHEModelServer(path_dir=fhe_directory)
+    server.load()
+    base_id = model_id.split("@")[0]
+    versions = [loaded_id for loaded_id in _worker_servers if loaded_id.split("@")[0] == base_id]
+    for stale_id in versions[:-1]:
+        del _worker_servers[stale_id]
+    _worker_servers[model_id] = server
+    return server
+
+
+def _read_payload(payload):
+    """Get the bytes of a payload sent to a worker, copying them out of shared memory if needed."""
+    if not isinstance(payload, SharedPayload):
+        return payload
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=payload.name)
+    try:
+        return bytes(shm.buf[:payload.size])
+    finally:
+        shm.close()
+
+
+def _resolve_worker_keys(server, evaluation_keys):
+    """Get evaluation keys usable by the worker's server, caching registered keys per worker."""
+    if isinstance(evaluation_keys, RegisteredEvaluationKeys):
+        from evaluation_key_store import EvaluationKeyStore
+        store = _worker_key_stores.get(evaluation_keys.directory)
+        if store is None:
+            store = EvaluationKeyStore(
+                evaluation_keys.directory,
+                max_cache_bytes=_worker_key_cache_bytes,
+                loader=lambda serialized_keys: prepare_evaluation_keys(server, serialized_keys)
+            )
+            _worker_key_stores[evaluation_keys.directory] = store
+        loaded_keys = store.get(evaluation_keys.key_id)
+        if loaded_keys is None:
+            raise KeyError(f"Evaluation keys {evaluation_keys.key_id} not found in {evaluation_keys.directory}")
+        return loaded_keys
+    return prepare_evaluation_keys(server, _read_payload(evaluation_keys))
+
+
+def _worker_run_batch(model_id, encrypted_rows, evaluation_keys, fhe_directory=None):
+    """Process pool task: evaluate a batch of ciphertexts on one of the worker's model servers.
+    Returns the results and the CPU time the worker spent on them."""
+    usage = {}
+    def run():
+        server = _worker_server(model_id, fhe_directory)
+        rows = [_read_payload(row) for row in encrypted_rows]
+        return run_fhe_batch(server, rows, _resolve_worker_keys(server, evaluation_keys))
+    results = measure_cpu(usage, run)
+    return results, usage['cpu_seconds']
+
+
+def _worker_ping():
+    import os
+    return os.getpid()
+
+
+class FHEWorkerPool:
+    """
+    Pool of worker processes that each load the model servers from `server.zip` once,
+    so concurrent predictions use all cores instead of contending for the GIL.
+    A pool can serve several models, which lets one host process share its workers
+    between all services.
+    Payloads larger than `shared_memory_threshold` bytes are handed to the workers through
+    shared memory rather than pickled through the pool's pipe. Registered evaluation keys
+    are sent by reference and every worker keeps its own LRU of deserialized keys.
+    """
+    def __init__(self, fhe_directories, workers, evaluation_keys_cache_bytes,
+                 shared_memory_threshold=1024 * 1024, start_method="spawn"):
+        """
+        Args:
+            fhe_directories (Dict[str, str]): Model artifact directory for each model id.
+            workers (int): Number of worker processes.
+            evaluation_keys_cache_bytes (int): Budget for deserialized evaluation keys, split across workers.
+            shared_memory_threshold (int): Payload size from which shared memory is used.
+            start_method (str): Multiprocessing start method of the workers.
+        """
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        self.workers = workers
+        self.model_ids = list(fhe_directories)
+        self.shared_memory_threshold = shared_memory_threshold
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context(start_method),
+            initializer=_init_worker,
+            initargs=(
+                {model_id: str(directory) for model_id, directory in fhe_directories.items()},
+                max(evaluation_keys_cache_bytes // workers, 0)
+            )
+        )
+
+    def start(self):
+        """Spawn the worker processes now, so the models are loaded before the first request
+        rather than on it. Waits until at least one worker has loaded the models."""
+        futures = [self._executor.submit(_worker_ping) for _ in range(self.workers)]
+        for future in futures:
+            future.result()
+
+    def _share(self, payload, shared_segments):
+        """Place a large payload in shared memory; small ones are sent as bytes."""
+        if isinstance(payload, RegisteredEvaluationKeys):
+            return payload
+        if len(payload) < self.shared_memory_threshold:
+            return bytes(payload)
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory(create=True, size=len(payload))
+        shared_segments.append(shm)
+        shm.buf[:len(payload)] = payload
+        return SharedPayload(shm.name, len(payload))
+
+    def run_batch(self, model_id, encrypted_rows, evaluation_keys, fhe_directory=None, usage=None):
+        """Evaluate ciphertexts of one model on a worker and wait for the results.
+        `fhe_directory` lets workers load a model id they were not started with (a reloaded model).
+        The worker's CPU time is added to `usage['cpu_seconds']`."""
+        shared_segments = []
+        try:
+            rows = [self._share(row, shared_segments) for row in encrypted_rows]
+            keys = self._share(evaluation_keys, shared_segments)
+            results, cpu_seconds = self._executor.submit(_worker_run_batch, model_id, rows, keys, fhe_directory).result()
+            if usage is not None:
+                usage['cpu_seconds'] = usage.get('cpu_seconds', 0.0) + cpu_seconds
+            return results
+        finally:
+            for shm in shared_segments:
+                shm.close()
+                shm.unlink()
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+class ProcessPoolExecutionBackend:
+    """
+    Runs the FHE circuit of one model on an FHEWorkerPool.
+    The backend shuts the pool down with the service only if it owns it; a pool shared
+    between services is shut down by whoever created it.
+    A backend with an `fhe_directory` serves a model the workers load on first use.
+    """
+    def __init__(self, pool, model_id, owns_pool=False, fhe_directory=None):
+        self.pool = pool
+        self.model_id = model_id
+        self.owns_pool = owns_pool
+        self.fhe_directory = fhe_directory
+
+    def prepare_evaluation_keys(self, serialized_evaluation_keys):
+        return bytes(serialized_evaluation_keys)
+
+    def resolve_registered_keys(self, evaluation_key_store, key_id):
+        if not evaluation_key_store.contains(key_id):
+            return None
+        return RegisteredEvaluationKeys(key_id, str(evaluation_key_store.directory))
+
+    def run(self, encrypted_data, evaluation_keys, usage=None):
+        return self.run_batch([encrypted_data], evaluation_keys, usage)[0]
+
+    def run_batch(self, encrypted_rows, evaluation_keys, usage=None):
+        return self.pool.run_batch(self.model_id, encrypted_rows, evaluation_keys, self.fhe_directory, usage)
+
+    def shutdown(self, wait=True):
+        if self.owns_pool:
+            self.pool.shutdown(wait=wait)
+
+
+class EchoExecutionBackend:
+    """
+    Load-testing stand-in that does not evaluate the circuit: after `delay_seconds`, each
+    ciphertext is answered with itself. The response has a realistic size but cannot be
+    decrypted as a prediction, and neither the model nor the shape of its output is checked.
+    """
+    def __init__(self, delay_seconds=0.0):
+        self.delay_seconds = delay_seconds
+
+    def prepare_evaluation_keys(self, serialized_evaluation_keys):
+        return bytes(serialized_evaluation_keys)
+
+    def resolve_registered_keys(self, evaluation_key_store, key_id):
+        return key_id if evaluation_key_store.contains(key_id) else None
+
+    def run(self, encrypted_data, evaluation_keys, usage=None):
+        return self.run_batch([encrypted_data], evaluation_keys, usage)[0]
+
+    def run_batch(self, encrypted_rows, evaluation_keys, usage=None):
+        return measure_cpu(usage, self._run_batch, encrypted_rows)
+
+    def _run_batch(self, encrypted_rows):
+        time.sleep(self.delay_seconds * len(encrypted_rows))
+        return [bytes(row) for row in encrypted_rows]
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class ClearExecutionBackend(EchoExecutionBackend):
+    """
+    Load-testing stand-in that evaluates cleartext inputs with the quantized model of
+    `client.zip`, in the clear (concrete-ml `fhe="disable"`), then waits `delay_seconds`.
+    Each input is a NumPy `.npy` array of features; each result the `.npy` array of the
+    model's output (class probabilities for classifiers).
+    """
+    def __init__(self, fhe_directory, delay_seconds=0.0):
+        super().__init__(delay_seconds)
+        from concrete.ml.deployment import FHEModelClient
+        self.model = FHEModelClient(path_dir=str(fhe_directory)).model
+
+    def _run_batch(self, encrypted_rows):
+        import io
+        import numpy
+        results = []
+        for row in encrypted_rows:
+            features = numpy.load(io.BytesIO(bytes(row)), allow_pickle=False)
+            predict = getattr(self.model, "predict_proba", None) or self.model.predict
+            output = io.BytesIO()
+            numpy.save(output, predict(numpy.atleast_2d(features), fhe="disable"), allow_pickle=False)
+            results.append(output.getvalue())
+        time.sleep(self.delay_seconds * len(encrypted_rows))
+        return results
@@ -0,0 +1,72 @@
+import sys
+sys.path.append("../..")
+from provider.services.base_service import AIServiceEndpoint
+from standard_definitions.terminology_definitions import ALL_DEFINITIONS
+
+DEFAULT_LABEL_MEANINGS = {
+    "0": "No Risk",
+    "1": "Risk"
+}
+
+
+class GenericService(AIServiceEndpoint):
+    """
+    Service declared entirely in training_config.yaml, without a dedicated *_server.py.
+    Its entry lists the `required_definitions` (keys of ALL_DEFINITIONS, in model input order)
+    and, optionally, a `description` and `label_meanings`.
+    """
+
+    def __init__(self, service_name, **kwargs):
+        super().__init__(service_name, **kwargs)
+        self.REQUIRED_DEFINITIONS = self.service_config.get('required_definitions', [])
+        if not self.REQUIRED_DEFINITIONS:
+            self.app.logger.error(f"No 'required_definitions' configured for {self.service_name}.")
+        self._omop_metadata = self._generate_omop_requirements()
+        self.prepare_metadata()
+
+    def _generate_omop_requirements(self):
+        """
+        Builds the OMOP metadata from the configured definitions, grouped by domain.
+        """
+        omop_reqs = {
+            "observation": [],
+            "condition": [],
+            "measurement": []
+        }
+
+        for value_name in self.REQUIRED_DEFINITIONS:
+            definition = ALL_DEFINITIONS.get(value_name)
+            if not definition:
+                self.app.logger.error(f"Definition for '{value_name}' not found in ALL_DEFINITIONS for OMOP requirements.")
+                continue
+
+            domain_key = definition["domain"].lower()
+            if domain_key not in omop_reqs:
+                self.app.logger.error(f"Domain '{domain_key}' for value_name '{value_name}' is not a recognized OMOP domain key (observation, condition, measurement).")
+                continue
+
+            omop_concept_id = definition.get("omop_concept_id")
+            if omop_concept_id is None:
+                self.app.logger.error(f"OMOP Concept ID not defined for '{value_name}' in ALL_DEFINITIONS.")
+                continue
+
+            omop_reqs[domain_key].append({
+                f"{domain_key}_concept_id": omop_concept_id,
+                f"{domain_key}_source_value": definition["source_value"],
+                "value_name": value_name,
+                "is_person_demographic": definition.get("is_person_demographic", False)
+            })
+
+        return omop_reqs
+
+    def get_omop_requirements(self):
+        return self._omop_metadata
+
+    def get_additional_service_info(self):
+        """Provides additional data about the service, as configured."""
+        additional_info = {
+            "service_name": self.service_name,
+            "description": self.service_config.get('description', ""),
+            "label_meanings": self.service_config.get('label_meanings', DEFAULT_LABEL_MEANINGS)
+        }
+        return additional_info
@@ -0,0 +1,252 @@
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SWEEP_INTERVAL_SECONDS = 60.0
+
+
+def _digest(value: str) -> str:
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+
+class IdempotencyConflictError(Exception):
+    """Raised when a request reuses the idempotency key and single-use keys of a stored request
+    with a different content."""
+
+
+def _binding(owner: str, fingerprint: str) -> str:
+    return f"{_digest(owner)}:{fingerprint}"
+
+
+class IdempotencyCache:
+    """
+    IdempotencyCache keeps the encrypted results of recent predictions so that a retried
+    request (same idempotency key, same single-use keys) gets the stored ciphertext back
+    instead of running the FHE circuit again.
+    Each entry is bound to the single-use keys of the request that produced it and to a
+    fingerprint of its content: a lookup only hits when the retry presents the same keys and
+    the same content, so a key consumed by one request cannot fetch its result for another
+    one. Entries expire after `ttl_seconds`, and the
+    oldest ones are evicted first to keep the stored results within `max_bytes`. Only
+    digests of the request ids and keys are kept.
+    With a `spool_directory`, the results and the running jobs are also written there, so
+    that a retry served by another process sharing the directory (pre-forked workers of the
+    same host) finds them. Each process evicts the files it wrote, and every process sweeps
+    the directory periodically, removing the expired files and the oldest results past
+    `spool_max_bytes`, including those left by processes that exited.
+    Attributes:
+        max_bytes (int): Upper bound for the size of the stored results.
+        ttl_seconds (float): How long a result is kept.
+        spool_directory (Optional[Path]): Directory shared with other processes, if any.
+        spool_max_bytes (int): Upper bound for the size of the results in the spool directory.
+    """
+    def __init__(self, max_bytes: int, ttl_seconds: float, spool_directory=None, spool_max_bytes: Optional[int] = None):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.spool_directory = Path(spool_directory) if spool_directory else None
+        self.spool_max_bytes = max_bytes if spool_max_bytes is None else spool_max_bytes
+        self._next_sweep = 0.0
+        if self.spool_directory:
+            self.spool_directory.mkdir(parents=True, exist_ok=True)
+        self._results = OrderedDict()
+        self._jobs: Dict[str, Tuple[str, str]] = {}
+        self._bytes = 0
+        self.hits = 0
+        self._lock = threading.Lock()
+
+    def get(self, request_key: str, owner: str, fingerprint: str = "") -> Optional[bytes]:
+        """Return the stored result of a request.
+        Args:
+            request_key (str): The client's idempotency key, or the single-use key.
+            owner (str): The single-use key(s) of the request.
+            fingerprint (str): Digest of the content of the request.
+        Returns:
+            Optional[bytes]: The encrypted result, or None if there is none for this request and owner.
+        Raises:
+            IdempotencyConflictError: If the result stored for this request and owner has another fingerprint.
+        """
+        key = _digest(request_key)
+        with self._lock:
+            self._purge_expired()
+            entry = self._results.get(key)
+        if entry is None:
+            entry = self._load_spooled(key)
+        if entry is None or not self._matches(entry[0], owner, fingerprint):
+            return None
+        with self._lock:
+            self.hits += 1
+        return entry[1]
+
+    def put(self, request_key: str, owner: str, result: bytes, fingerprint: str = ""):
+        """Store the result of a request, evicting the oldest results to stay within budget."""
+        if len(result) > self.max_bytes:
+            return
+        key = _digest(request_key)
+        owner_digest = _binding(owner, fingerprint)
+        self._spool(self._result_path(key), owner_digest, time.time() + self.ttl_seconds, bytes(result))
+        with self._lock:
+            if self._jobs.pop(key, None):
+                self._unlink(self._job_path(key))
+            previous = self._results.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous[1])
+            self._results[key] = (owner_digest, bytes(result), time.monotonic() + self.ttl_seconds)
+            self._bytes += len(result)
+            while self._bytes > self.max_bytes:
+                evicted_key, (_, evicted, _) = self._results.popitem(last=False)
+                self._bytes -= len(evicted)
+                self._unlink(self._result_path(evicted_key))
+        self._maybe_sweep()
+
+    def start_job(self, request_key: str, owner: str, job_id: str, fingerprint: str = ""):
+        """Remember the job running a request, so a retried submission gets the same job."""
+        key = _digest(request_key)
+        binding = _binding(owner, fingerprint)
+        with self._lock:
+            self._jobs[key] = (binding, job_id)
+        self._spool(self._job_path(key), binding, time.time() + self.ttl_seconds, job_id.encode("ascii"))
+        self._maybe_sweep()
+
+    def finish_job(self, request_key: str):
+        """Forget the job of a request (its result, if any, is stored with `put`)."""
+        key = _digest(request_key)
+        with self._lock:
+            self._jobs.pop(key, None)
+        self._unlink(self._job_path(key))
+
+    def get_job(self, request_key: str, owner: str, fingerprint: str = "") -> Optional[str]:
+        """Return the id of the job still running a request, or None.
+        Raises:
+            IdempotencyConflictError: If the job of this request and owner has another fingerprint.
+        """
+        key = _digest(request_key)
+        with self._lock:
+            entry = self._jobs.get(key)
+        if entry is None:
+            spooled = self._load_spooled(key, job=True)
+            entry = (spooled[0], spooled[1].decode("ascii")) if spooled else None
+        return entry[1] if entry and self._matches(entry[0], owner, fingerprint) else None
+
+    @staticmethod
+    def _matches(binding: str, owner: str, fingerprint: str) -> bool:
+        """Whether an entry belongs to a request: False for other single-use keys, and a
+        conflict for the same keys with another content."""
+        owner_digest, _, stored_fingerprint = binding.partition(":")
+        if owner_digest != _digest(owner):
+            return False
+        if stored_fingerprint != fingerprint:
+            raise IdempotencyConflictError("The request reuses the single-use keys of another request with a different content.")
+        return True
+
+    def _purge_expired(self):
+        """Drop expired results. Must be called with the lock held."""
+        now = time.monotonic()
+        while self._results:
+            key, (_, result, expires_at) = next(iter(self._results.items()))
+            if expires_at > now:
+                break
+            del self._results[key]
+            self._bytes -= len(result)
+            self._unlink(self._result_path(key))
+
+    def sweep_spool(self):
+        """Remove the spooled entries that expired, whichever process wrote them, then the oldest
+        results until the directory is within `spool_max_bytes`. Every entry is written with the
+        same TTL, so its age is read from the file's modification time. The newest result is kept
+        even if it is over budget by its header."""
+        if self.spool_directory is None:
+            return
+        now = time.time()
+        results = []
+        try:
+            paths = list(self.spool_directory.iterdir())
+        except OSError as e:
+            logger.error(f"Failed to sweep the idempotency spool {self.spool_directory}: {e}")
+            return
+        for path in paths:
+            try:
+                stat = path.stat()
+                if stat.st_mtime + self.ttl_seconds <= now:
+                    path.unlink(missing_ok=True)
+                elif path.suffix == ".result":
+                    results.append((stat.st_mtime, stat.st_size, path))
+            except OSError:
+                continue
+        spooled_bytes = sum(size for _, size, _ in results)
+        for _, size, path in sorted(results)[:-1]:
+            if spooled_bytes <= self.spool_max_bytes:
+                break
+            try:
+                path.unlink(missing_ok=True)
+            except OSError:
+                continue
+            spooled_bytes -= size
+
+    def _maybe_sweep(self):
+        """Sweep the spool directory at most every `SWEEP_INTERVAL_SECONDS` (or TTL, if shorter)."""
+        if self.spool_directory is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if now < self._next_sweep:
+                return
+            self._next_sweep = now + min(self.ttl_seconds, SWEEP_INTERVAL_SECONDS)
+        self.sweep_spool()
+
+    def _result_path(self, key: str) -> Optional[Path]:
+        return self.spool_directory / f"{key}.result" if self.spool_directory else None
+
+    def _job_path(self, key: str) -> Optional[Path]:
+        return self.spool_directory / f"{key}.job" if self.spool_directory else None
+
+    def _spool(self, path: Optional[Path], owner_digest: str, expires_at: float, payload: bytes):
+        """Write an entry atomically to the spool directory: its owner binding and expiry (wall
+        clock time, shared by the processes) on the first line, then its payload."""
+        if path is None:
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.spool_directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(f"{owner_digest} {expires_at}\n".encode("ascii"))
+                f.write(payload)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            Path(tmp_path).unlink(missing_ok=True)
+            logger.error(f"Failed to spool idempotency entry {path.name}: {e}")
+
+    def _load_spooled(self, key: str, job: bool = False) -> Optional[Tuple[str, bytes]]:
+        """Read an entry written by any process, or None if there is none or it expired.
+        Returns:
+            Optional[Tuple[str, bytes]]: The owner binding and the payload (result or job id).
+        """
+        path = self._job_path(key) if job else self._result_path(key)
+        if path is None:
+            return None
+        try:
+            data = path.read_bytes()
+            header, payload = data.split(b"\n", 1)
+            owner_digest, expires_at = header.decode("ascii").split(" ")
+            if float(expires_at) <= time.time():
+                self._unlink(path)
+                return None
+        except (OSError, ValueError):
+            return None
+        return owner_digest, payload
+
+    @staticmethod
+    def _unlink(path: Optional[Path]):
+        if path is not None:
+            path.unlink(missing_ok=True)
+
+    @property
+    def cached_bytes(self) -> int:
+        """Size of the results currently stored."""
+        return self._bytes
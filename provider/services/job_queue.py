@@ -0,0 +1,288 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Optional
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+_JOB_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+_SPOOL_FILE_PATTERN = re.compile(r"^[0-9a-f]{32}\.(json|bin)$")
+
+SWEEP_INTERVAL_SECONDS = 60.0
+
+
+def _process_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobQueueFullError(Exception):
+    """Raised when a job is submitted while the queue already holds its maximum of unfinished jobs."""
+
+
+class Job:
+    """
+    A prediction job tracked by the JobManager.
+    Attributes:
+        job_id (str): Identifier returned to the client.
+        status (str): One of JobManager.QUEUED, RUNNING, DONE or FAILED.
+        result (Optional[bytes]): The encrypted result once the job is done.
+        error (Optional[str]): The error message if the job failed.
+        finished_at (Optional[float]): Monotonic time at which the job finished (None for jobs
+            read back from the spool directory).
+    """
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.status = JobManager.QUEUED
+        self.result: Optional[bytes] = None
+        self.error: Optional[str] = None
+        self.created_at = time.monotonic()
+        self.finished_at: Optional[float] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (JobManager.DONE, JobManager.FAILED)
+
+
+class JobManager:
+    """
+    JobManager runs prediction jobs on a bounded pool of worker threads so that HTTP
+    requests can return right after submission.
+    Finished jobs keep their result for `result_ttl_seconds` and are then forgotten.
+    With a `spool_directory`, the state and result of every job are also written there, so
+    that processes sharing the directory (pre-forked workers of the same host) can answer
+    status requests for jobs submitted to any of them. A spooled job whose process exited
+    before it finished is reported as failed. Every process sweeps the directory periodically,
+    removing the files of jobs finished (or orphaned) for longer than `result_ttl_seconds`,
+    including those of processes that exited.
+    Attributes:
+        max_workers (int): Number of jobs executed concurrently.
+        max_pending (int): Maximum number of unfinished (queued or running) jobs.
+        rejected (int): Number of submissions rejected because the queue was full.
+        result_ttl_seconds (float): How long finished jobs are kept.
+        spool_directory (Optional[Path]): Directory shared with other processes, if any.
+    """
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, max_workers: int, max_pending: int, result_ttl_seconds: float, spool_directory=None):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.result_ttl_seconds = result_ttl_seconds
+        self.spool_directory = Path(spool_directory) if spool_directory else None
+        if self.spool_directory:
+            self.spool_directory.mkdir(parents=True, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fhe-job")
+        self._jobs: Dict[str, Job] = {}
+        self._pending = 0
+        self.rejected = 0
+        self._condition = threading.Condition()
+        self._next_sweep = 0.0
+
+    def submit(self, fn: Callable[[], bytes], on_finish: Optional[Callable[[Job], None]] = None) -> Job:
+        """Queue a job.
+        Args:
+            fn (Callable[[], bytes]): Computes the job result.
+            on_finish (Optional[Callable[[Job], None]]): Called from the worker once the job is done or failed,
+                with its outcome, before the outcome is published. If it raises, the job fails.
+        Returns:
+            Job: The queued job.
+        Raises:
+            JobQueueFullError: If `max_pending` jobs are already unfinished.
+        """
+        with self._condition:
+            self._purge_expired()
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                raise JobQueueFullError(f"Job queue is full ({self.max_pending} unfinished jobs).")
+            job = Job(uuid.uuid4().hex)
+            self._jobs[job.job_id] = job
+            self._pending += 1
+        self._spool(job)
+        self._executor.submit(self._run, job, fn, on_finish)
+        self._maybe_sweep()
+        return job
+
+    def _run(self, job: Job, fn: Callable[[], bytes], on_finish: Optional[Callable[[Job], None]]):
+        with self._condition:
+            job.status = self.RUNNING
+        self._spool(job)
+        outcome = Job(job.job_id)
+        try:
+            outcome.result, outcome.status = fn(), self.DONE
+        except Exception as e:
+            outcome.error, outcome.status = str(e), self.FAILED
+        if on_finish:
+            try:
+                on_finish(outcome)
+            except Exception as e:
+                logger.exception(f"Completion callback of job {job.job_id} failed.")
+                outcome.result, outcome.error, outcome.status = None, f"Job completion failed: {e}", self.FAILED
+        with self._condition:
+            job.result, job.error, job.status = outcome.result, outcome.error, outcome.status
+            job.finished_at = time.monotonic()
+            self._pending -= 1
+            self._condition.notify_all()
+        self._spool(job)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Return a job by id, or None if it is unknown or expired."""
+        with self._condition:
+            self._purge_expired()
+            job = self._jobs.get(job_id)
+        return job if job is not None else self._load_spooled(job_id)
+
+    def wait(self, job_id: str, timeout: float) -> Optional[Job]:
+        """Long-poll a job: block until it finishes or `timeout` seconds pass.
+        Args:
+            job_id (str): The job id.
+            timeout (float): Maximum number of seconds to wait.
+        Returns:
+            Optional[Job]: The job (finished or not), or None if it is unknown or expired.
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            self._purge_expired()
+            job = self._jobs.get(job_id)
+            if job is not None:
+                while not job.finished:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                return job
+
+        # Job submitted to another process: poll the spool directory.
+        job = self._load_spooled(job_id)
+        while job is not None and not job.finished:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(0.2, remaining))
+            job = self._load_spooled(job_id)
+        return job
+
+    @property
+    def pending(self) -> int:
+        """Number of queued or running jobs."""
+        return self._pending
+
+    def _purge_expired(self):
+        """Forget finished jobs older than the TTL. Must be called with the condition held."""
+        now = time.monotonic()
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished and now - job.finished_at > self.result_ttl_seconds
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+            if self.spool_directory:
+                for path in self._spool_paths(job_id):
+                    path.unlink(missing_ok=True)
+
+    def _spool_paths(self, job_id: str):
+        return self.spool_directory / f"{job_id}.json", self.spool_directory / f"{job_id}.bin"
+
+    def _write_atomically(self, path: Path, data: bytes):
+        fd, tmp_path = tempfile.mkstemp(dir=self.spool_directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+
+    def _spool(self, job: Job):
+        """Write the state of a job, and its result once done, to the spool directory."""
+        if not self.spool_directory:
+            return
+        state_path, result_path = self._spool_paths(job.job_id)
+        try:
+            if job.result is not None:
+                self._write_atomically(result_path, job.result)
+            state = {"status": job.status, "error": job.error, "pid": os.getpid()}
+            self._write_atomically(state_path, json.dumps(state).encode())
+        except OSError as e:
+            logger.error(f"Failed to spool job {job.job_id}: {e}")
+
+    def _load_spooled(self, job_id: str) -> Optional[Job]:
+        """Read a job from the spool directory, or None if it is unknown or expired."""
+        if not self.spool_directory or not _JOB_ID_PATTERN.match(job_id or ""):
+            return None
+        job = self._load_spooled_state(job_id)
+        if job is not None and job.status == self.DONE:
+            try:
+                job.result = self._spool_paths(job_id)[1].read_bytes()
+            except OSError:
+                return None
+        return job
+
+    def _load_spooled_state(self, job_id: str) -> Optional[Job]:
+        """Read the state of a spooled job, without its result. A job whose process exited before
+        it finished is failed. The files of an expired job are removed."""
+        state_path = self._spool_paths(job_id)[0]
+        try:
+            state = json.loads(state_path.read_bytes())
+            job = Job(job_id)
+            job.status, job.error = state["status"], state["error"]
+            if not job.finished and not _process_exists(state["pid"]):
+                job.status, job.error = self.FAILED, "The worker running the job exited."
+            if job.finished and time.time() - state_path.stat().st_mtime > self.result_ttl_seconds:
+                for path in self._spool_paths(job_id):
+                    path.unlink(missing_ok=True)
+                return None
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return job
+
+    def sweep_spool(self):
+        """Remove the spooled jobs that expired, whichever process ran them, and temporary files
+        left by interrupted writes."""
+        if not self.spool_directory:
+            return
+        try:
+            paths = [path for path in self.spool_directory.iterdir() if path.is_file()]
+        except OSError as e:
+            logger.error(f"Failed to sweep the job spool {self.spool_directory}: {e}")
+            return
+        now = time.time()
+        for path in paths:
+            try:
+                if _SPOOL_FILE_PATTERN.match(path.name) and path.suffix == ".json":
+                    self._load_spooled_state(path.stem)
+                elif path.suffix in (".tmp", ".bin") and not path.with_suffix(".json").exists():
+                    # Interrupted write, or result whose state was never written.
+                    if now - path.stat().st_mtime > self.result_ttl_seconds:
+                        path.unlink(missing_ok=True)
+            except OSError:
+                continue
+
+    def _maybe_sweep(self):
+        """Sweep the spool directory at most every `SWEEP_INTERVAL_SECONDS` (or TTL, if shorter)."""
+        if not self.spool_directory:
+            return
+        with self._condition:
+            now = time.monotonic()
+            if now < self._next_sweep:
+                return
+            self._next_sweep = now + min(self.result_ttl_seconds, SWEEP_INTERVAL_SECONDS)
+        self.sweep_spool()
+
+    def shutdown(self, wait: bool = True):
+        """Stop accepting jobs and, optionally, wait for the running ones."""
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,158 @@
+"""
+Cached derivation of the single-use key addresses of an account xPub.
+
+Parsing the xPub and deriving a change node are done once, and every address derived is
+remembered with its BIP44 position, so checking whether a key belongs to the validation
+window is a dict probe.
+
+The window of each change chain slides, wallet gap-limit style, above the highest index
+consumed on it. A background thread derives the addresses of the window, and `lookahead`
+indexes past its end, as soon as the window moves, so validations do not derive addresses:
+a validation that outruns the thread waits for it. Addresses that fall below the window are
+forgotten.
+"""
+
+from typing import Dict, Optional, Tuple
+import os
+import threading
+from bip_utils import Bip44, Bip44Changes, Bip44Coins
+
+Position = Tuple[int, int]
+Window = Tuple[int, int]
+
+_THREAD_START_LOCK = threading.Lock()
+
+
+class DerivationIndex:
+    """
+    Addresses derived from an account xPub, indexed by address.
+    Attributes:
+        lookahead (int): Indexes derived in the background past the end of each window.
+        derived (Dict[int, int]): End of the derived indexes of each change chain (from the start of its window).
+    """
+    def __init__(self, xpub: str, coin: Bip44Coins = Bip44Coins.BITCOIN_TESTNET, lookahead: int = 0):
+        """
+        Args:
+            xpub (str): The account extended public key.
+            coin (Bip44Coins): The coin the addresses are encoded for.
+            lookahead (int): Indexes derived in the background past the end of each window.
+        Raises:
+            Exception: If the xPub cannot be parsed (from bip_utils).
+        """
+        account = Bip44.FromExtendedKey(xpub, coin)
+        self._change_nodes = {int(change): account.Change(change) for change in (Bip44Changes.CHAIN_EXT, Bip44Changes.CHAIN_INT)}
+        self.lookahead = lookahead
+        self._positions: Dict[str, Position] = {}
+        self._addresses: Dict[int, Dict[int, str]] = {change: {} for change in self._change_nodes}
+        self._start = {change: 0 for change in self._change_nodes}
+        self.derived: Dict[int, int] = {change: 0 for change in self._change_nodes}
+        self._target = {change: 0 for change in self._change_nodes}
+        self._thread = None
+        self._pid = None
+        self._thread_pid = None
+
+    def address(self, change: int, index: int) -> str:
+        """Derive the address at a position (from the cached change node)."""
+        return self._change_nodes[int(change)].AddressIndex(index).PublicKey().ToAddress()
+
+    def _extend(self, change: int, end: int):
+        """Derive the addresses of a chain up to index `end` (excluded). The lock is only held to
+        claim and store each address, so lookups are not blocked by the derivations."""
+        while True:
+            with self._lock:
+                index = self.derived[change]
+                if index >= end:
+                    return
+            address = self.address(change, index)
+            with self._lock:
+                if self.derived[change] == index:  # Not derived meanwhile by another thread, nor below the window.
+                    self._addresses[change][index] = address
+                    self._positions[address] = (change, index)
+                    self.derived[change] = index + 1
+                    self._progress.notify_all()
+
+    def _slide(self, windows: Dict[int, Window]):
+        """Forget the addresses below the windows and set the background derivation targets. Called with the lock held."""
+        for change, (start, end) in windows.items():
+            addresses = self._addresses[change]
+            if start > self._start[change]:
+                for index in range(self._start[change], min(start, self.derived[change])):
+                    self._positions.pop(addresses.pop(index, None), None)
+                self._start[change] = start
+                self.derived[change] = max(self.derived[change], start)
+            self._target[change] = max(self._target[change], end + self.lookahead)
+        self._wake.notify()
+
+    def prefetch(self, windows: Dict[int, Window]):
+        """Move the windows and let the background thread derive them.
+        Args:
+            windows (Dict[int, Window]): The [start, end) window of each change chain.
+        """
+        self._ensure_thread()
+        with self._lock:
+            self._slide(windows)
+
+    def derive(self, windows: Dict[int, Window]):
+        """Move the windows and derive them (and the look-ahead) in the calling thread, without starting
+        the background thread: e.g. in a process that forks workers, which inherit the derived addresses."""
+        self._ensure_lock()
+        with self._lock:
+            self._slide(windows)
+        for change, (start, end) in windows.items():
+            self._extend(change, end + self.lookahead)
+
+    def lookup(self, address: str, windows: Dict[int, Window]) -> Optional[Position]:
+        """Find the position of an address in the windows of the change chains.
+        Waits for the background thread if it has not derived the windows yet.
+        Args:
+            address (str): The address.
+            windows (Dict[int, Window]): The [start, end) window of each change chain.
+        Returns:
+            Optional[Position]: The (change, index) of the address, or None if it is not in a window.
+        Raises:
+            RuntimeError: If the background thread stopped.
+        """
+        self.prefetch(windows)
+        with self._lock:
+            while any(self.derived[change] < end for change, (start, end) in windows.items()):
+                if not self._thread.is_alive():
+                    raise RuntimeError("The key derivation thread stopped.")
+                self._progress.wait(timeout=1)
+            position = self._positions.get(address)
+        if position is None:
+            return None
+        start, end = windows.get(position[0], (0, 0))
+        return position if start <= position[1] < end else None
+
+    def _ensure_lock(self):
+        """Create the lock of this process (a lock held by another thread when the process forked stays held)."""
+        if self._pid == os.getpid():
+            return
+        with _THREAD_START_LOCK:
+            if self._pid == os.getpid():
+                return
+            self._lock = threading.Lock()
+            self._wake = threading.Condition(self._lock)
+            self._progress = threading.Condition(self._lock)
+            self._pid = os.getpid()
+
+    def _ensure_thread(self):
+        """Start the background derivation thread of this process (threads do not survive a fork)."""
+        self._ensure_lock()
+        if self._thread_pid == os.getpid():
+            return
+        with _THREAD_START_LOCK:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._derive_ahead, name="key-derivation", daemon=True)
+            self._thread.start()
+            self._thread_pid = os.getpid()
+
+    def _derive_ahead(self):
+        while True:
+            with self._lock:
+                while all(self.derived[change] >= self._target[change] for change in self._change_nodes):
+                    self._wake.wait()
+                change = min(self._change_nodes, key=lambda change: self.derived[change] - self._target[change])
+                target = self._target[change]
+            self._extend(change, target)
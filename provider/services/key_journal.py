@@ -0,0 +1,117 @@
+"""
+Append-only journal of consumed single-use keys.
+
+Consuming a key appends one line (its address, and the BIP44 position learned for it if
+any) to the journal instead of rewriting the whole list of used keys and of positions, so the cost of persisting a consumption does not grow with the
+history. The journal is replayed on top of the last snapshot (`used.json`) when the keys
+are loaded, and compacted into a new snapshot once it grows past a size threshold.
+
+Appends are made durable in groups: the journal is fsynced at most every
+`fsync_interval_seconds`, by a timer armed by the first append after a sync, so
+concurrent consumptions share one fsync. An interval of 0 fsyncs every append.
+"""
+
+from pathlib import Path
+from typing import List, Optional
+import os
+import threading
+
+
+class KeyJournal:
+    """
+    Journal of consumed keys, one record per line. Several processes append to the same
+    file (under the key files lock); each one keeps the `offset` up to which it has applied
+    the journal, and reads the records appended by the others from there.
+    Attributes:
+        path (Path): The journal file.
+        fsync_interval_seconds (float): Longest time an append waits to be fsynced.
+        offset (int): Bytes of the journal already applied by this process.
+    """
+    def __init__(self, path, fsync_interval_seconds: float = 0.01):
+        self.path = Path(path)
+        self.fsync_interval_seconds = fsync_interval_seconds
+        self.offset = 0
+        self._fd = None
+        self._dirty = False
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def _open(self) -> int:
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        return self._fd
+
+    def size(self) -> int:
+        try:
+            return self.path.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def read_new(self) -> Optional[List[str]]:
+        """Read the records appended since `offset` and move past them.
+        A last line without its newline (an append in progress, or cut by a crash) is left for later.
+        Returns:
+            Optional[List[str]]: The new records, or None if the journal is shorter than `offset`
+                (it was compacted: reload the snapshot and read the journal from 0).
+        """
+        size = self.size()
+        if size < self.offset:
+            return None
+        if size == self.offset:
+            return []
+        with open(self.path, "rb") as journal:
+            journal.seek(self.offset)
+            data = journal.read(size - self.offset)
+        complete = data[:data.rfind(b"\n") + 1]
+        self.offset += len(complete)
+        return [line for line in complete.decode("utf-8", errors="replace").split("\n") if line]
+
+    def append(self, keys: List[str]):
+        """Append records of consumed keys. Must be called with the key files lock held, after `read_new`."""
+        if not keys:
+            return
+        data = "".join(f"{key}\n" for key in keys).encode("utf-8")
+        fd = self._open()
+        size = os.fstat(fd).st_size
+        if size and os.pread(fd, 1, size - 1) != b"\n":
+            data = b"\n" + data  # Terminate a line cut by a crash rather than extending it.
+        written = 0
+        while written < len(data):
+            written += os.write(fd, data[written:])
+        if self.offset == size:
+            self.offset = size + len(data)
+        self._schedule_sync()
+
+    def _schedule_sync(self):
+        if self.fsync_interval_seconds <= 0:
+            os.fsync(self._fd)
+            return
+        with self._lock:
+            self._dirty = True
+            if self._timer is None:
+                self._timer = threading.Timer(self.fsync_interval_seconds, self.sync)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def sync(self):
+        """Fsync the appends made since the last sync."""
+        with self._lock:
+            self._timer = None
+            if self._dirty and self._fd is not None:
+                os.fsync(self._fd)
+            self._dirty = False
+
+    def truncate(self):
+        """Empty the journal after its records were saved in a snapshot. Must be called with the key files lock held."""
+        fd = self._open()
+        os.ftruncate(fd, 0)
+        os.fsync(fd)
+        with self._lock:
+            self._dirty = False
+        self.offset = 0
+
+    def close(self):
+        self.sync()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
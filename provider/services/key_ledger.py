@@ -0,0 +1,115 @@
+"""
+Indexed in-memory ledger of the single-use keys of a service.
+
+The valid and used keys are kept in insertion-ordered dicts keyed by address, so looking a
+key up and consuming it are O(1) while the order of the key files is preserved. Each address
+maps to its BIP44 position (change, index) when known: keys generated from the account xPub
+and keys validated by derivation know theirs, keys loaded from older key files may not.
+The highest consumed index of each change chain is tracked, for the validation window.
+"""
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+Position = Tuple[int, int]
+
+
+class KeyLedger:
+    """
+    Valid and used single-use keys, indexed by address.
+    Attributes:
+        valid (Dict[str, Optional[Position]]): Keys that may still pay for a prediction, in file order.
+        used (Dict[str, Optional[Position]]): Consumed keys, in consumption order.
+        positions_changed (bool): Whether positions were learned since `mark_positions_saved`.
+    """
+    def __init__(self):
+        self.valid: Dict[str, Optional[Position]] = {}
+        self.used: Dict[str, Optional[Position]] = {}
+        self._positions: Dict[str, Position] = {}
+        self._highest_used: Dict[int, int] = {}
+        self.positions_changed = False
+
+    def load(self, valid_keys: Optional[List[str]] = None, used_keys: Optional[List[str]] = None,
+             positions: Optional[Dict[str, Position]] = None):
+        """Replace the valid keys, the used keys and/or the known positions (those given)."""
+        if positions is not None:
+            self._positions = {address: tuple(position) for address, position in positions.items()}
+            self.positions_changed = False
+        self.valid = {key: self._positions.get(key) for key in (self.valid if valid_keys is None else valid_keys)}
+        self.used = {key: self._positions.get(key) for key in (self.used if used_keys is None else used_keys)}
+        self._highest_used = {}
+        for position in self.used.values():
+            self._track_used(position)
+
+    def _track_used(self, position: Optional[Position]):
+        if position is not None and position[1] > self._highest_used.get(position[0], -1):
+            self._highest_used[position[0]] = position[1]
+
+    @property
+    def valid_keys(self) -> List[str]:
+        return list(self.valid)
+
+    @property
+    def used_keys(self) -> List[str]:
+        return list(self.used)
+
+    @property
+    def positions(self) -> Dict[str, Position]:
+        """Known BIP44 positions by address."""
+        return dict(self._positions)
+
+    def is_valid(self, key: str) -> bool:
+        return key in self.valid
+
+    def is_used(self, key: str) -> bool:
+        return key in self.used
+
+    def position(self, key: str) -> Optional[Position]:
+        """BIP44 (change, index) of a key, if known."""
+        return self._positions.get(key)
+
+    def learn_position(self, key: str, position: Position):
+        """Record the BIP44 position of a key (e.g. found by derivation)."""
+        position = tuple(position)
+        if self._positions.get(key) != position:
+            self._positions[key] = position
+            self.positions_changed = True
+            for keys in (self.valid, self.used):
+                if key in keys:
+                    keys[key] = position
+            if key in self.used:
+                self._track_used(position)
+
+    def add_valid(self, keys: Iterable[Tuple[str, Optional[Position]]]):
+        """Append generated keys, with their positions, to the valid keys."""
+        for key, position in keys:
+            if position is not None:
+                self.learn_position(key, position)
+            if key not in self.used:
+                self.valid[key] = self._positions.get(key)
+
+    def consume(self, keys: Iterable[str]) -> bool:
+        """Move keys to the used keys (keys validated by derivation may not be in the valid keys).
+        Returns:
+            bool: Whether any of them was in the valid keys.
+        """
+        removed_valid = False
+        for key in keys:
+            if key in self.valid:
+                del self.valid[key]
+                removed_valid = True
+            if key not in self.used:
+                self.used[key] = self._positions.get(key)
+                self._track_used(self.used[key])
+        return removed_valid
+
+    def mark_positions_saved(self):
+        self.positions_changed = False
+
+    def highest_used_index(self, change: int) -> int:
+        """Highest index consumed on a change chain (among the keys whose position is known), or -1."""
+        return self._highest_used.get(change, -1)
+
+    def next_index(self, change: int, default: int = 0) -> int:
+        """Index following the highest known index on a change chain, or `default` if none is known."""
+        indexes = [index for chain, index in self._positions.values() if chain == change]
+        return max(indexes) + 1 if indexes else default
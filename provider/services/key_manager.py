@@ -1,11 +1,35 @@
+from contextlib import contextmanager
 from pathlib import Path
+import hashlib
 import json
 import configparser
-from typing import List, Optional
+import os
+import tempfile
+import threading
+from typing import Dict, List, Optional, Set, Tuple
 from bip_utils import (
     Bip39MnemonicGenerator, Bip39SeedGenerator, Bip44, Bip44Coins,
     Bip44Changes
 )
+from key_derivation import DerivationIndex
+from key_journal import KeyJournal
+from key_ledger import KeyLedger
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows: the key files are then only shared between threads.
+    fcntl = None
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
 
 class KeyManager:
     """
@@ -15,11 +39,25 @@ class KeyManager:
     The keys are stored in a specified directory, and the configuration is loaded from a file.
     The KeyManager ensures that the necessary directories exist and provides methods to generate,
     validate, and mark keys as used.
+    Several processes may serve the same service (e.g. pre-forked workers): the key files are
+    updated under an exclusive file lock, reloaded when another process changed them, and the
+    keys reserved by running predictions are published in a shared reservations file.
+    The keys are indexed in a `KeyLedger`, so validating and consuming a key does not scan the
+    key lists. The BIP44 position of each key, when known, is saved next to the key files.
+    Consumed keys are appended to a journal (`used.journal`) rather than rewriting `used.json`,
+    which is only a snapshot: the journal is replayed on top of it when the keys are loaded and
+    compacted into it once it exceeds `journal_compaction_bytes`. The positions learned by
+    derivation for consumed keys are journaled with them, and saved to `positions.json` at
+    compaction.
+    Addresses are derived through a `DerivationIndex`, which parses the xPub once and remembers
+    the addresses of the validation window, so validating an unknown key is a dict probe.
+    The window of each change chain slides above its highest consumed index (gap limit of
+    `crypto_validation_window_size`) and is derived ahead in the background.
     Attributes:
         config (configparser.ConfigParser): Configuration parser for key authentication.
         master_xpub (Optional[str]): The master xPub for the server.
-        valid_keys (List[str]): List of valid one-time keys.
-        used_keys (List[str]): List of used one-time keys.
+        ledger (KeyLedger): The valid and used one-time keys, indexed by address.
+        reserved_keys (Set[str]): Keys held by predictions that are still running in this process.
     """
     def __init__(self, service_name: str):
         """
@@ -31,10 +69,30 @@ class KeyManager:
         self.config = self._load_key_auth_config()
         self._load_config_parameters()
         self._ensure_keys_directory_exists()
+        keys_dir = Path(self.valid_keys_file).parent
+        self.lock_file = str(keys_dir / ".lock")
+        self.reserved_keys_file = str(keys_dir / "reserved.json")
+        self.key_positions_file = str(keys_dir / "positions.json")
+        self.journal = KeyJournal(keys_dir / "used.journal", self.journal_fsync_interval_ms / 1000)
         self.master_xpub: Optional[str] = None
-        self.valid_keys: List[str] = []
-        self.used_keys: List[str] = []
+        self.ledger = KeyLedger()
+        self.reserved_keys: Set[str] = set()
+        self._foreign_reserved_keys: Set[str] = set()
+        self._file_versions: Dict[str, Optional[tuple]] = {}
+        self._derivation: Optional[Tuple[str, DerivationIndex]] = None
+        self._lock = threading.RLock()
         self._initialize_service_state()
+        self._prefetch_derivation(background=False)
+
+    @property
+    def valid_keys(self) -> List[str]:
+        """Valid one-time keys, in the order of the key file (a copy)."""
+        return self.ledger.valid_keys
+
+    @property
+    def used_keys(self) -> List[str]:
+        """Used one-time keys, in the order they were consumed (a copy)."""
+        return self.ledger.used_keys
 
     def _load_key_auth_config(self) -> configparser.ConfigParser:
         """Create the configuration parser for key authentication."""
@@ -57,6 +115,9 @@ class KeyManager:
         self.crypto_validation_window_size = self.config.getint("server", "crypto_validation_window_size", fallback=200)
         self.default_account_index = self.config.getint("server", "default_account_index", fallback=0)
         self.max_index_to_check_crypto = self.config.getint("server", "max_index_to_check_crypto", fallback=1000)
+        self.crypto_lookahead_size = self.config.getint("server", "crypto_lookahead_size", fallback=50)
+        self.journal_fsync_interval_ms = self.config.getint("server", "journal_fsync_interval_ms", fallback=10)
+        self.journal_compaction_bytes = self.config.getint("server", "journal_compaction_bytes", fallback=1024 * 1024)
 
     def _ensure_keys_directory_exists(self):
         """Ensure the directory for keys exists.
@@ -108,35 +169,184 @@ class KeyManager:
         except (IOError, json.JSONDecodeError):
             return []
 
-    def _save_keys_to_file(self, keys_list: List[str], file_path: str) -> bool:
+    def _load_positions_from_file(self) -> Dict[str, Tuple[int, int]]:
+        """Load the BIP44 (change, index) of the keys, by address; empty if the file is missing or invalid."""
+        try:
+            with open(self.key_positions_file, 'r') as f:
+                positions = json.load(f)
+        except (IOError, json.JSONDecodeError):
+            return {}
+        if not isinstance(positions, dict):
+            return {}
+        return {address: tuple(position) for address, position in positions.items()
+                if isinstance(position, list) and len(position) == 2}
+
+    def _save_keys_to_file(self, keys_list, file_path: str, durable: bool = False) -> bool:
+        """Replace a key file atomically (a crash leaves the old or the new content).
+        Args:
+            keys_list: The JSON content.
+            file_path (str): The key file.
+            durable (bool): Fsync the content before replacing the file.
+        Returns:
+            bool: True if the file was saved.
+        """
         keys_path = Path(file_path)
         try:
-            with keys_path.open('w') as f:
-                json.dump(keys_list, f, indent=4)
+            fd, tmp_path = tempfile.mkstemp(dir=keys_path.parent, prefix=f".{keys_path.name}.", suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(keys_list, f, indent=4)
+                    if durable:
+                        f.flush()
+                        os.fsync(f.fileno())
+                os.replace(tmp_path, keys_path)
+            except BaseException:
+                Path(tmp_path).unlink(missing_ok=True)
+                raise
+            self._file_versions[file_path] = self._file_version(file_path)
             return True
         except IOError:
             return False
 
+    @staticmethod
+    def _file_version(file_path: str) -> Optional[tuple]:
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    @contextmanager
+    def _key_files_lock(self):
+        """Hold the in-process lock and an exclusive lock on the key files of the service."""
+        with self._lock:
+            with open(self.lock_file, 'a') as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _save_positions(self) -> bool:
+        """Save the known key positions if new ones were learned. Must be called with the key files lock held."""
+        if not self.ledger.positions_changed:
+            return True
+        positions = {address: list(position) for address, position in self.ledger.positions.items()}
+        if not self._save_keys_to_file(positions, self.key_positions_file):
+            return False
+        self.ledger.mark_positions_saved()
+        return True
+
+    def _file_changed(self, file_path: str) -> bool:
+        """Check whether a key file was changed by another process since it was last loaded or saved."""
+        version = self._file_version(file_path)
+        changed = file_path not in self._file_versions or version != self._file_versions[file_path]
+        self._file_versions[file_path] = version
+        return changed
+
+    def _refresh_keys_from_files(self):
+        """Reload the valid and used keys (and their positions) if another process changed their files,
+        and apply the keys consumed in the journal since it was last read.
+        Must be called with the key files lock held."""
+        positions = None
+        if self._file_changed(self.key_positions_file):
+            # Positions never change for an address: keep those learned here and not saved yet.
+            positions = {**self._load_positions_from_file(), **self.ledger.positions}
+        valid_keys = self._load_keys_from_file(self.valid_keys_file) if self._file_changed(self.valid_keys_file) else None
+        used_keys = None
+        journal_keys = None if self._file_changed(self.used_keys_file) else self.journal.read_new()
+        if journal_keys is None:
+            # New snapshot (compacted by another process): replay the whole journal on top of it.
+            used_keys = self._load_keys_from_file(self.used_keys_file)
+            self.journal.offset = 0
+            journal_keys = self.journal.read_new() or []
+        if positions is not None or valid_keys is not None or used_keys is not None:
+            changed = self.ledger.positions_changed
+            self.ledger.load(valid_keys, used_keys, positions)
+            self.ledger.positions_changed = changed
+        self._apply_journal(journal_keys)
+
+    def _journal_records(self, keys: List[str]) -> List[str]:
+        """Journal records of keys about to be consumed: the address, followed by its position when
+        it was learned by derivation (the positions of generated keys are saved with them)."""
+        records = []
+        for key in keys:
+            position = None if self.ledger.is_valid(key) else self.ledger.position(key)
+            records.append(f"{key} {position[0]} {position[1]}" if position else key)
+        return records
+
+    def _apply_journal(self, records: List[str]):
+        """Consume the keys of journal records, learning the positions they carry."""
+        keys = []
+        for record in records:
+            address, *position = record.split(" ")
+            if len(position) == 2:
+                try:
+                    self.ledger.learn_position(address, (int(position[0]), int(position[1])))
+                except ValueError:
+                    pass
+            keys.append(address)
+        self.ledger.consume(keys)
+
+    def _compact_journal(self) -> bool:
+        """Save the positions and the used keys as new snapshots and empty the journal.
+        Must be called with the key files lock held."""
+        self.journal.sync()
+        if not self._save_positions():
+            return False
+        if not self._save_keys_to_file(self.ledger.used_keys, self.used_keys_file, durable=True):
+            return False
+        self.journal.truncate()
+        return True
+
+    def _sync_reservations(self):
+        """Publish the keys reserved by this process and load those reserved by other live processes.
+        Must be called with the key files lock held."""
+        pid = os.getpid()
+        try:
+            with open(self.reserved_keys_file, 'r') as f:
+                reservations = json.load(f)
+        except (IOError, json.JSONDecodeError):
+            reservations = {}
+        if not isinstance(reservations, dict):
+            reservations = {}
+        foreign = {key: owner for key, owner in reservations.items() if owner != pid and _process_alive(owner)}
+        self._foreign_reserved_keys = set(foreign)
+        shared = {**foreign, **{key: pid for key in self.reserved_keys}}
+        if shared != reservations:
+            try:
+                with open(self.reserved_keys_file, 'w') as f:
+                    json.dump(shared, f)
+            except IOError:
+                pass
+
     def _initialize_service_state(self):
         """Initialize the service state by loading or generating the master xPub and keys."""
-        self.master_xpub = self._load_master_xpub()
-        if not self.master_xpub:
-            self.master_xpub = self._generate_and_save_master_xpub()
-
-        self.valid_keys = self._load_keys_from_file(self.valid_keys_file)
-        self.used_keys = self._load_keys_from_file(self.used_keys_file)
-
-        if not self.valid_keys and self.master_xpub:
-            start_idx = len(self.used_keys) if self.used_keys else 0
-            new_keys = self._generate_one_time_keys(
-                start_index=start_idx,
-                count=self.initial_key_batch_size,
-                change_level_bip44=Bip44Changes.CHAIN_EXT
-            )
-            if new_keys:
-                self.valid_keys.extend(new_keys)
-                self._save_keys_to_file(self.valid_keys, self.valid_keys_file)
-                self._save_keys_to_file(self.used_keys, self.used_keys_file)
+        with self._key_files_lock():
+            self.master_xpub = self._load_master_xpub()
+            if not self.master_xpub:
+                self.master_xpub = self._generate_and_save_master_xpub()
+
+            self._refresh_keys_from_files()
+            if self.journal.size() >= self.journal_compaction_bytes:
+                self._compact_journal()
+
+            if not self.ledger.valid and self.master_xpub:
+                start_idx = self.ledger.next_index(int(Bip44Changes.CHAIN_EXT), default=len(self.ledger.used))
+                new_keys = self._generate_one_time_keys(
+                    start_index=start_idx,
+                    count=self.initial_key_batch_size,
+                    change_level_bip44=Bip44Changes.CHAIN_EXT
+                )
+                if new_keys:
+                    change = int(Bip44Changes.CHAIN_EXT)
+                    self.ledger.add_valid((key, (change, start_idx + i)) for i, key in enumerate(new_keys))
+                    self._save_keys_to_file(self.ledger.valid_keys, self.valid_keys_file)
+                    if not Path(self.used_keys_file).exists():
+                        self._save_keys_to_file(self.ledger.used_keys, self.used_keys_file, durable=True)
+                    self._save_positions()
 
     def _generate_one_time_keys(self, start_index: int, count: int, change_level_bip44: Bip44Changes) -> List[str]:
         """
@@ -151,12 +361,9 @@ class KeyManager:
         if not self.master_xpub: return []
         keys = []
         try:
-            xpub_account_obj = Bip44.FromExtendedKey(self.master_xpub, Bip44Coins.BITCOIN_TESTNET)
-            change_node = xpub_account_obj.Change(change_level_bip44)
+            derivation = self._derivation_index()
             for i in range(count):
-                address_node = change_node.AddressIndex(start_index + i)
-                address = address_node.PublicKey().ToAddress()
-                keys.append(address)
+                keys.append(derivation.address(change_level_bip44, start_index + i))
         except Exception:
             return Exception("Failed to generate keys from master xPub.")
         return keys
@@ -172,13 +379,64 @@ class KeyManager:
         """
         if not self.master_xpub: return False
         try:
-            xpub_account_obj = Bip44.FromExtendedKey(self.master_xpub, Bip44Coins.BITCOIN_TESTNET)
-            change_node = xpub_account_obj.Change(change_level)
-            address_node = change_node.AddressIndex(key_index)
-            derived_address = address_node.PublicKey().ToAddress()
-            return derived_address == key_to_validate
+            return self._derivation_index().address(change_level, key_index) == key_to_validate
         except Exception: return False
 
+    def _derivation_index(self) -> DerivationIndex:
+        """The derivation index of the master xPub, built on first use (and again if the xPub changes)."""
+        if self._derivation is None or self._derivation[0] != self.master_xpub:
+            self._derivation = (self.master_xpub, DerivationIndex(
+                self.master_xpub, Bip44Coins.BITCOIN_TESTNET, lookahead=self.crypto_lookahead_size
+            ))
+        return self._derivation[1]
+
+    def _highest_used_index(self, change: int) -> int:
+        """Highest index consumed on a change chain, or -1."""
+        return self.ledger.highest_used_index(change)
+
+    def _validation_windows(self) -> Dict[int, Tuple[int, int]]:
+        """The [start, end) indexes checked by `validate_key_cryptographically` on each change chain.
+        A window ends `crypto_validation_window_size` indexes above the highest consumed index (the gap
+        limit) and spans at most `max_index_to_check_crypto` indexes, though never less than the gap."""
+        windows = {}
+        for change in (int(Bip44Changes.CHAIN_EXT), int(Bip44Changes.CHAIN_INT)):
+            highest_used = self._highest_used_index(change)
+            end = highest_used + 1 + self.crypto_validation_window_size
+            windows[change] = (max(0, min(highest_used + 1, end - self.max_index_to_check_crypto)), end)
+        return windows
+
+    def _prefetch_derivation(self, background: bool = True):
+        """Let the derivation index derive the current validation windows.
+        Args:
+            background (bool): Derive in the background thread; otherwise in the calling thread, without
+                starting the thread (at startup, which may be in a process that forks workers).
+        """
+        if not self.master_xpub: return
+        try:
+            derivation = self._derivation_index()
+            if background:
+                derivation.prefetch(self._validation_windows())
+            else:
+                derivation.derive(self._validation_windows())
+        except Exception:
+            pass
+
+    def key_account(self, key: str) -> Optional[str]:
+        """Identify the BIP44 account a single-use key derives from, for attributing usage.
+        The keys of a service all derive from its account xPub (m/44'/1'/account'), so the account
+        is identified by its index and a digest of that xPub ('<index>:<8 hex digits>'): a new xPub
+        is a new account even if it has the same index. Keys are not issued to identified clients
+        (the patient app takes them from the shared `valid.json`), so every key of a service has
+        the same account: usage is attributed per service and xPub, not per client.
+        Args:
+            key (str): A key accepted by `validate_key` or `reserve_keys`.
+        Returns:
+            Optional[str]: The account id, or None if the service has no xPub.
+        """
+        if not self.master_xpub:
+            return None
+        return f"{self.default_account_index}:{hashlib.sha256(self.master_xpub.encode('ascii')).hexdigest()[:8]}"
+
     def validate_key(self, key_to_validate: str) -> bool:
         """Validates a key against the valid keys list.
         Args:
@@ -186,30 +444,113 @@ class KeyManager:
         Returns:
             bool: True if the key is valid, False otherwise.
         """
-        if key_to_validate in self.used_keys:
+        if (self.ledger.is_used(key_to_validate) or key_to_validate in self.reserved_keys
+                or key_to_validate in self._foreign_reserved_keys):
             return False
-        elif key_to_validate in self.valid_keys:
+        elif self.ledger.is_valid(key_to_validate):
             return True
         elif self.master_xpub:
             return self.validate_key_cryptographically(key_to_validate)
 
+    def validate_keys(self, keys_to_validate: List[str]) -> List[bool]:
+        """Validates a batch of keys in one pass.
+        A key repeated inside the batch is only accepted at its first position,
+        since each single-use key may pay for exactly one prediction.
+        Args:
+            keys_to_validate (List[str]): The keys to validate.
+        Returns:
+            List[bool]: One validation result per key, in the same order.
+        """
+        seen = set()
+        results = []
+        for key in keys_to_validate:
+            if (key in seen or self.ledger.is_used(key) or key in self.reserved_keys
+                    or key in self._foreign_reserved_keys):
+                results.append(False)
+            elif self.ledger.is_valid(key):
+                results.append(True)
+            else:
+                results.append(bool(self.master_xpub) and self.validate_key_cryptographically(key))
+            seen.add(key)
+        return results
+
     def validate_key_cryptographically(self, key_to_validate: str) -> bool:
+        """Check whether a key derives from the master xPub within the validation windows,
+        and record its BIP44 position in the ledger if it does."""
         if not self.master_xpub: return False
-        for i in range(min(self.crypto_validation_window_size, self.max_index_to_check_crypto)):
-            if self._derive_and_check_key(Bip44Changes.CHAIN_EXT, i, key_to_validate): return True
-        for i in range(min(self.crypto_validation_window_size, self.max_index_to_check_crypto)):
-            if self._derive_and_check_key(Bip44Changes.CHAIN_INT, i, key_to_validate): return True
-        return False
+        try:
+            position = self._derivation_index().lookup(key_to_validate, self._validation_windows())
+        except Exception: return False
+        if position is None:
+            return False
+        self.ledger.learn_position(key_to_validate, position)
+        return True
+
+    def reserve_keys(self, keys: List[str]) -> List[bool]:
+        """Validates a batch of keys and, if all of them are valid, reserves them for a running prediction.
+        A reserved key is rejected by later validations until it is either marked as used
+        or released, so concurrent requests cannot spend the same key twice.
+        Args:
+            keys (List[str]): The keys to reserve.
+        Returns:
+            List[bool]: One validation result per key. The keys are only reserved if all are True.
+        """
+        with self._key_files_lock():
+            self._refresh_keys_from_files()
+            self._sync_reservations()
+            results = self.validate_keys(keys)
+            if all(results):
+                self.reserved_keys.update(keys)
+                self._sync_reservations()
+            return results
+
+    def release_keys(self, keys: List[str]):
+        """Releases reserved keys whose prediction did not complete, so they can be used again.
+        Args:
+            keys (List[str]): The keys to release.
+        """
+        with self._key_files_lock():
+            self.reserved_keys.difference_update(keys)
+            self._sync_reservations()
 
     def mark_key_as_used(self, key: str) -> bool:
-        key_was_in_valid = False
-        if key in self.valid_keys:
-            try: self.valid_keys.remove(key); key_was_in_valid = True
-            except ValueError: 
-                return False
-        if key not in self.used_keys: self.used_keys.append(key)
-        
-        saved_used = self._save_keys_to_file(self.used_keys, self.used_keys_file)
+        return self.mark_keys_as_used([key])
+
+    def mark_keys_as_used(self, keys: List[str]) -> bool:
+        """Marks a batch of keys as used, with one journal append for the whole batch.
+        Args:
+            keys (List[str]): The keys to mark as used.
+        Returns:
+            bool: True if the key files were saved successfully, False otherwise.
+        """
+        with self._key_files_lock():
+            self._refresh_keys_from_files()
+            saved = self._mark_keys_as_used(keys)
+            self._sync_reservations()
+        self._prefetch_derivation()
+        return saved
+
+    def _mark_keys_as_used(self, keys: List[str]) -> bool:
+        self.reserved_keys.difference_update(keys)
+        new_keys = [key for key in dict.fromkeys(keys) if not self.ledger.is_used(key)]
+        records = self._journal_records(new_keys)
+        key_was_in_valid = self.ledger.consume(new_keys)
+        try:
+            self.journal.append(records)
+            saved_used = True
+        except OSError:
+            saved_used = False
+
+        # valid.json only shrinks after its batch of `initial_key_batch_size` keys is generated, so
+        # this rewrite is bounded by the batch, not by the history; it stays current for the client
+        # handing the keys out (patient_app), which must not pick a consumed one.
         saved_valid = True
-        if key_was_in_valid: saved_valid = self._save_keys_to_file(self.valid_keys, self.valid_keys_file)
-        return saved_used and saved_valid
\ No newline at end of file
+        if key_was_in_valid: saved_valid = self._save_keys_to_file(self.ledger.valid_keys, self.valid_keys_file)
+        if saved_used and self.journal.size() >= self.journal_compaction_bytes:
+            saved_used = self._compact_journal()
+        return saved_used and saved_valid
+
+    def close(self):
+        """Fsync and close the journal of consumed keys (e.g. before the process exits), so that
+        no key consumed in the last `journal_fsync_interval_ms` is lost on a crash of the host."""
+        self.journal.close()
@@ -0,0 +1,442 @@
+"""
+Minimal metrics registry rendered in the Prometheus text exposition format.
+
+Counters, gauges and histograms are kept per label set in memory. One registry can be
+shared by several services (the model host), which tell their series apart with a
+`service` label.
+
+Processes serving the same services (pre-forked workers) share a registry `directory`:
+each one writes a snapshot of its metrics there, at most `flush_interval_seconds` after
+they change, and a scrape served by any of them renders the sum of the snapshots. The
+counters and histograms of exited workers are kept, their gauges dropped. Sharing needs
+`fcntl` (POSIX, like pre-forking): elsewhere the directory is ignored and each process
+renders its own metrics.
+"""
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Optional, Tuple
+import bisect
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+import weakref
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows: metrics are then only rendered per process.
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(12))  # 1 KiB ... 4 GiB
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: Iterable[Tuple[str, str]] = ()) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._on_change: Callable[[], None] = lambda: None
+
+    def _key(self, labels: Dict) -> Tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield from self._samples()
+
+    def _samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def _snapshot(self) -> list:
+        """The [label values, value] pairs of this process, for the registry directory."""
+        raise NotImplementedError
+
+    def _reset(self):
+        """Forget the values inherited from the parent process, after a fork."""
+        self._lock = threading.Lock()
+        for values in (getattr(self, "_values", None), getattr(self, "_series", None)):
+            if values is not None:
+                values.clear()
+
+    def _merge(self, samples: list, alive: bool):
+        """Add the samples of a snapshot (of a process that exited unless `alive`)."""
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Monotonically increasing count, e.g. of errors."""
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        self._on_change()
+
+    def _samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+    def _snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def _merge(self, samples, alive):
+        for key, value in samples:
+            self._values[tuple(key)] = self._values.get(tuple(key), 0) + value
+
+
+class Gauge(_Metric):
+    """Value that goes up and down, e.g. requests in flight. It can also be read from a callback."""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple, float] = {}
+        self._functions: Dict[Tuple, Callable[[], float]] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        self._on_change()
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+        self._on_change()
+
+    def set_function(self, function: Callable[[], float], **labels):
+        """Read the value of this label set from `function` at each scrape."""
+        key = self._key(labels)
+        with self._lock:
+            self._functions[key] = function
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, function in functions.items():
+            values[key] = function()
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+    def _snapshot(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, function in functions.items():
+            values[key] = function()
+        return [[list(key), value] for key, value in values.items()]
+
+    def _merge(self, samples, alive):
+        if alive:
+            for key, value in samples:
+                self._values[tuple(key)] = self._values.get(tuple(key), 0) + value
+
+
+class Histogram(_Metric):
+    """Distribution of observations (durations, sizes) in cumulative buckets."""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._series: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+        self._on_change()
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        with self._lock:
+            series = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._series.items())
+        for key, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+    def _snapshot(self):
+        with self._lock:
+            return [[list(key), [list(counts), total, count]] for key, (counts, total, count) in self._series.items()]
+
+    def _merge(self, samples, alive):
+        for key, (counts, total, count) in samples:
+            series = self._series.setdefault(tuple(key), [[0] * len(self.buckets), 0.0, 0])
+            series[0] = [a + b for a, b in zip(series[0], counts)]
+            series[1] += total
+            series[2] += count
+
+
+class MetricsRegistry:
+    """
+    Holds metrics by name. Asking twice for the same name returns the same metric, so
+    services sharing a registry share the metric families.
+    Attributes:
+        directory (Optional[Path]): Directory shared with the other processes, if any.
+        flush_interval_seconds (float): Longest time a change stays out of this process's snapshot.
+    """
+    _KINDS = {"counter": Counter, "gauge": Gauge, "histogram": Histogram}
+
+    def __init__(self, directory=None, flush_interval_seconds: float = 1.0):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+        self.directory = Path(directory) if directory else None
+        if self.directory and fcntl is None:
+            logger.warning(f"Metrics are not shared through {self.directory}: file locks are not available on this platform.")
+            self.directory = None
+        self.flush_interval_seconds = flush_interval_seconds
+        self._timer: Optional[threading.Timer] = None
+        self._timer_pid: Optional[int] = None
+        if self.directory:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            # A forked worker starts from zero: the values of its parent are in the parent's snapshot.
+            forked = weakref.WeakMethod(self._forked)
+            os.register_at_fork(after_in_child=lambda: forked() and forked()())
+
+    def _get_or_create(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+                if self.directory:
+                    metric._on_change = self._schedule_flush
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} is already registered with another type or labels.")
+            return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self) -> bytes:
+        """Render every metric in the Prometheus text exposition format (summed over the
+        processes sharing the registry directory, if any)."""
+        registry = self._merged() if self.directory else self
+        with registry._lock:
+            metrics = sorted(registry._metrics.values(), key=lambda m: m.name)
+        lines = [line for metric in metrics for line in metric.render()]
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+    def _forked(self):
+        self._lock = threading.Lock()
+        self._timer = None
+        for metric in self._metrics.values():
+            metric._reset()
+
+    def _schedule_flush(self):
+        """Write this process's snapshot `flush_interval_seconds` after its first unsaved change."""
+        with self._lock:
+            if self._timer is not None and self._timer_pid == os.getpid():
+                return
+            self._timer = threading.Timer(self.flush_interval_seconds, self.flush)
+            self._timer.daemon = True
+            self._timer_pid = os.getpid()
+        self._timer.start()
+
+    def flush(self):
+        """Write the snapshot of this process's metrics to the registry directory."""
+        if not self.directory:
+            return
+        with self._lock:
+            self._timer = None
+        self._write_snapshot(self.directory / f"{os.getpid()}.json", self._snapshot())
+
+    def _snapshot(self) -> dict:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {
+            metric.name: {
+                "kind": metric.kind, "documentation": metric.documentation, "labelnames": metric.labelnames,
+                **({"buckets": metric.buckets[:-1]} if isinstance(metric, Histogram) else {}),
+                "samples": metric._snapshot()
+            }
+            for metric in metrics
+        }
+
+    def _write_snapshot(self, path: Path, snapshot: dict):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            Path(tmp_path).unlink(missing_ok=True)
+            logger.error(f"Failed to write the metrics snapshot {path}: {e}")
+
+    @staticmethod
+    def _read_snapshot(path: Path) -> dict:
+        try:
+            return json.loads(path.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _merged(self) -> "MetricsRegistry":
+        """Sum the snapshots of the processes sharing the directory, this one's written first.
+        The snapshots of exited processes are folded into `exited.json` (without their gauges)."""
+        self.flush()
+        exited_path = self.directory / "exited.json"
+        with open(self.directory / ".lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                exited = MetricsRegistry()
+                self._merge_snapshot(exited, self._read_snapshot(exited_path), alive=False)
+                snapshots, exited_paths = [], []
+                for path in self.directory.glob("[0-9]*.json"):
+                    snapshot = self._read_snapshot(path)
+                    if int(path.stem) == os.getpid() or _process_alive(int(path.stem)):
+                        snapshots.append(snapshot)
+                    else:
+                        self._merge_snapshot(exited, snapshot, alive=False)
+                        exited_paths.append(path)
+                if exited_paths:
+                    self._write_snapshot(exited_path, exited._snapshot())
+                    for path in exited_paths:
+                        path.unlink(missing_ok=True)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        merged = exited
+        for snapshot in snapshots:
+            self._merge_snapshot(merged, snapshot, alive=True)
+        return merged
+
+    def _merge_snapshot(self, registry: "MetricsRegistry", snapshot: dict, alive: bool):
+        for name, family in snapshot.items():
+            cls = self._KINDS.get(family.get("kind"))
+            if cls is None:
+                continue
+            kwargs = {"buckets": family["buckets"]} if cls is Histogram else {}
+            try:
+                metric = registry._get_or_create(cls, name, family["documentation"], tuple(family["labelnames"]), **kwargs)
+                metric._merge(family["samples"], alive)
+            except (KeyError, ValueError, TypeError):
+                logger.warning(f"Skipping the inconsistent metric {name} of a snapshot.")
+
+
+class ServiceMetrics:
+    """
+    The metric families of one FHE service, with its `service` label bound.
+    Attributes:
+        service_name (str): Value of the `service` label.
+    """
+    def __init__(self, registry: MetricsRegistry, service_name: str):
+        self.registry = registry
+        self.service_name = service_name
+        self._stage_seconds = registry.histogram(
+            "fhe_stage_duration_seconds",
+            "Duration of the stages of prediction requests (parse, queue, validate_key, run, mark_used).",
+            ("service", "stage")
+        )
+        self._request_seconds = registry.histogram(
+            "fhe_request_duration_seconds", "Total duration of prediction and registration requests.",
+            ("service", "endpoint")
+        )
+        self._payload_bytes = registry.histogram(
+            "fhe_payload_bytes", "Size of uploaded parts (decoded) and of binary responses (as sent).",
+            ("service", "direction", "part"), buckets=SIZE_BUCKETS
+        )
+        self._in_flight = registry.gauge(
+            "fhe_requests_in_flight", "Prediction and registration requests being processed.", ("service", "endpoint")
+        )
+        self._errors = registry.counter(
+            "fhe_request_errors_total", "Prediction and registration requests answered with an error status.",
+            ("service", "endpoint", "status")
+        )
+
+    @contextmanager
+    def stage(self, stage: str):
+        """Time a stage of a prediction request."""
+        with self._stage_seconds.time(service=self.service_name, stage=stage):
+            yield
+
+    def observe_payload(self, direction: str, part: str, size: int):
+        """Record the size of an uploaded part ('request') or a response body ('response')."""
+        self._payload_bytes.observe(size, service=self.service_name, direction=direction, part=part)
+
+    def request_started(self, endpoint: str):
+        self._in_flight.inc(service=self.service_name, endpoint=endpoint)
+
+    def request_finished(self, endpoint: str, seconds: float, status_code: int):
+        self._in_flight.dec(service=self.service_name, endpoint=endpoint)
+        self._request_seconds.observe(seconds, service=self.service_name, endpoint=endpoint)
+        if status_code >= 400:
+            self._errors.inc(service=self.service_name, endpoint=endpoint, status=status_code)
+
+    def gauge_function(self, name: str, documentation: str, function: Callable[[], float]):
+        """Expose a value of the service read at each scrape, e.g. the admission queue depth."""
+        self.registry.gauge(name, documentation, ("service",)).set_function(function, service=self.service_name)
@@ -0,0 +1,98 @@
+"""
+Detection of retrained model artifacts, for reloading a service's model without a restart.
+
+The version of a model is a digest of its `server.zip`. `ModelWatcher` polls the
+artifact and calls back once it has changed and stopped changing (a copy in progress
+is not picked up half written).
+"""
+
+from typing import Callable, Optional, Tuple
+import hashlib
+import logging
+import os
+import signal
+import threading
+
+logger = logging.getLogger(__name__)
+
+SERVER_ARTIFACT = "server.zip"
+
+
+def model_version(fhe_directory) -> Optional[str]:
+    """Version of the model saved in `fhe_directory`: the first 16 hex digits of the SHA-256 of its server.zip.
+    Returns:
+        Optional[str]: The version, or None if there is no server.zip.
+    """
+    digest = hashlib.sha256()
+    try:
+        with open(os.path.join(fhe_directory, SERVER_ARTIFACT), "rb") as artifact:
+            for chunk in iter(lambda: artifact.read(1024 * 1024), b""):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()[:16]
+
+
+def _artifact_signature(fhe_directory) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(os.path.join(fhe_directory, SERVER_ARTIFACT))
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class ModelWatcher:
+    """
+    Polls the server.zip of a model directory and calls `on_change` from its thread when
+    the file was replaced. A change is reported once the file's size and modification time
+    are the same on two consecutive polls. The first signature seen is reported as well: the
+    callback compares model versions, which catches a file replaced before the watcher started.
+    Attributes:
+        fhe_directory (str): The watched model directory.
+        interval_seconds (float): Time between two polls.
+    """
+    def __init__(self, fhe_directory, interval_seconds: float, on_change: Callable[[], None]):
+        self.fhe_directory = fhe_directory
+        self.interval_seconds = interval_seconds
+        self.on_change = on_change
+        self._seen = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"model-watcher-{self.fhe_directory}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def poll(self, candidate=None):
+        """Check the artifact once.
+        Args:
+            candidate: Signature seen at the previous poll, if it differed from the loaded one.
+        Returns:
+            The new signature while the file is changing, to pass to the next poll.
+        """
+        signature = _artifact_signature(self.fhe_directory)
+        if signature is None or signature == self._seen:
+            return None
+        if signature != candidate:
+            return signature
+        self._seen = signature
+        try:
+            self.on_change()
+        except Exception:
+            logger.exception(f"Reloading the model from {self.fhe_directory} failed.")
+        return None
+
+    def _run(self):
+        candidate = None
+        while not self._stopped.wait(self.interval_seconds):
+            candidate = self.poll(candidate)
+
+
+def install_reload_signal(reload: Callable[[], None]):
+    """Run `reload` in a background thread on SIGHUP. Must be called from the main thread."""
+    if not hasattr(signal, "SIGHUP"):
+        return
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=reload, daemon=True).start())
@@ -0,0 +1,84 @@
+"""
+Content-encoding of FHE payloads (ciphertexts, evaluation keys and encrypted results).
+
+Request parts are compressed by the client and marked with a `Content-Encoding` part
+header. Responses are compressed according to the request's `Accept-Encoding`. `gzip` is
+always available; `zstd` is offered when the optional `zstandard` package is installed.
+"""
+
+import gzip
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from uploads import SpooledPart
+
+DEFAULT_LEVELS = {"zstd": 3, "gzip": 6}
+_CHUNK_SIZE = 64 * 1024
+_DECOMPRESSION_ERRORS = (OSError, EOFError, zlib.error) + ((zstandard.ZstdError,) if zstandard else ())
+
+
+def available_encodings():
+    """Encodings supported in this environment, in order of preference."""
+    return ["zstd", "gzip"] if zstandard else ["gzip"]
+
+
+def compress(data, encoding, level=None):
+    """Compress a payload.
+    Args:
+        data (bytes | memoryview): The payload.
+        encoding (str): 'zstd' or 'gzip'.
+        level (Optional[int]): Compression level, DEFAULT_LEVELS[encoding] when omitted.
+    Returns:
+        bytes: The compressed payload.
+    """
+    level = DEFAULT_LEVELS.get(encoding) if level is None else level
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    if encoding == "zstd" and zstandard:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    raise ValueError(f"Unsupported content encoding '{encoding}'")
+
+
+def _decompressing_reader(stream, encoding):
+    if encoding == "gzip":
+        return gzip.GzipFile(fileobj=stream, mode="rb")
+    if encoding == "zstd" and zstandard:
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+    raise ValueError(f"Unsupported content encoding '{encoding}'")
+
+
+def decompress_stream(stream, encoding, spool_threshold, max_size=None):
+    """Decompress an uploaded part into a SpooledPart, chunk by chunk.
+    The decompressed size is bounded by `max_size`, so a small compressed part cannot
+    expand beyond the upload limits.
+    Args:
+        stream: Readable stream of the compressed part.
+        encoding (str): 'zstd' or 'gzip'.
+        spool_threshold (int): Size from which the decompressed part is spooled to disk.
+        max_size (Optional[int]): Maximum decompressed size.
+    Returns:
+        SpooledPart: The decompressed part.
+    Raises:
+        ValueError: If the encoding is unsupported or the data is corrupt.
+        RequestEntityTooLarge: If the decompressed part exceeds `max_size`.
+    """
+    part = SpooledPart(spool_threshold, max_size)
+    reader = _decompressing_reader(stream, encoding)
+    try:
+        while True:
+            chunk = reader.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            part.write(chunk)
+    except _DECOMPRESSION_ERRORS as e:
+        part.close()
+        raise ValueError(f"Corrupt {encoding} data: {e}")
+    except BaseException:
+        part.close()
+        raise
+    part.seek(0)
+    return part
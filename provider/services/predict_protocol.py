@@ -0,0 +1,94 @@
+"""
+Compact binary encoding of a single prediction request, an alternative to multipart/form-data.
+
+Layout (integers big-endian):
+
+    magic      4 bytes   b"AGDP"
+    version    1 byte    1
+    u16 length + single-use key (UTF-8)
+    u16 length + evaluation keys id (ASCII, empty when the keys are inline)
+    u64 length + ciphertext
+    u64 length + evaluation keys (empty when an id is given)
+
+The parser returns memoryview slices of the body: the ciphertext and the keys are not copied.
+"""
+
+from typing import NamedTuple, Optional, Union
+import struct
+
+PREDICT_CONTENT_TYPE = "application/x-agedap-predict"
+MAGIC = b"AGDP"
+VERSION = 1
+
+_HEADER = struct.Struct(">4sB")
+_SHORT = struct.Struct(">H")
+_LONG = struct.Struct(">Q")
+
+
+class PredictRequest(NamedTuple):
+    single_use_key: str
+    evaluation_keys_id: Optional[str]
+    encrypted_data: memoryview
+    evaluation_keys: Optional[memoryview]
+
+
+def pack_predict_request(single_use_key: str, encrypted_data: bytes, evaluation_keys: Optional[bytes] = None,
+                         evaluation_keys_id: Optional[str] = None) -> bytes:
+    """Encode a prediction request. Exactly one of `evaluation_keys` and `evaluation_keys_id` is given.
+    Returns:
+        bytes: The request body.
+    """
+    if (evaluation_keys is None) == (evaluation_keys_id is None):
+        raise ValueError("Give either the evaluation keys or their id.")
+    key = single_use_key.encode("utf-8")
+    key_id = (evaluation_keys_id or "").encode("ascii")
+    evaluation_keys = evaluation_keys if evaluation_keys is not None else b""
+    return b"".join([
+        _HEADER.pack(MAGIC, VERSION),
+        _SHORT.pack(len(key)), key,
+        _SHORT.pack(len(key_id)), key_id,
+        _LONG.pack(len(encrypted_data)), encrypted_data,
+        _LONG.pack(len(evaluation_keys)), evaluation_keys,
+    ])
+
+
+def parse_predict_request(body: Union[bytes, memoryview]) -> PredictRequest:
+    """Decode a body produced by `pack_predict_request`, without copying the large fields.
+    Args:
+        body (bytes | memoryview): The request body.
+    Returns:
+        PredictRequest: The fields; `encrypted_data` and `evaluation_keys` are slices of `body`.
+    Raises:
+        ValueError: If the body is not a request of a supported version, is truncated or has trailing bytes.
+    """
+    view = memoryview(body)
+    if len(view) < _HEADER.size:
+        raise ValueError("Body too short for the protocol header.")
+    magic, version = _HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a prediction request (bad magic).")
+    if version != VERSION:
+        raise ValueError(f"Unsupported protocol version {version} (supported: {VERSION}).")
+    offset = _HEADER.size
+    fields = []
+    for length_format in (_SHORT, _SHORT, _LONG, _LONG):
+        if offset + length_format.size > len(view):
+            raise ValueError("Body truncated (missing field length).")
+        (length,) = length_format.unpack_from(view, offset)
+        offset += length_format.size
+        if offset + length > len(view):
+            raise ValueError("Body truncated (incomplete field).")
+        fields.append(view[offset:offset + length])
+        offset += length
+    if offset != len(view):
+        raise ValueError("Body has trailing bytes after the last field.")
+
+    key, key_id, encrypted_data, evaluation_keys = fields
+    try:
+        single_use_key = bytes(key).decode("utf-8").strip()
+        evaluation_keys_id = bytes(key_id).decode("ascii").strip() or None
+    except UnicodeDecodeError:
+        raise ValueError("Single-use key or evaluation keys id is not valid text.")
+    if (evaluation_keys_id is None) == (len(evaluation_keys) == 0):
+        raise ValueError("Give either the evaluation keys or their id.")
+    return PredictRequest(single_use_key, evaluation_keys_id, encrypted_data, evaluation_keys if len(evaluation_keys) else None)
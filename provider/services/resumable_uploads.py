@@ -0,0 +1,202 @@
+"""
+Resumable uploads of evaluation keys, for clients on connections that drop.
+
+An upload is created with its total size, its chunks are written at their offsets in any
+order (and possibly more than once), the ranges received so far can be queried to resume
+after a disconnection, and the finished upload is handed to the evaluation key store.
+
+Each upload is three files in the store's directory: `<id>.json` (size, digest, encoding),
+`<id>.part` (the data, written in place at each chunk's offset) and `<id>.ranges` (one
+'start end' line appended per stored chunk). A chunk is acknowledged only once its data is
+written, and appending a short line is atomic, so several processes (pre-forked workers)
+can take the chunks of the same upload.
+"""
+
+from pathlib import Path
+from typing import List, Optional, Tuple
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+
+_UPLOAD_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+class UploadError(Exception):
+    """A request on an upload cannot be served; `status` is the HTTP status to answer with."""
+    def __init__(self, message: str, status: int):
+        super().__init__(message)
+        self.status = status
+
+
+def merge_ranges(ranges) -> List[List[int]]:
+    """Merge overlapping and adjacent [start, end) ranges, in order."""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class ResumableUploadStore:
+    """
+    Uploads in progress, kept on disk until they are finished or expire.
+    Attributes:
+        directory (Path): Directory of the uploads.
+        max_upload_bytes (int): Largest accepted upload.
+        max_chunk_bytes (int): Largest accepted chunk.
+        expiry_seconds (float): Uploads without a chunk for this long are removed.
+    """
+    def __init__(self, directory, max_upload_bytes: int, max_chunk_bytes: int = 8 * 1024 * 1024,
+                 expiry_seconds: float = 24 * 3600):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_upload_bytes = max_upload_bytes
+        self.max_chunk_bytes = max_chunk_bytes
+        self.expiry_seconds = expiry_seconds
+
+    def _path(self, upload_id: str, suffix: str) -> Path:
+        return self.directory / f"{upload_id}{suffix}"
+
+    def _info(self, upload_id: str) -> dict:
+        if not upload_id or not _UPLOAD_ID_PATTERN.match(upload_id):
+            raise UploadError("Unknown upload.", 404)
+        try:
+            return json.loads(self._path(upload_id, ".json").read_text())
+        except FileNotFoundError:
+            raise UploadError("Unknown upload.", 404)
+
+    def create(self, size: int, sha256: Optional[str] = None, encoding: Optional[str] = None) -> str:
+        """Start an upload.
+        Args:
+            size (int): Total size of the uploaded bytes.
+            sha256 (Optional[str]): Hex digest of the uploaded bytes, checked when the upload is finished.
+            encoding (Optional[str]): Content encoding of the uploaded bytes ('gzip', 'zstd').
+        Returns:
+            str: The upload id.
+        Raises:
+            UploadError: If the size is not accepted (400, 413).
+        """
+        if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+            raise UploadError("'size' must be a positive integer.", 400)
+        if size > self.max_upload_bytes:
+            raise UploadError(f"Upload of {size} bytes over the limit of {self.max_upload_bytes} bytes.", 413)
+        if sha256 is not None and not re.match(r"^[0-9a-f]{64}$", str(sha256)):
+            raise UploadError("'sha256' must be a hex SHA-256 digest.", 400)
+        self.remove_expired()
+        upload_id = uuid.uuid4().hex
+        with open(self._path(upload_id, ".part"), "wb") as data:
+            data.truncate(size)
+        self._path(upload_id, ".ranges").touch()
+        info_path = self._path(upload_id, ".json")
+        temporary_path = self._path(upload_id, ".json.tmp")
+        temporary_path.write_text(json.dumps({"size": size, "sha256": sha256, "encoding": encoding, "created": time.time()}))
+        os.replace(temporary_path, info_path)
+        return upload_id
+
+    def write_chunk(self, upload_id: str, offset: int, chunk) -> dict:
+        """Store a chunk at its offset.
+        Args:
+            upload_id (str): The upload.
+            offset (int): Position of the chunk in the upload.
+            chunk (bytes | memoryview): The chunk.
+        Returns:
+            dict: The status of the upload (see `status`).
+        Raises:
+            UploadError: If the upload is unknown (404) or the chunk does not fit in it (400, 413).
+        """
+        info = self._info(upload_id)
+        if len(chunk) > self.max_chunk_bytes:
+            raise UploadError(f"Chunk of {len(chunk)} bytes over the limit of {self.max_chunk_bytes} bytes.", 413)
+        if offset < 0 or offset + len(chunk) > info["size"]:
+            raise UploadError(f"Chunk {offset}-{offset + len(chunk)} outside the upload of {info['size']} bytes.", 400)
+        if len(chunk):
+            chunk = memoryview(chunk)
+            fd = os.open(self._path(upload_id, ".part"), os.O_WRONLY)
+            try:
+                written = 0
+                while written < len(chunk):
+                    written += os.pwrite(fd, chunk[written:], offset + written)
+            finally:
+                os.close(fd)
+            fd = os.open(self._path(upload_id, ".ranges"), os.O_WRONLY | os.O_APPEND)
+            try:
+                os.write(fd, f"{offset} {offset + len(chunk)}\n".encode("ascii"))
+            finally:
+                os.close(fd)
+        return self._status(upload_id, info)
+
+    def status(self, upload_id: str) -> dict:
+        """Get the progress of an upload.
+        Returns:
+            dict: 'upload_id', 'size', the merged 'received' [start, end) ranges, 'next_offset'
+                (end of the received prefix, where a sequential client resumes) and 'complete'.
+        Raises:
+            UploadError: If the upload is unknown (404).
+        """
+        return self._status(upload_id, self._info(upload_id))
+
+    def _status(self, upload_id: str, info: dict) -> dict:
+        received = merge_ranges(self._received(upload_id))
+        next_offset = received[0][1] if received and received[0][0] == 0 else 0
+        return {
+            "upload_id": upload_id,
+            "size": info["size"],
+            "received": received,
+            "next_offset": next_offset,
+            "complete": next_offset == info["size"],
+        }
+
+    def _received(self, upload_id: str) -> List[Tuple[int, int]]:
+        try:
+            lines = self._path(upload_id, ".ranges").read_text().splitlines()
+        except FileNotFoundError:
+            raise UploadError("Unknown upload.", 404)
+        return [tuple(int(field) for field in line.split()) for line in lines if line]
+
+    def finish(self, upload_id: str) -> Tuple[Path, dict]:
+        """Check that an upload is complete and matches its digest.
+        Args:
+            upload_id (str): The upload.
+        Returns:
+            Tuple[Path, dict]: The file of the uploaded bytes and the upload's info ('size', 'sha256', 'encoding').
+                The caller consumes the file and then calls `remove`.
+        Raises:
+            UploadError: If the upload is unknown (404), incomplete (409) or does not match its digest (400,
+                and the upload is removed).
+        """
+        info = self._info(upload_id)
+        status = self._status(upload_id, info)
+        if not status["complete"]:
+            raise UploadError(f"Upload incomplete: {status['next_offset']} of {info['size']} bytes received.", 409)
+        path = self._path(upload_id, ".part")
+        if info.get("sha256"):
+            digest = hashlib.sha256()
+            with open(path, "rb") as data:
+                for block in iter(lambda: data.read(1024 * 1024), b""):
+                    digest.update(block)
+            if digest.hexdigest() != info["sha256"]:
+                self.remove(upload_id)
+                raise UploadError("Uploaded bytes do not match the announced SHA-256.", 400)
+        return path, info
+
+    def remove(self, upload_id: str):
+        """Delete the files of an upload."""
+        for suffix in (".json", ".ranges", ".part"):
+            self._path(upload_id, suffix).unlink(missing_ok=True)
+
+    def remove_expired(self):
+        """Delete the uploads that received nothing for `expiry_seconds`."""
+        deadline = time.time() - self.expiry_seconds
+        for info_path in self.directory.glob("*.json"):
+            upload_id = info_path.stem
+            try:
+                last_activity = max(self._path(upload_id, suffix).stat().st_mtime for suffix in (".json", ".ranges"))
+            except FileNotFoundError:
+                continue
+            if last_activity < deadline:
+                self.remove(upload_id)
@@ -0,0 +1,243 @@
+"""
+Slow-request profiler.
+
+While a prediction runs, a background thread samples the stack of the thread serving it.
+If the request ends up slower than the configured threshold, its sampled stacks, the
+duration of each of its stages and the sizes of its payloads are written to a bounded
+on-disk ring buffer (`SlowRequestLog`); otherwise the samples are dropped.
+
+The log is read with the command line of this module:
+
+    python provider/services/slow_requests.py list
+    python provider/services/slow_requests.py show <id>
+    python provider/services/slow_requests.py folded <id> > stacks.txt   # flamegraph.pl, speedscope
+"""
+
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+DEFAULT_LOG_DIRECTORY = Path(__file__).resolve().parent.parent.parent / "slow_requests"
+MAX_STACKS = 200
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+class RequestProfile:
+    """
+    What is recorded about one request: sampled stacks, stage durations and payload sizes.
+    Attributes:
+        started_at (float): `time.perf_counter()` at the start of the request.
+        stacks (Counter): Number of samples per stack, in folded form ('outer;...;inner').
+        stages (Dict[str, float]): Seconds spent in each stage.
+        payloads (List[dict]): Size of each uploaded part and response body.
+    """
+    def __init__(self, thread_id: int):
+        self.thread_id = thread_id
+        self.started_at = time.perf_counter()
+        self.stacks = Counter()
+        self.stages: Dict[str, float] = {}
+        self.payloads: List[dict] = []
+
+    def add_stage(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_payload(self, direction: str, part: str, size: int):
+        self.payloads.append({"direction": direction, "part": part, "bytes": size})
+
+    @property
+    def samples(self) -> int:
+        return sum(self.stacks.values())
+
+
+class StackSampler:
+    """
+    Samples the stacks of the threads serving profiled requests from a single background
+    thread, every `interval_seconds`. The thread exits when no request is profiled, so an
+    idle process has no extra thread (the pre-fork master forks its workers from it).
+    """
+    def __init__(self, interval_seconds: float = 0.01, max_depth: int = 64):
+        self.interval_seconds = interval_seconds
+        self.max_depth = max_depth
+        self._profiles: Dict[int, RequestProfile] = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self) -> RequestProfile:
+        """Start profiling the calling thread."""
+        profile = RequestProfile(threading.get_ident())
+        with self._lock:
+            self._profiles[profile.thread_id] = profile
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="slow-request-sampler", daemon=True)
+                self._thread.start()
+        return profile
+
+    def stop(self, profile: RequestProfile):
+        """Stop sampling the thread of `profile`."""
+        with self._lock:
+            if self._profiles.get(profile.thread_id) is profile:
+                del self._profiles[profile.thread_id]
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._profiles:
+                    self._thread = None
+                    return
+            time.sleep(self.interval_seconds)
+            frames = sys._current_frames()
+            with self._lock:
+                profiles = list(self._profiles.values())
+            for profile in profiles:
+                frame = frames.get(profile.thread_id)
+                if frame is not None:
+                    profile.stacks[self._fold(frame)] += 1
+
+    def _fold(self, frame) -> str:
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            names.append(_frame_name(frame))
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+
+class SlowRequestLog:
+    """
+    Ring buffer of slow-request records: one JSON file per request in `directory`, the
+    oldest removed beyond `max_entries`. Several processes (pre-forked workers) can share it.
+    """
+    def __init__(self, directory, max_entries: int = 100):
+        self.directory = Path(directory)
+        self.max_entries = max_entries
+
+    def record(self, entry: dict) -> str:
+        """Write a record and drop the oldest ones. Returns the record id."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        record_id = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        path = self.directory / f"{record_id}.json"
+        temporary_path = self.directory / f".{record_id}.tmp"
+        temporary_path.write_text(json.dumps({"id": record_id, **entry}, indent=1))
+        os.replace(temporary_path, path)
+        for stale in self._paths()[:-self.max_entries or None]:
+            stale.unlink(missing_ok=True)
+        return record_id
+
+    def entries(self) -> List[dict]:
+        """All records, oldest first."""
+        records = []
+        for path in self._paths():
+            try:
+                records.append(json.loads(path.read_text()))
+            except (OSError, ValueError):
+                continue  # Removed by another process, or being replaced.
+        return records
+
+    def get(self, record_id: str) -> Optional[dict]:
+        path = self.directory / f"{record_id}.json"
+        try:
+            return json.loads(path.read_text())
+        except FileNotFoundError:
+            return None
+
+    def _paths(self) -> List[Path]:
+        if not self.directory.is_dir():
+            return []
+        return sorted(self.directory.glob("*.json"))
+
+
+class SlowRequestProfiler:
+    """
+    Profiles requests and keeps those slower than `threshold_seconds`.
+    Attributes:
+        threshold_seconds (float): Requests at least this slow are recorded.
+        log (SlowRequestLog): Where they are recorded.
+    """
+    def __init__(self, threshold_seconds: float, log: SlowRequestLog, sampler: Optional[StackSampler] = None):
+        self.threshold_seconds = threshold_seconds
+        self.log = log
+        self.sampler = sampler or StackSampler()
+
+    def start(self) -> RequestProfile:
+        return self.sampler.start()
+
+    def finish(self, profile: RequestProfile, **details) -> Optional[str]:
+        """Stop profiling a request and record it if it was slow.
+        Args:
+            profile (RequestProfile): The request's profile.
+            **details: Stored with the record (service, endpoint, status...).
+        Returns:
+            Optional[str]: The id of the record, or None if the request was fast enough.
+        """
+        self.sampler.stop(profile)
+        duration = time.perf_counter() - profile.started_at
+        if duration < self.threshold_seconds:
+            return None
+        return self.log.record({
+            **details,
+            "timestamp": time.time(),
+            "duration_seconds": round(duration, 6),
+            "threshold_seconds": self.threshold_seconds,
+            "stages": {stage: round(seconds, 6) for stage, seconds in profile.stages.items()},
+            "payloads": profile.payloads,
+            "profile": {
+                "interval_seconds": self.sampler.interval_seconds,
+                "samples": profile.samples,
+                "stacks": dict(profile.stacks.most_common(MAX_STACKS)),
+            },
+        })
+
+
+def _log_directories(directory: Path) -> List[Path]:
+    """The log directory itself if it holds records, else its per-service subdirectories."""
+    if any(directory.glob("*.json")):
+        return [directory]
+    return sorted(path for path in directory.iterdir() if path.is_dir()) if directory.is_dir() else []
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="List and dump the slow requests recorded by the FHE services.")
+    parser.add_argument("--directory", default=str(DEFAULT_LOG_DIRECTORY),
+                        help="Log directory of a service, or the parent of several (default: %(default)s)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="List the recorded requests, oldest first")
+    show = commands.add_parser("show", help="Print a record as JSON")
+    show.add_argument("id")
+    folded = commands.add_parser("folded", help="Print the sampled stacks of a record in folded form, for flame graphs")
+    folded.add_argument("id")
+    args = parser.parse_args(argv)
+
+    logs = [SlowRequestLog(directory) for directory in _log_directories(Path(args.directory))]
+    if args.command == "list":
+        for log in logs:
+            for entry in log.entries():
+                stages = ", ".join(f"{stage}={seconds:.3f}s" for stage, seconds in entry.get("stages", {}).items())
+                started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["timestamp"]))
+                print(f"{entry['id']}  {started}  {entry.get('service', '-')}  {entry.get('endpoint', '-')}  "
+                      f"{entry.get('status', '-')}  {entry['duration_seconds']:.3f}s  [{stages}]")
+        return 0
+
+    entry = next((e for e in (log.get(args.id) for log in logs) if e is not None), None)
+    if entry is None:
+        print(f"No slow request {args.id} in {args.directory}", file=sys.stderr)
+        return 1
+    if args.command == "show":
+        print(json.dumps(entry, indent=2))
+    else:
+        for stack, count in entry["profile"]["stacks"].items():
+            print(f"{stack} {count}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
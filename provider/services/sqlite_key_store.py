@@ -0,0 +1,317 @@
+"""
+Single-use keys stored in a SQLite database, for services run by many worker processes.
+
+The keys of a service are rows of one table in `keys/<service>/keys.sqlite3`:
+
+    keys(address TEXT PRIMARY KEY, change, idx, state, reserved_by, used_at)
+
+where `state` is 'valid', 'reserved' (by the process `reserved_by`, while its prediction
+runs) or 'used'. Reserving, consuming and releasing keys are single write transactions
+(`BEGIN IMMEDIATE`), so concurrent workers and replicas on the same host can neither spend a
+key twice nor wait on a lock for longer than one transaction. The database is in WAL mode:
+validations read a snapshot without blocking the writers.
+
+`valid.json` is still exported, since the patient app takes its keys from it. The export runs
+outside the write transactions, at most `valid_keys_export_interval_ms` after a consumption, so
+concurrent consumptions share one export and no worker waits for it to take the write lock.
+Existing JSON key files are imported into an empty database.
+"""
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import os
+import sqlite3
+import threading
+import time
+from bip_utils import Bip44Changes
+from key_ledger import KeyLedger
+from key_manager import KeyManager, _process_alive
+
+_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS keys (
+        address TEXT PRIMARY KEY,
+        change INTEGER,
+        idx INTEGER,
+        state TEXT NOT NULL,
+        reserved_by INTEGER,
+        used_at REAL
+    )""",
+    "CREATE INDEX IF NOT EXISTS keys_state ON keys (state)",
+    "CREATE INDEX IF NOT EXISTS keys_position ON keys (change, idx)",
+)
+# Keys looked up per statement, below SQLite's limit on bound parameters.
+_QUERY_CHUNK = 500
+
+
+class SQLiteKeyManager(KeyManager):
+    """
+    KeyManager whose keys are stored in a SQLite database (`key_store: sqlite` in the service
+    configuration). Key generation, cryptographic validation and accounts are those of `KeyManager`.
+    A process holds one connection per thread, opened again after a fork.
+    Attributes:
+        key_store_file (str): The SQLite database.
+    """
+    def __init__(self, service_name: str):
+        self._connections = threading.local()
+        self._export_lock = threading.Lock()
+        self._export_timer: Optional[threading.Timer] = None
+        self._export_timer_pid: Optional[int] = None
+        super().__init__(service_name)
+
+    def _load_config_parameters(self):
+        super()._load_config_parameters()
+        self.sqlite_synchronous = self.config.get("server", "sqlite_synchronous", fallback="NORMAL").upper()
+        if self.sqlite_synchronous not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+            raise ValueError(f"Unknown sqlite_synchronous '{self.sqlite_synchronous}'")
+        self.sqlite_busy_timeout_ms = self.config.getint("server", "sqlite_busy_timeout_ms", fallback=30000)
+        self.valid_keys_export_interval_ms = self.config.getint("server", "valid_keys_export_interval_ms", fallback=100)
+
+    @property
+    def key_store_file(self) -> str:
+        return str(Path(self.valid_keys_file).parent / "keys.sqlite3")
+
+    def _connection(self) -> sqlite3.Connection:
+        """The connection of the calling thread (a connection must not be used across a fork)."""
+        connection = getattr(self._connections, "connection", None)
+        if connection is None or self._connections.pid != os.getpid():
+            connection = sqlite3.connect(
+                self.key_store_file, timeout=self.sqlite_busy_timeout_ms / 1000, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(f"PRAGMA synchronous={self.sqlite_synchronous}")
+            self._connections.connection = connection
+            self._connections.pid = os.getpid()
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        """A write transaction: it takes the database's write lock when it starts."""
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _initialize_service_state(self):
+        """Load or generate the master xPub, create the database (importing the JSON key files
+        into an empty one) and generate keys if none is valid."""
+        with self._key_files_lock():
+            self.master_xpub = self._load_master_xpub()
+            if not self.master_xpub:
+                self.master_xpub = self._generate_and_save_master_xpub()
+
+            with self._transaction() as connection:
+                for statement in _SCHEMA:
+                    connection.execute(statement)
+                if connection.execute("SELECT 1 FROM keys LIMIT 1").fetchone() is None:
+                    self._import_key_files(connection)
+
+                if connection.execute("SELECT 1 FROM keys WHERE state != 'used' LIMIT 1").fetchone() is None and self.master_xpub:
+                    change = int(Bip44Changes.CHAIN_EXT)
+                    (last_index,) = connection.execute("SELECT MAX(idx) FROM keys WHERE change = ?", (change,)).fetchone()
+                    if last_index is None:
+                        (last_index,) = connection.execute("SELECT COUNT(*) - 1 FROM keys WHERE state = 'used'").fetchone()
+                    start_idx = last_index + 1
+                    new_keys = self._generate_one_time_keys(
+                        start_index=start_idx,
+                        count=self.initial_key_batch_size,
+                        change_level_bip44=Bip44Changes.CHAIN_EXT
+                    )
+                    if isinstance(new_keys, list):
+                        connection.executemany(
+                            "INSERT OR IGNORE INTO keys (address, change, idx, state) VALUES (?, ?, ?, 'valid')",
+                            [(key, change, start_idx + i) for i, key in enumerate(new_keys)]
+                        )
+            self._export_valid_keys()
+
+    def _import_key_files(self, connection: sqlite3.Connection):
+        """Copy the keys of the JSON key files (and their positions) into the database."""
+        self._refresh_keys_from_files()
+        rows = [(key, *(position or (None, None)), 'used') for key, position in self.ledger.used.items()]
+        rows += [(key, *(position or (None, None)), 'valid') for key, position in self.ledger.valid.items()]
+        connection.executemany("INSERT OR IGNORE INTO keys (address, change, idx, state) VALUES (?, ?, ?, ?)", rows)
+        self.ledger = KeyLedger()
+
+    def _export_valid_keys(self) -> bool:
+        """Write the keys not used yet to `valid.json`, for the patient app. Must be called with the
+        key files lock held and outside a transaction: concurrent exports are serialized by the lock,
+        so the last one written reads the latest committed keys, without holding the write lock."""
+        rows = self._connection().execute("SELECT address FROM keys WHERE state != 'used' ORDER BY rowid").fetchall()
+        return self._save_keys_to_file([address for (address,) in rows], self.valid_keys_file)
+
+    def flush_valid_keys(self) -> bool:
+        """Export `valid.json` now if a consumption is waiting for its export."""
+        with self._export_lock:
+            pending = self._export_timer is not None and self._export_timer_pid == os.getpid()
+            if pending:
+                self._export_timer.cancel()
+                self._export_timer = None
+        if not pending:
+            return True
+        with self._key_files_lock():
+            return self._export_valid_keys()
+
+    def _schedule_export(self) -> bool:
+        """Export `valid.json` `valid_keys_export_interval_ms` after the first consumption since the last export."""
+        if self.valid_keys_export_interval_ms <= 0:
+            with self._key_files_lock():
+                return self._export_valid_keys()
+        with self._export_lock:
+            if self._export_timer is not None and self._export_timer_pid == os.getpid():
+                return True
+            self._export_timer = threading.Timer(self.valid_keys_export_interval_ms / 1000, self._export_in_background)
+            self._export_timer.daemon = True
+            self._export_timer_pid = os.getpid()
+        self._export_timer.start()
+        return True
+
+    def _export_in_background(self):
+        with self._export_lock:
+            self._export_timer = None
+        try:
+            with self._key_files_lock():
+                self._export_valid_keys()
+        finally:
+            self._close_connection()
+
+    def _key_states(self, connection: sqlite3.Connection, keys: List[str]) -> Dict[str, Tuple[str, Optional[int]]]:
+        """The state and reserving process of the keys that are in the database."""
+        states = {}
+        unique_keys = list(dict.fromkeys(keys))
+        for start in range(0, len(unique_keys), _QUERY_CHUNK):
+            chunk = unique_keys[start:start + _QUERY_CHUNK]
+            states.update(
+                (address, (state, reserved_by)) for address, state, reserved_by in connection.execute(
+                    f"SELECT address, state, reserved_by FROM keys WHERE address IN ({','.join('?' * len(chunk))})", chunk
+                )
+            )
+        return states
+
+    @staticmethod
+    def _is_available(state: Tuple[str, Optional[int]]) -> bool:
+        """Whether a key can be reserved: valid, or reserved by a process that died."""
+        key_state, reserved_by = state
+        if key_state == 'valid':
+            return True
+        return key_state == 'reserved' and reserved_by != os.getpid() and not _process_alive(reserved_by)
+
+    def _derive_unknown_keys(self, keys: List[str], states: Dict[str, Tuple[str, Optional[int]]]) -> Dict[str, Tuple[int, int]]:
+        """Validate cryptographically the keys that are not in the database.
+        Returns:
+            Dict[str, Tuple[int, int]]: The BIP44 position of those that derive from the master xPub.
+        """
+        derived = {}
+        for key in dict.fromkeys(keys):
+            if key not in states and self.master_xpub and self.validate_key_cryptographically(key):
+                derived[key] = self.ledger.position(key)
+        return derived
+
+    def _results(self, keys: List[str], states: Dict[str, Tuple[str, Optional[int]]],
+                 derived: Dict[str, Tuple[int, int]]) -> List[bool]:
+        seen = set()
+        results = []
+        for key in keys:
+            state = states.get(key)
+            results.append(key not in seen and (self._is_available(state) if state else key in derived))
+            seen.add(key)
+        return results
+
+    def _highest_used_index(self, change: int) -> int:
+        (highest,) = self._connection().execute(
+            "SELECT MAX(idx) FROM keys WHERE change = ? AND state = 'used'", (change,)
+        ).fetchone()
+        return -1 if highest is None else highest
+
+    @property
+    def valid_keys(self) -> List[str]:
+        rows = self._connection().execute("SELECT address FROM keys WHERE state != 'used' ORDER BY rowid").fetchall()
+        return [address for (address,) in rows]
+
+    @property
+    def used_keys(self) -> List[str]:
+        rows = self._connection().execute("SELECT address FROM keys WHERE state = 'used' ORDER BY used_at, rowid").fetchall()
+        return [address for (address,) in rows]
+
+    def validate_key(self, key_to_validate: str) -> bool:
+        return self.validate_keys([key_to_validate])[0]
+
+    def validate_keys(self, keys_to_validate: List[str]) -> List[bool]:
+        """Validates a batch of keys without reserving them (see `KeyManager.validate_keys`)."""
+        states = self._key_states(self._connection(), keys_to_validate)
+        return self._results(keys_to_validate, states, self._derive_unknown_keys(keys_to_validate, states))
+
+    def reserve_keys(self, keys: List[str]) -> List[bool]:
+        """Validates a batch of keys and, if all of them are valid, reserves them in one transaction.
+        Keys not in the database are derived before the transaction, which only checks and updates rows.
+        Args:
+            keys (List[str]): The keys to reserve.
+        Returns:
+            List[bool]: One validation result per key. The keys are only reserved if all are True.
+        """
+        derived = self._derive_unknown_keys(keys, self._key_states(self._connection(), keys))
+        with self._transaction() as connection:
+            states = self._key_states(connection, keys)
+            results = self._results(keys, states, derived)
+            if all(results):
+                pid = os.getpid()
+                connection.executemany(
+                    "UPDATE keys SET state = 'reserved', reserved_by = ? WHERE address = ?",
+                    [(pid, key) for key in keys if key in states]
+                )
+                connection.executemany(
+                    "INSERT INTO keys (address, change, idx, state, reserved_by) VALUES (?, ?, ?, 'reserved', ?)",
+                    [(key, *(derived[key] or (None, None)), pid) for key in keys if key not in states]
+                )
+        return results
+
+    def release_keys(self, keys: List[str]):
+        """Releases keys reserved by this process whose prediction did not complete.
+        Args:
+            keys (List[str]): The keys to release.
+        """
+        with self._transaction() as connection:
+            connection.executemany(
+                "UPDATE keys SET state = 'valid', reserved_by = NULL WHERE address = ? AND state = 'reserved' AND reserved_by = ?",
+                [(key, os.getpid()) for key in keys]
+            )
+
+    def mark_keys_as_used(self, keys: List[str]) -> bool:
+        """Marks a batch of keys as used in one transaction.
+        Args:
+            keys (List[str]): The keys to mark as used.
+        Returns:
+            bool: True if the keys were stored as used (and `valid.json` exported), False otherwise.
+        """
+        try:
+            with self._transaction() as connection:
+                states = self._key_states(connection, keys)
+                now = time.time()
+                connection.executemany(
+                    "INSERT INTO keys (address, change, idx, state, used_at) VALUES (?, ?, ?, 'used', ?) "
+                    "ON CONFLICT (address) DO UPDATE SET state = 'used', reserved_by = NULL, used_at = excluded.used_at "
+                    "WHERE keys.state != 'used'",
+                    [(key, *(self.ledger.position(key) or (None, None)), now) for key in dict.fromkeys(keys)]
+                )
+            exported = True
+            if any(states.get(key, ('used',))[0] != 'used' for key in keys):
+                exported = self._schedule_export()
+        except sqlite3.Error:
+            return False
+        self._prefetch_derivation()
+        return exported
+
+    def close(self):
+        """Export a pending `valid.json` and close the connection of the calling thread."""
+        super().close()
+        self.flush_valid_keys()
+        self._close_connection()
+
+    def _close_connection(self):
+        connection = getattr(self._connections, "connection", None)
+        if connection is not None and self._connections.pid == os.getpid():
+            connection.close()
+            self._connections.connection = None
@@ -0,0 +1,139 @@
+"""
+Disk-spooled storage for the file parts of prediction requests.
+
+Parts are kept in memory up to a threshold and spooled to an anonymous temporary file
+beyond it, so concurrent uploads of evaluation keys do not each hold a full copy in
+Python memory. `read_part` hands the content on without copying it again: a memory map of
+the spooled file, or the in-memory bytes for small parts.
+"""
+
+import io
+import mmap
+import tempfile
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+DEFAULT_SPOOL_THRESHOLD = 1024 * 1024
+
+
+class SpooledPart(io.RawIOBase):
+    """
+    Writable buffer for one uploaded file part, spooled to a temporary file past `spool_threshold` bytes.
+    Attributes:
+        spool_threshold (int): Size from which the part is moved to a temporary file.
+        max_size (Optional[int]): Maximum size of the part; writing past it raises RequestEntityTooLarge.
+        size (int): Number of bytes written.
+    """
+    def __init__(self, spool_threshold, max_size=None):
+        super().__init__()
+        self.spool_threshold = spool_threshold
+        self.max_size = max_size
+        self.size = 0
+        self._file = io.BytesIO()
+        self._rolled = False
+
+    @property
+    def rolled(self):
+        """Whether the part has been moved to a temporary file."""
+        return self._rolled
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def write(self, data):
+        if self.max_size is not None and self.size + len(data) > self.max_size:
+            raise RequestEntityTooLarge(f"Uploaded part exceeds the limit of {self.max_size} bytes.")
+        if not self._rolled and self.size + len(data) > self.spool_threshold:
+            spooled = tempfile.TemporaryFile()
+            spooled.write(self._file.getbuffer())
+            spooled.seek(self._file.tell())
+            self._file = spooled
+            self._rolled = True
+        written = self._file.write(data)
+        self.size += written
+        return written
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def readinto(self, buffer):
+        return self._file.readinto(buffer)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+    def view(self):
+        """Content of the part without an extra copy.
+        Returns:
+            memoryview | bytes: A read-only memory map of the spooled file, or the in-memory bytes.
+            The memory map stays valid after the part is closed.
+        """
+        if not self._rolled:
+            return self._file.getvalue()
+        if self.size == 0:
+            return b""
+        self._file.flush()
+        return memoryview(mmap.mmap(self._file.fileno(), self.size, access=mmap.ACCESS_READ))
+
+
+class BufferPart(io.RawIOBase):
+    """
+    File part backed by a slice of an already received body (see `predict_protocol`).
+    `view` returns the slice itself, without copying it.
+    """
+    def __init__(self, buffer):
+        super().__init__()
+        self._buffer = memoryview(buffer)
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        chunk = self._buffer[self._position:self._position + len(buffer)]
+        buffer[:len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._buffer)}[whence]
+        self._position = max(base + offset, 0)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def view(self):
+        return self._buffer
+
+
+def read_part(file_storage):
+    """Get the content of an uploaded file part.
+    Parts stored as SpooledPart or BufferPart are returned without copying (memoryview or bytes);
+    other streams are read into bytes.
+    Args:
+        file_storage (FileStorage): The uploaded file.
+    Returns:
+        memoryview | bytes: The content of the part.
+    """
+    stream = file_storage.stream
+    if isinstance(stream, (SpooledPart, BufferPart)):
+        return stream.view()
+    return file_storage.read()
@@ -0,0 +1,155 @@
+"""
+Metering of the resources consumed by predictions, per key account.
+
+Each prediction request is charged to the key account behind its single-use key (see
+`KeyManager.key_account`: every key of a service derives from its account xPub, so a service
+has a single account and this is per-service metering, not per client): the CPU
+time of its FHE evaluation, its wall time and the bytes it received and sent. Usage is
+summed in memory per account and hour, then appended to a compact on-disk store every
+`flush_interval_seconds`: one binary file per UTC day, with one fixed-layout record per
+account and hour in each flush (little-endian):
+
+    u32 hour (hours since the epoch)
+    u8  length + account (UTF-8)
+    u32 requests, u32 predictions
+    u64 CPU microseconds, u64 wall microseconds
+    u64 bytes in, u64 bytes out
+
+Records are appended with a single `O_APPEND` write, so several processes (pre-forked
+workers) share the files. Queries add up the records of the requested period.
+"""
+
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import datetime
+import os
+import struct
+import threading
+import time
+
+FIELDS = ("requests", "predictions", "cpu_seconds", "wall_seconds", "bytes_in", "bytes_out")
+
+_PREFIX = struct.Struct("<IB")
+_COUNTERS = struct.Struct("<IIQQQQ")
+_MICROSECONDS = 1_000_000
+
+
+def _day_of(hour: int) -> str:
+    return datetime.datetime.fromtimestamp(hour * 3600, datetime.timezone.utc).strftime("%Y-%m-%d")
+
+
+def encode_record(hour: int, account: str, usage: List[float]) -> bytes:
+    """Encode the usage of an account during an hour (counters in the order of `FIELDS`)."""
+    account_bytes = account.encode("utf-8")[:255]
+    requests, predictions, cpu_seconds, wall_seconds, bytes_in, bytes_out = usage
+    return (_PREFIX.pack(hour, len(account_bytes)) + account_bytes + _COUNTERS.pack(
+        int(requests), int(predictions), round(cpu_seconds * _MICROSECONDS), round(wall_seconds * _MICROSECONDS),
+        int(bytes_in), int(bytes_out)
+    ))
+
+
+def decode_records(data: bytes):
+    """Decode the records of a usage file. A record cut short (the process died while writing it) ends the file.
+    Yields:
+        Tuple[int, str, List[float]]: The hour, the account and its counters.
+    """
+    offset = 0
+    while offset + _PREFIX.size <= len(data):
+        hour, length = _PREFIX.unpack_from(data, offset)
+        end = offset + _PREFIX.size + length + _COUNTERS.size
+        if end > len(data):
+            return
+        account = data[offset + _PREFIX.size:offset + _PREFIX.size + length].decode("utf-8", errors="replace")
+        requests, predictions, cpu, wall, bytes_in, bytes_out = _COUNTERS.unpack_from(data, end - _COUNTERS.size)
+        yield hour, account, [requests, predictions, cpu / _MICROSECONDS, wall / _MICROSECONDS, bytes_in, bytes_out]
+        offset = end
+
+
+class UsageMeter:
+    """
+    Aggregates usage per account and hour and stores it in `directory`.
+    Attributes:
+        directory (Path): Directory of the daily usage files.
+        flush_interval_seconds (float): Longest time usage stays in memory only.
+    """
+    def __init__(self, directory, flush_interval_seconds: float = 10):
+        self.directory = Path(directory)
+        self.flush_interval_seconds = flush_interval_seconds
+        self._pending: Dict[Tuple[int, str], List[float]] = defaultdict(lambda: [0] * len(FIELDS))
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, account: str, predictions: int, cpu_seconds: float, wall_seconds: float,
+               bytes_in: int, bytes_out: int, timestamp: Optional[float] = None):
+        """Charge one request to an account. Flushes the pending usage when the interval has elapsed."""
+        hour = int((timestamp if timestamp is not None else time.time()) // 3600)
+        with self._lock:
+            counters = self._pending[(hour, account)]
+            for i, value in enumerate((1, predictions, cpu_seconds, wall_seconds, bytes_in, bytes_out)):
+                counters[i] += value
+            due = time.monotonic() - self._last_flush >= self.flush_interval_seconds
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Append the pending usage to the daily files."""
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(lambda: [0] * len(FIELDS))
+            self._last_flush = time.monotonic()
+        if not pending:
+            return
+        by_day = defaultdict(list)
+        for (hour, account), counters in sorted(pending.items()):
+            by_day[_day_of(hour)].append(encode_record(hour, account, counters))
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for day, records in by_day.items():
+            fd = os.open(self.directory / f"{day}.usage", os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, b"".join(records))
+            finally:
+                os.close(fd)
+
+    def query(self, since: Optional[float] = None, until: Optional[float] = None, account: Optional[str] = None,
+              by_hour: bool = False) -> List[dict]:
+        """Sum the stored usage (after flushing this process's pending usage).
+        Args:
+            since (Optional[float]): Start of the period (timestamp), rounded down to the hour.
+            until (Optional[float]): End of the period (timestamp), rounded up to the hour.
+            account (Optional[str]): Only this account.
+            by_hour (bool): One entry per account and hour instead of per account.
+        Returns:
+            List[dict]: One entry per account ('account' and the counters of `FIELDS`, plus 'hour' as an
+                ISO 8601 timestamp when `by_hour`), heaviest CPU consumers first (by hour, then CPU, when `by_hour`).
+        """
+        self.flush()
+        first_hour = int(since // 3600) if since is not None else None
+        end_hour = int(-(-until // 3600)) if until is not None else None
+        totals: Dict[Tuple[Optional[int], str], List[float]] = defaultdict(lambda: [0] * len(FIELDS))
+        for path in sorted(self.directory.glob("*.usage")) if self.directory.is_dir() else []:
+            day_start = int(datetime.datetime.strptime(path.stem, "%Y-%m-%d").replace(
+                tzinfo=datetime.timezone.utc).timestamp() // 3600)
+            if (end_hour is not None and day_start >= end_hour) or (first_hour is not None and day_start + 24 <= first_hour):
+                continue
+            for hour, record_account, counters in decode_records(path.read_bytes()):
+                if (first_hour is not None and hour < first_hour) or (end_hour is not None and hour >= end_hour):
+                    continue
+                if account is not None and record_account != account:
+                    continue
+                total = totals[(hour if by_hour else None, record_account)]
+                for i, value in enumerate(counters):
+                    total[i] += value
+
+        entries = []
+        for (hour, record_account), counters in totals.items():
+            entry = {"account": record_account, **dict(zip(FIELDS, counters))}
+            entry["cpu_seconds"] = round(entry["cpu_seconds"], 6)
+            entry["wall_seconds"] = round(entry["wall_seconds"], 6)
+            if by_hour:
+                entry["hour"] = datetime.datetime.fromtimestamp(hour * 3600, datetime.timezone.utc).isoformat()
+            entries.append(entry)
+        if by_hour:
+            entries.sort(key=lambda entry: (entry["hour"], -entry["cpu_seconds"], entry["account"]))
+        else:
+            entries.sort(key=lambda entry: (-entry["cpu_seconds"], entry["account"]))
+        return entries
@@ -1,8 +1,11 @@
+import argparse
 import os
 import subprocess
 import time
 import sys
 import logging
+import urllib.error
+import urllib.request
 
 logger = logging.getLogger(__name__)
 project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -16,6 +19,8 @@ except ImportError:
     logger.error(f"Error: Could not import 'train_and_save' and 'load_config' from 'provider.train'. Ensure 'provider/train.py' exists and '{provider_dir}' is in PYTHONPATH.")
     sys.exit(1)
 
+from prefork import default_worker_count
+
 def check_model_exists(directory_path):
     """
     Checks if the FHE model directory exists and contains essential files.
@@ -29,7 +34,7 @@ def check_model_exists(directory_path):
     server_zip_path = os.path.join(abs_directory_path, "server.zip")
     return os.path.isfile(server_zip_path)
 
-def start_flask_server(server_script_path_relative, port, service_name):
+def start_flask_server(server_script_path_relative, port, service_name, script_args=None):
     """Starts a Flask server as a background process."""
     absolute_script_path = os.path.join(project_root, server_script_path_relative)
 
@@ -46,7 +51,7 @@ def start_flask_server(server_script_path_relative, port, service_name):
     try:
         with open(log_file_stdout, 'wb') as out_log, open(log_file_stderr, 'wb') as err_log:
             process = subprocess.Popen(
-                [sys.executable, absolute_script_path], 
+                [sys.executable, absolute_script_path, *(script_args or [])],
                 stdout=out_log,
                 stderr=err_log,
                 cwd=os.path.dirname(absolute_script_path) 
@@ -57,7 +62,47 @@ def start_flask_server(server_script_path_relative, port, service_name):
         logger.error(f"Error starting {service_name} server: {e}")
         return None
 
+def start_prefork_server(port, service_name, workers, service=None):
+    """Starts the pre-fork production launcher (provider/prefork.py) as a background process.
+    Without `service`, it serves every service like model_host.py."""
+    script_args = ["--port", str(port), "--workers", str(workers)]
+    if service:
+        script_args += ["--service", service]
+    return start_flask_server(os.path.join("provider", "prefork.py"), port, service_name, script_args)
+
+def wait_until_ready(process, port, service_name, timeout_seconds, poll_interval_seconds=1.0):
+    """
+    Polls the server's `/readyz` until it reports the model loaded and warmed up.
+    Returns False if the process exits or the server is not ready within `timeout_seconds`.
+    """
+    url = f"http://127.0.0.1:{port}/readyz"
+    deadline = time.monotonic() + timeout_seconds
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            logger.error(f"{service_name} server exited with code {process.returncode} before becoming ready.")
+            return False
+        try:
+            with urllib.request.urlopen(url, timeout=poll_interval_seconds) as response:
+                if response.status == 200:
+                    logger.info(f"{service_name} server is ready on port {port}.")
+                    return True
+        except (urllib.error.URLError, OSError):
+            pass  # Not listening yet, or 503 while warming up.
+        time.sleep(poll_interval_seconds)
+    logger.error(f"{service_name} server is not ready after {timeout_seconds} seconds.")
+    return False
+
 def main():
+    parser = argparse.ArgumentParser(description="Train missing models and start the FHE services.")
+    parser.add_argument("--single-host", action="store_true",
+                        help="Serve all services from one host instead of one server per service.")
+    parser.add_argument("--dev-server", action="store_true",
+                        help="Use the Flask development servers instead of the pre-fork launcher.")
+    args = parser.parse_args()
+    use_prefork = not args.dev_server and hasattr(os, "fork")
+    if not args.dev_server and not use_prefork:
+        logger.warning("The pre-fork launcher needs os.fork, falling back to the development servers.")
+
     config_file_path_relative = os.path.join("provider", "training_config.yaml")
     config_path_absolute = os.path.join(project_root, config_file_path_relative)
 
@@ -67,6 +112,13 @@ def main():
 
     config = load_config(config_path_absolute)
     running_servers_pids = []
+    started_servers = []
+    readiness_timeout = config.get("readiness_timeout_seconds", 300)
+
+    # The cores are split between the pre-fork servers: one server in single-host mode,
+    # one per service otherwise.
+    servers = 1 if args.single_host else max(len([c for c in config.get("datasets", []) if c.get("server_port") is not None]), 1)
+    workers = config.get("prefork", {}).get("workers") or default_worker_count(servers)
 
     for service_config in config.get("datasets", []):
         service_name = service_config.get("service_name", f"DatasetID_{service_config.get('dataset_id')}")
@@ -77,7 +129,8 @@ def main():
         server_script_relative = service_config.get("server_script")
         server_port = service_config.get("server_port")
 
-        if not all([output_dir_config, dataset_id is not None, server_script_relative, server_port is not None]):
+        if not all([output_dir_config, dataset_id is not None]) or (
+                not args.single_host and not all([server_script_relative, server_port is not None])):
             logger.warning(f"Skipping service '{service_name}' due to incomplete configuration (missing output_directory, dataset_id, server_script, or server_port).")
             continue
 
@@ -108,10 +161,30 @@ def main():
         else:
             logger.info(f"Model for '{service_name}' already exists in '{output_dir_absolute}'.")
 
-        server_process = start_flask_server(server_script_relative, server_port, service_name)
+        if args.single_host:
+            continue
+
+        if use_prefork:
+            server_process = start_prefork_server(server_port, service_name, workers, service=service_name)
+        else:
+            server_process = start_flask_server(server_script_relative, server_port, service_name)
         if server_process:
             running_servers_pids.append(server_process.pid)
-            time.sleep(2)
+            started_servers.append((server_process, server_port, service_name))
+
+    if args.single_host:
+        host_port = config.get("model_host", {}).get("port", 5000)
+        if use_prefork:
+            host_process = start_prefork_server(host_port, "Model Host", workers)
+        else:
+            host_process = start_flask_server(os.path.join("provider", "model_host.py"), host_port, "Model Host")
+        if host_process:
+            running_servers_pids.append(host_process.pid)
+            started_servers.append((host_process, host_port, "Model Host"))
+
+    # The servers load and warm up their models in parallel; wait for all of them.
+    for process, port, service_name in started_servers:
+        wait_until_ready(process, port, service_name, readiness_timeout)
 
     if not running_servers_pids:
         logger.info("\nNo servers were started.")
@@ -0,0 +1,54 @@
+"""
+Tests for the admission control of predictions.
+"""
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent / "provider" / "services"))
+
+from admission import AdmissionController, AdmissionRejectedError
+
+
+def test_full_queue_is_rejected_with_retry_after():
+    """Test that requests beyond the running and queued limits are rejected right away."""
+    controller = AdmissionController(max_in_flight=1, max_queued=1, queue_timeout_seconds=5, reject_status=429,
+                                     initial_latency_seconds=2.0)
+    controller.acquire()
+    waiter = threading.Thread(target=controller.acquire)
+    waiter.start()
+    while controller.queued < 1:
+        time.sleep(0.01)
+    with pytest.raises(AdmissionRejectedError) as excinfo:
+        controller.acquire()
+    assert excinfo.value.status_code == 429
+    assert excinfo.value.retry_after == 4
+    controller.release()
+    waiter.join(5)
+    stats = controller.stats()
+    assert (stats["in_flight"], stats["queued"], stats["admitted"], stats["rejected_queue_full"]) == (1, 0, 2, 1)
+
+
+def test_queue_wait_times_out():
+    """Test that a queued request gives up with 503 when no slot frees up."""
+    controller = AdmissionController(max_in_flight=1, max_queued=4, queue_timeout_seconds=0.05)
+    controller.acquire()
+    with pytest.raises(AdmissionRejectedError) as excinfo:
+        controller.acquire()
+    assert excinfo.value.status_code == 503
+    assert controller.stats()["rejected_timeout"] == 1
+
+
+def test_latency_moving_average():
+    """Test that successful blocks update the latency estimate and failed ones do not."""
+    controller = AdmissionController(max_in_flight=2, max_queued=0, latency_alpha=0.5, initial_latency_seconds=4.0)
+    controller.record_latency(2.0)
+    assert controller.latency_seconds == 3.0
+    with pytest.raises(RuntimeError):
+        with controller.measure():
+            raise RuntimeError("failed")
+    assert controller.latency_seconds == 3.0
+    assert controller.retry_after() == 3
@@ -0,0 +1,190 @@
+"""
+Tests for the ASGI front end of the provider services.
+"""
+import asyncio
+import json
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent / "provider" / "services"))
+
+flask = pytest.importorskip("flask")
+from asgi_app import AsgiDispatcher, AsgiServiceApp, PreparsedRequest
+from job_queue import JobManager
+
+BOUNDARY = "testboundary"
+
+
+def multipart_body(fields, files):
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, data in files:
+        parts.append(f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"; filename="{name}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + data + b"\r\n")
+    return b"".join(parts) + f"--{BOUNDARY}--\r\n".encode()
+
+
+def make_flask_app(job_manager=None):
+    app = flask.Flask("test")
+    app.request_class = PreparsedRequest
+    app.view_threads = []
+
+    @app.get("/omop_requirements")
+    def omop_requirements():
+        return flask.jsonify({"thread": threading.current_thread().name})
+
+    @app.post("/predict")
+    def predict():
+        app.view_threads.append(threading.current_thread().name)
+        data = b"".join(f.read() for f in flask.request.files.getlist("encrypted_data"))
+        return data + flask.request.form["evaluation_keys_id"].encode(), 200
+
+    @app.get("/jobs/<job_id>")
+    def get_job(job_id):
+        job = job_manager.get(job_id)
+        return (job.result, 200) if job.status == JobManager.DONE else ({"status": job.status, "wait": flask.request.args.get("wait")}, 202)
+
+    return app
+
+
+async def request(app, method, path, body=b"", headers=(), query=b"", chunk_size=None):
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)] if chunk_size and body else [body]
+    messages = [{"type": "http.request", "body": c, "more_body": i < len(chunks) - 1} for i, c in enumerate(chunks)]
+    sent = []
+
+    async def receive():
+        await asyncio.sleep(0)
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": method, "path": path, "root_path": "", "query_string": query,
+             "headers": [(k.encode(), v.encode()) for k, v in headers], "http_version": "1.1"}
+    await app(scope, receive, send)
+    return sent[0]["status"], sent[1]["body"]
+
+
+def test_multipart_upload_is_parsed_on_the_loop_and_view_runs_on_executor():
+    """Test that chunked multipart uploads reach the Flask view, which runs on the executor."""
+    flask_app = make_flask_app()
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="fhe-view") as executor:
+        app = AsgiServiceApp(flask_app, executor)
+        body = multipart_body({"evaluation_keys_id": "abc"}, [("encrypted_data", b"x" * 5000), ("encrypted_data", b"yz")])
+        headers = [("content-type", f"multipart/form-data; boundary={BOUNDARY}"), ("content-length", str(len(body)))]
+        status, response = asyncio.run(request(app, "POST", "/predict", body, headers, chunk_size=777))
+    assert status == 200
+    assert response == b"x" * 5000 + b"yzabc"
+    assert flask_app.view_threads[0].startswith("fhe-view")
+
+
+def test_metadata_is_answered_on_the_event_loop():
+    """Test that metadata routes do not use the executor."""
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="fhe-view") as executor:
+        app = AsgiServiceApp(make_flask_app(), executor)
+        status, response = asyncio.run(request(app, "GET", "/omop_requirements"))
+    assert status == 200
+    assert b"fhe-view" not in response
+
+
+def test_malformed_multipart_is_rejected():
+    """Test that an invalid multipart body is answered with 400."""
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        app = AsgiServiceApp(make_flask_app(), executor)
+        headers = [("content-type", f"multipart/form-data; boundary={BOUNDARY}")]
+        status, _ = asyncio.run(request(app, "POST", "/predict", b"--" + BOUNDARY.encode() + b"\r\ngarbage", headers))
+    assert status == 400
+
+
+def test_job_long_poll_waits_on_the_loop():
+    """Test that a job long-poll returns the result once the job finishes."""
+    job_manager = JobManager(max_workers=1, max_pending=4, result_ttl_seconds=60)
+    release = threading.Event()
+    job = job_manager.submit(lambda: release.wait(5) and b"result")
+    threading.Timer(0.2, release.set).start()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        app = AsgiServiceApp(make_flask_app(job_manager), executor, job_manager=job_manager)
+        status, response = asyncio.run(request(app, "GET", f"/jobs/{job.job_id}", query=b"wait=5"))
+    assert (status, response) == (200, b"result")
+    job_manager.shutdown()
+
+
+def test_dispatcher_mounts_apps_by_prefix():
+    """Test that requests are routed by path prefix, with the prefix moved to root_path."""
+    seen = []
+
+    async def mounted(scope, receive, send):
+        seen.append((scope["root_path"], scope["path"]))
+        await send({"type": "http.response.start", "status": 204, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    dispatcher = AsgiDispatcher(mounted, {"/services/bcs": mounted})
+    asyncio.run(request(dispatcher, "GET", "/services/bcs/omop_requirements"))
+    asyncio.run(request(dispatcher, "GET", "/status"))
+    assert seen == [("/services/bcs", "/omop_requirements"), ("", "/status")]
+
+
+def test_upload_limits_are_enforced_on_the_loop():
+    """Test that oversized parts and bodies are rejected with 413 before reaching the view."""
+    flask_app = make_flask_app()
+    flask_app.config.update(UPLOAD_MAX_PART_BYTES=100, MAX_CONTENT_LENGTH=10_000)
+    body = multipart_body({"evaluation_keys_id": "abc"}, [("encrypted_data", b"x" * 101)])
+    headers = [("content-type", f"multipart/form-data; boundary={BOUNDARY}")]
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        app = AsgiServiceApp(flask_app, executor)
+        status, _ = asyncio.run(request(app, "POST", "/predict", body, headers, chunk_size=50))
+        assert status == 413
+        status, _ = asyncio.run(request(app, "POST", "/predict", b"x" * 10_001, [("content-length", "10001")]))
+        assert status == 413
+    assert flask_app.view_threads == []
+
+
+def test_other_bodies_are_spooled_on_the_loop():
+    """Test that a non-multipart body is spooled while it is received and handed to the view as is."""
+    flask_app = flask.Flask("test")
+    flask_app.request_class = PreparsedRequest
+    flask_app.config.update(UPLOAD_SPOOL_THRESHOLD=1000)
+
+    @flask_app.put("/chunk")
+    def chunk():
+        body = flask.request.body_part()
+        return {"rolled": body.rolled, "size": body.size, "head": bytes(body.view()[:3]).decode(),
+                "preparsed": body is flask.request.environ.get("agedap.preparsed_body")}
+
+    body = b"abc" + b"x" * 4997
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        app = AsgiServiceApp(flask_app, executor)
+        status, response = asyncio.run(request(app, "PUT", "/chunk", body, [("content-type", "application/octet-stream")], chunk_size=700))
+    assert status == 200
+    assert json.loads(response) == {"rolled": True, "size": 5000, "head": "abc", "preparsed": True}
+
+    response = flask_app.test_client().put("/chunk", data=body, content_type="application/octet-stream")
+    assert response.get_json() == {"rolled": True, "size": 5000, "head": "abc", "preparsed": False}
+
+
+def test_parts_are_closed_when_parsing_fails(monkeypatch):
+    """Test that the parts spooled before a part over the limit are closed, not left to the garbage collector."""
+    import asgi_app
+    from werkzeug.exceptions import RequestEntityTooLarge
+    parts = []
+
+    class TrackedPart(asgi_app.SpooledPart):
+        def __init__(self, *args):
+            super().__init__(*args)
+            parts.append(self)
+
+    monkeypatch.setattr(asgi_app, "SpooledPart", TrackedPart)
+    body = multipart_body({}, [("evaluation_keys", b"k" * 50), ("encrypted_data", b"x" * 101)])
+    messages = [{"type": "http.request", "body": body[i:i + 40], "more_body": i + 40 < len(body)} for i in range(0, len(body), 40)]
+
+    async def receive():
+        return messages.pop(0)
+
+    with pytest.raises(RequestEntityTooLarge):
+        asyncio.run(asgi_app.parse_multipart(receive, BOUNDARY.encode(), max_part_size=100))
+    assert len(parts) == 2 and all(part.closed for part in parts)
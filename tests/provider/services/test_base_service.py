@@ -1,6 +1,9 @@
 """
 Tests for base service functionality.
 """
+import io
+import sys
+import time
 import pytest
 from pathlib import Path
 
@@ -51,3 +54,295 @@ def test_services_directory_structure():
     for expected_file in expected_files:
         file_path = services_dir / expected_file
         assert file_path.exists(), f"Expected service file missing: {expected_file}"
+
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent / "provider" / "services"))
+
+flask = pytest.importorskip("flask")
+pytest.importorskip("bip_utils")
+from werkzeug.datastructures import FileStorage, Headers
+from base_service import AIServiceEndpoint
+from key_manager import KeyManager
+from predict_protocol import PREDICT_CONTENT_TYPE, pack_predict_request
+
+
+class TmpKeyManager(KeyManager):
+    """KeyManager whose key files live in a temporary directory."""
+
+    keys_dir = None
+
+    def _load_config_parameters(self):
+        super()._load_config_parameters()
+        self.server_xpub_file = str(self.keys_dir / "server_xpub.txt")
+        self.valid_keys_file = str(self.keys_dir / "valid.json")
+        self.used_keys_file = str(self.keys_dir / "used.json")
+        self.initial_key_batch_size = 10
+        self.crypto_validation_window_size = 20
+
+
+class EchoService(AIServiceEndpoint):
+    """Service in the 'echo' execution mode whose keys, uploads and usage live in a temporary directory."""
+
+    def __init__(self, directory, worker_processes=1, **config):
+        self.directory = directory
+        self.config_overrides = config
+        super().__init__("test_service", worker_processes=worker_processes)
+
+    def load_service_config(self, service_name):
+        return {
+            "service_name": service_name,
+            "output_directory": str(self.directory / "model"),
+            "execution_mode": "echo",
+            "model_watch_interval_seconds": 0,
+            "slow_request_threshold_seconds": 0,
+            "evaluation_keys_directory": str(self.directory / "evaluation_keys"),
+            "evaluation_key_upload_directory": str(self.directory / "evaluation_key_uploads"),
+            "usage_directory": str(self.directory / "usage"),
+            **self.config_overrides
+        }
+
+    def create_key_manager(self):
+        TmpKeyManager.keys_dir = self.directory / "keys"
+        TmpKeyManager.keys_dir.mkdir(exist_ok=True)
+        return TmpKeyManager(self.service_name)
+
+    def get_omop_requirements(self):
+        return {}
+
+    def get_additional_service_info(self):
+        return {}
+
+
+@pytest.fixture
+def service(tmp_path):
+    return EchoService(tmp_path)
+
+
+def predict_form(key, evaluation_keys=b"EK" * 16, encoding=None):
+    headers = Headers([("Content-Encoding", encoding)] if encoding else [])
+    return {
+        "encrypted_data": (io.BytesIO(b"ciphertext"), "encrypted_data"),
+        "single_use_key": (io.BytesIO(key.encode()), "single_use_key"),
+        "evaluation_keys": FileStorage(io.BytesIO(evaluation_keys), filename="evaluation_keys", headers=headers),
+    }
+
+
+def test_unreadable_evaluation_keys_release_the_reserved_key(service):
+    """Test that a key reserved by a request whose evaluation keys cannot be read (415, 400) can be spent again."""
+    client = service.app.test_client()
+    key = service.key_manager.valid_keys[0]
+
+    response = client.post("/predict", data=predict_form(key, encoding="bogus"))
+    assert response.status_code == 415
+    response = client.post("/predict", data=predict_form(key, evaluation_keys=b"not gzip", encoding="gzip"))
+    assert response.status_code == 400
+    assert service.key_manager.reserve_keys([key]) == [True]
+
+
+def test_unknown_evaluation_keys_id_releases_the_reserved_key(service):
+    """Test that a key reserved by a job whose evaluation keys id is unknown (404) can be spent again."""
+    client = service.app.test_client()
+    key = service.key_manager.valid_keys[0]
+
+    response = client.post("/jobs", data=pack_predict_request(key, b"ciphertext", evaluation_keys_id="unknown"),
+                           content_type=PREDICT_CONTENT_TYPE)
+    assert response.status_code == 404
+    assert service.key_manager.reserve_keys([key]) == [True]
+
+
+def failing_run(*args, **kwargs):
+    raise RuntimeError("circuit failed")
+
+
+def test_successful_prediction_spends_the_key_and_charges_its_account(service):
+    """Test that a prediction answers the echoed ciphertext, marks the key as used and charges the usage."""
+    client = service.app.test_client()
+    key = service.key_manager.valid_keys[0]
+
+    response = client.post("/predict", data=predict_form(key))
+    assert response.status_code == 200
+    assert response.data == b"ciphertext"
+    assert key in service.key_manager.used_keys
+    assert service.key_manager.reserve_keys([key]) == [False]
+
+    usage = client.get("/usage").get_json()["usage"]
+    assert [entry["predictions"] for entry in usage] == [1]
+    assert usage[0]["account"] == service.key_manager.key_account(key)
+
+
+def test_failed_prediction_releases_the_key(service, monkeypatch):
+    """Test that a key whose prediction fails is released and not charged."""
+    client = service.app.test_client()
+    key = service.key_manager.valid_keys[0]
+    monkeypatch.setattr(service.execution_backend, "run", failing_run)
+
+    response = client.post("/predict", data=predict_form(key))
+    assert response.status_code == 500
+    assert key not in service.key_manager.used_keys
+    assert service.key_manager.reserve_keys([key]) == [True]
+    assert client.get("/usage").get_json()["usage"] == []
+
+
+def test_invalid_key_is_rejected(service):
+    """Test that a key not derived from the service xPub is rejected with a 403."""
+    response = service.app.test_client().post("/predict", data=predict_form("not-a-key"))
+    assert response.status_code == 403
+
+
+def test_pre_forked_workers_split_the_admission_limits(tmp_path):
+    """Test that each pre-forked worker admits its share of the host's predictions, at least one."""
+    service = EchoService(tmp_path, worker_processes=4, max_concurrent_predictions=8, max_queued_predictions=3)
+    assert (service.admission.max_in_flight, service.admission.max_queued) == (2, 1)
+    service = EchoService(tmp_path, worker_processes=16, max_concurrent_predictions=8)
+    assert service.admission.max_in_flight == 1
+
+
+@pytest.mark.parametrize("reject_status", [429, 503])
+def test_rejected_prediction_does_not_reserve_the_key(tmp_path, reject_status):
+    """Test that a prediction rejected by admission control leaves its key untouched."""
+    service = EchoService(tmp_path, max_concurrent_predictions=1, max_queued_predictions=0, admission_reject_status=reject_status)
+    client = service.app.test_client()
+    key = service.key_manager.valid_keys[0]
+
+    service.admission.acquire()
+    try:
+        response = client.post("/predict", data=predict_form(key))
+    finally:
+        service.admission.release()
+    assert response.status_code == reject_status
+    assert "Retry-After" in response.headers
+    assert service.key_manager.reserve_keys([key]) == [True]
+
+
+def test_retried_prediction_replays_the_stored_result(service):
+    """Test that a retry with the same Idempotency-Key gets the stored result although its key is spent."""
+    client = service.app.test_client()
+    key = service.key_manager.valid_keys[0]
+    headers = {"Idempotency-Key": "request-1"}
+
+    first = client.post("/predict", data=predict_form(key), headers=headers)
+    retry = client.post("/predict", data=predict_form(key), headers=headers)
+    assert first.status_code == retry.status_code == 200
+    assert retry.data == first.data
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert [entry["predictions"] for entry in client.get("/usage").get_json()["usage"]] == [1]
+
+
+def test_spent_key_with_another_payload_is_not_replayed(service):
+    """Test that a spent key presented with another ciphertext is rejected rather than given the stored result,
+    and that an Idempotency-Key reused for another ciphertext is a conflict."""
+    client = service.app.test_client()
+    key, other_key = service.key_manager.valid_keys[:2]
+
+    def other_payload(key):
+        return dict(predict_form(key), encrypted_data=(io.BytesIO(b"other"), "encrypted_data"))
+
+    assert client.post("/predict", data=predict_form(key)).status_code == 200
+    response = client.post("/predict", data=other_payload(key))
+    assert response.status_code == 403
+    assert "Idempotent-Replayed" not in response.headers
+
+    headers = {"Idempotency-Key": "request-1"}
+    assert client.post("/predict", data=predict_form(other_key), headers=headers).status_code == 200
+    assert client.post("/predict", data=other_payload(other_key), headers=headers).status_code == 409
+
+
+def eventually(condition, timeout=5):
+    """Wait for a condition set in the background, e.g. by a job's completion callback."""
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def submit_job(client, key):
+    response = client.post("/jobs", data=pack_predict_request(key, b"ciphertext", evaluation_keys=b"EK" * 16),
+                           content_type=PREDICT_CONTENT_TYPE)
+    assert response.status_code == 202
+    return client.get(f"{response.get_json()['status_url']}?wait=5")
+
+
+def test_successful_job_spends_the_key(service):
+    """Test that a job answers the echoed ciphertext and marks its key as used."""
+    client = service.app.test_client()
+    key = service.key_manager.valid_keys[0]
+
+    response = submit_job(client, key)
+    assert response.status_code == 200
+    assert response.data == b"ciphertext"
+    assert eventually(lambda: key in service.key_manager.used_keys)
+
+
+def test_failed_job_releases_the_key(service, monkeypatch):
+    """Test that a key whose job fails is released."""
+    client = service.app.test_client()
+    key = service.key_manager.valid_keys[0]
+    monkeypatch.setattr(service.execution_backend, "run", failing_run)
+
+    response = submit_job(client, key)
+    assert response.status_code == 500
+    assert response.get_json()["status"] == "failed"
+    assert eventually(lambda: service.key_manager.validate_key(key))
+
+
+def test_job_whose_key_cannot_be_spent_fails_and_releases_it(service, monkeypatch):
+    """Test that a job whose key cannot be marked as used fails, without its result, and releases the key."""
+    client = service.app.test_client()
+    key = service.key_manager.valid_keys[0]
+
+    def broken_mark(key):
+        raise OSError("disk full")
+    monkeypatch.setattr(service.key_manager, "mark_key_as_used", broken_mark)
+
+    response = submit_job(client, key)
+    assert response.status_code == 500
+    assert response.get_json()["status"] == "failed"
+    assert service.key_manager.validate_key(key)
+
+
+def test_retry_served_by_another_worker_replays_the_stored_result(tmp_path):
+    """Test that services sharing an idempotency spool directory replay each other's results."""
+    spool_directory = tmp_path / "idempotency"
+    worker_a = EchoService(tmp_path, idempotency_spool_directory=str(spool_directory))
+    worker_b = EchoService(tmp_path, idempotency_spool_directory=str(spool_directory))
+    key = worker_a.key_manager.valid_keys[0]
+    headers = {"Idempotency-Key": "request-1"}
+
+    first = worker_a.app.test_client().post("/predict", data=predict_form(key), headers=headers)
+    retry = worker_b.app.test_client().post("/predict", data=predict_form(key), headers=headers)
+    assert first.status_code == retry.status_code == 200
+    assert retry.headers["Idempotent-Replayed"] == "true"
+
+
+def test_replay_waits_for_an_admission_slot(tmp_path):
+    """Test that the body of a retry is not read, even to replay its result, before a slot is free."""
+    service = EchoService(tmp_path, max_concurrent_predictions=1, max_queued_predictions=0)
+    client = service.app.test_client()
+    key = service.key_manager.valid_keys[0]
+    headers = {"Idempotency-Key": "request-1"}
+    assert client.post("/predict", data=predict_form(key), headers=headers).status_code == 200
+
+    service.admission.acquire()
+    try:
+        assert client.post("/predict", data=predict_form(key), headers=headers).status_code == 503
+    finally:
+        service.admission.release()
+    assert client.post("/predict", data=predict_form(key), headers=headers).headers["Idempotent-Replayed"] == "true"
+
+
+def test_usage_is_saved_when_the_host_shuts_down(tmp_path):
+    """Test that usage still in memory is on disk once the host of the service (e.g. an exiting worker) shut down."""
+    sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent / "provider"))
+    from model_host import ModelHost
+    from usage_meter import UsageMeter
+
+    service = EchoService(tmp_path, usage_flush_interval_seconds=3600)
+    key = service.key_manager.valid_keys[0]
+    assert service.app.test_client().post("/predict", data=predict_form(key)).status_code == 200
+    assert UsageMeter(tmp_path / "usage").query() == []
+
+    host = ModelHost({"datasets": []}, execution_backend="inline")
+    host.services["test-service"] = service
+    host.shutdown(wait=True)
+    assert [entry["predictions"] for entry in UsageMeter(tmp_path / "usage").query()] == [1]
+    assert key in (tmp_path / "keys" / "used.journal").read_text().split()
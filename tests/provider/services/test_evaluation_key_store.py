@@ -0,0 +1,49 @@
+"""
+Tests for the content-addressed evaluation key store.
+"""
+import sys
+import hashlib
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent / "provider" / "services"))
+
+from evaluation_key_store import EvaluationKeyStore
+
+
+def test_register_is_content_addressed(tmp_path):
+    """Test that keys are stored under their SHA-256 and registered only once."""
+    store = EvaluationKeyStore(tmp_path, max_cache_bytes=1024, loader=bytes)
+    key_id, created = store.register(b"evaluation-keys")
+    assert key_id == hashlib.sha256(b"evaluation-keys").hexdigest()
+    assert created
+    assert store.register(b"evaluation-keys") == (key_id, False)
+    assert store.contains(key_id)
+
+
+def test_get_loads_once_and_caches(tmp_path):
+    """Test that stored keys are loaded through the loader only on cache misses."""
+    calls = []
+    store = EvaluationKeyStore(tmp_path, max_cache_bytes=1024, loader=lambda blob: calls.append(blob) or blob.upper())
+    key_id, _ = store.register(b"keys")
+    assert store.get(key_id) == b"KEYS"
+    assert store.get(key_id) == b"KEYS"
+    assert calls == [b"keys"]
+
+
+def test_cache_is_bounded_by_bytes(tmp_path):
+    """Test that the least recently used keys are evicted to stay within the byte budget."""
+    store = EvaluationKeyStore(tmp_path, max_cache_bytes=10, loader=bytes)
+    first, _ = store.register(b"a" * 6)
+    second, _ = store.register(b"b" * 6)
+    store.get(first)
+    store.get(second)
+    assert store.cached_bytes == 6
+    assert store.get(first) == b"a" * 6
+
+
+def test_unknown_or_malformed_ids(tmp_path):
+    """Test that unknown and path-like ids are rejected."""
+    store = EvaluationKeyStore(tmp_path, max_cache_bytes=1024, loader=bytes)
+    assert store.get("0" * 64) is None
+    assert store.get("../../etc/passwd") is None
+    assert not store.contains("")
@@ -0,0 +1,78 @@
+"""
+Tests for the FHE execution helpers and backends.
+"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent / "provider" / "services"))
+
+from execution import (
+    FHEWorkerPool, InlineExecutionBackend, SharedPayload, EchoExecutionBackend,
+    run_fhe_batch, _read_payload
+)
+
+
+class EchoServer:
+    """Stand-in for FHEModelServer without the underlying concrete server."""
+    server = None
+
+    def __init__(self):
+        self.calls = []
+
+    def run(self, encrypted_data, evaluation_keys):
+        self.calls.append((encrypted_data, evaluation_keys))
+        return encrypted_data[::-1]
+
+
+def test_run_fhe_batch_keeps_row_order():
+    """Test that batch results are returned in input order."""
+    server = EchoServer()
+    assert run_fhe_batch(server, [b"ab", b"cd"], b"keys") == [b"ba", b"dc"]
+    assert [keys for _, keys in server.calls] == [b"keys", b"keys"]
+
+
+def test_inline_backend_runs_on_loaded_server():
+    """Test that the inline backend delegates to the service's model server."""
+    backend = InlineExecutionBackend(EchoServer())
+    assert backend.run(b"abc", b"keys") == b"cba"
+    assert backend.run_batch([b"x", b"yz"], b"keys") == [b"x", b"zy"]
+
+
+def test_echo_backend_echoes_after_the_delay():
+    """Test that the echo backend skips the circuit and waits the artificial delay per row."""
+    import time
+    backend = EchoExecutionBackend(delay_seconds=0.02)
+    started_at = time.perf_counter()
+    assert backend.run_batch([b"ct1", memoryview(b"ct2")], b"keys") == [b"ct1", b"ct2"]
+    assert time.perf_counter() - started_at >= 0.04
+
+
+def test_backends_report_the_cpu_time_of_an_evaluation():
+    """Test that the CPU time of an evaluation is added to the caller's usage."""
+    class BusyServer(EchoServer):
+        def run(self, encrypted_data, evaluation_keys):
+            sum(range(200000))
+            return super().run(encrypted_data, evaluation_keys)
+
+    usage = {}
+    InlineExecutionBackend(BusyServer()).run(b"abc", b"keys", usage=usage)
+    InlineExecutionBackend(BusyServer()).run_batch([b"x"], b"keys", usage=usage)
+    assert usage["cpu_seconds"] > 0
+    assert EchoExecutionBackend().run_batch([b"x"], b"keys", usage={}) == [b"x"]
+
+
+def test_large_payloads_go_through_shared_memory():
+    """Test that payloads above the threshold are shared and read back intact."""
+    pool = FHEWorkerPool.__new__(FHEWorkerPool)
+    pool.shared_memory_threshold = 16
+    segments = []
+    small = pool._share(b"small", segments)
+    large = pool._share(b"L" * 64, segments)
+    try:
+        assert small == b"small"
+        assert isinstance(large, SharedPayload)
+        assert _read_payload(large) == b"L" * 64
+    finally:
+        for shm in segments:
+            shm.close()
+            shm.unlink()
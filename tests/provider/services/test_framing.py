@@ -0,0 +1,35 @@
+"""
+Tests for the length-prefixed framing helpers.
+"""
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent / "provider" / "services"))
+
+from framing import pack_frames, unpack_frames
+
+
+def test_frames_round_trip():
+    """Test that packed payloads are recovered in order."""
+    payloads = [b"first", b"", b"\x00" * 1024]
+    assert unpack_frames(pack_frames(payloads)) == payloads
+
+
+def test_empty_frame_list():
+    """Test that an empty list of payloads round-trips."""
+    assert unpack_frames(pack_frames([])) == []
+
+
+def test_truncated_body_is_rejected():
+    """Test that a truncated body raises ValueError."""
+    body = pack_frames([b"payload"])
+    with pytest.raises(ValueError, match="truncated"):
+        unpack_frames(body[:-1])
+
+
+def test_trailing_bytes_are_rejected():
+    """Test that trailing bytes after the last frame raise ValueError."""
+    with pytest.raises(ValueError, match="trailing"):
+        unpack_frames(pack_frames([b"payload"]) + b"x")
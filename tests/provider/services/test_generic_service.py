@@ -0,0 +1,21 @@
+"""
+Tests for the YAML-declared generic service.
+"""
+import pytest
+from pathlib import Path
+
+
+def test_generic_service_file_exists():
+    """Test that generic_service.py file exists."""
+    server_path = Path(__file__).parent.parent.parent.parent / "provider" / "services" / "generic_service.py"
+    assert server_path.exists(), "generic_service.py should exist"
+
+
+def test_generic_service_contains_class():
+    """Test that generic_service.py defines the GenericService endpoint."""
+    server_path = Path(__file__).parent.parent.parent.parent / "provider" / "services" / "generic_service.py"
+    
+    if server_path.exists():
+        content = server_path.read_text()
+        assert "class GenericService(AIServiceEndpoint)" in content
+        assert "required_definitions" in content
@@ -0,0 +1,109 @@
+"""
+Tests for the idempotency cache of prediction results.
+"""
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent / "provider" / "services"))
+
+import pytest
+
+from idempotency_cache import IdempotencyCache, IdempotencyConflictError
+
+
+def test_result_is_bound_to_the_single_use_key():
+    """Test that a stored result is only returned to a retry with the same single-use key."""
+    cache = IdempotencyCache(max_bytes=1024, ttl_seconds=60)
+    cache.put("predict:request-1", "key-a", b"result")
+    assert cache.get("predict:request-1", "key-a") == b"result"
+    assert cache.get("predict:request-1", "key-b") is None
+    assert cache.get("predict:request-2", "key-a") is None
+    assert cache.hits == 1
+
+
+def test_result_is_bound_to_the_request_content():
+    """Test that the same keys with another content are a conflict, not a hit."""
+    cache = IdempotencyCache(max_bytes=1024, ttl_seconds=60)
+    cache.put("predict:key-a", "key-a", b"result", "digest-1")
+    assert cache.get("predict:key-a", "key-a", "digest-1") == b"result"
+    with pytest.raises(IdempotencyConflictError):
+        cache.get("predict:key-a", "key-a", "digest-2")
+
+
+def test_results_are_bounded_by_size_and_ttl():
+    """Test that the oldest results are evicted past the byte budget and expired ones dropped."""
+    cache = IdempotencyCache(max_bytes=10, ttl_seconds=60)
+    cache.put("r1", "k1", b"123456")
+    cache.put("r2", "k2", b"123456")
+    assert cache.get("r1", "k1") is None
+    assert cache.get("r2", "k2") == b"123456"
+    assert cache.cached_bytes == 6
+    cache.put("too-large", "k3", b"x" * 11)
+    assert cache.get("too-large", "k3") is None
+
+    cache = IdempotencyCache(max_bytes=10, ttl_seconds=0.01)
+    cache.put("r1", "k1", b"1")
+    time.sleep(0.02)
+    assert cache.get("r1", "k1") is None
+    assert cache.cached_bytes == 0
+
+
+def test_running_job_is_found_until_it_finishes():
+    """Test that a retried job submission finds the job still running its request."""
+    cache = IdempotencyCache(max_bytes=1024, ttl_seconds=60)
+    cache.start_job("predict:r1", "key-a", "job-1")
+    assert cache.get_job("predict:r1", "key-a") == "job-1"
+    assert cache.get_job("predict:r1", "key-b") is None
+    cache.finish_job("predict:r1")
+    assert cache.get_job("predict:r1", "key-a") is None
+
+
+def test_spooled_results_and_jobs_are_shared_between_processes(tmp_path):
+    """Test that a cache sharing the spool directory (another worker) finds the results and running jobs."""
+    worker_a = IdempotencyCache(max_bytes=1024, ttl_seconds=60, spool_directory=tmp_path)
+    worker_b = IdempotencyCache(max_bytes=1024, ttl_seconds=60, spool_directory=tmp_path)
+
+    worker_a.start_job("predict:r1", "key-a", "job-1")
+    assert worker_b.get_job("predict:r1", "key-a") == "job-1"
+    assert worker_b.get_job("predict:r1", "key-b") is None
+    worker_a.finish_job("predict:r1")
+    assert worker_b.get_job("predict:r1", "key-a") is None
+
+    worker_a.put("predict:r1", "key-a", b"result")
+    assert worker_b.get("predict:r1", "key-a") == b"result"
+    assert worker_b.get("predict:r1", "key-b") is None
+
+    worker_a.put("predict:r2", "key-c", b"x" * 1024)
+    assert worker_b.get("predict:r1", "key-a") is None
+
+
+def test_spooled_results_expire(tmp_path):
+    """Test that an expired spooled result is not replayed and is removed."""
+    worker_a = IdempotencyCache(max_bytes=1024, ttl_seconds=0.01, spool_directory=tmp_path)
+    worker_b = IdempotencyCache(max_bytes=1024, ttl_seconds=0.01, spool_directory=tmp_path)
+    worker_a.put("r1", "k1", b"1")
+    time.sleep(0.02)
+    assert worker_b.get("r1", "k1") is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_sweep_removes_files_left_by_other_processes(tmp_path):
+    """Test that the sweep removes expired entries written by another process, and the oldest results past the budget."""
+    exited_worker = IdempotencyCache(max_bytes=1024, ttl_seconds=60, spool_directory=tmp_path)
+    exited_worker.put("r1", "k1", b"1" * 300)
+    exited_worker.start_job("r2", "k2", "job-2")
+    for path in tmp_path.iterdir():
+        os.utime(path, (time.time() - 120, time.time() - 120))
+    exited_worker.put("r3", "k3", b"3" * 300)
+    time.sleep(0.01)
+    exited_worker.put("r4", "k4", b"4" * 300)
+
+    worker = IdempotencyCache(max_bytes=1024, ttl_seconds=60, spool_directory=tmp_path, spool_max_bytes=500)
+    worker.sweep_spool()
+    assert worker.get("r1", "k1") is None
+    assert worker.get_job("r2", "k2") is None
+    assert worker.get("r3", "k3") is None
+    assert worker.get("r4", "k4") == b"4" * 300
+    assert len(list(tmp_path.iterdir())) == 1
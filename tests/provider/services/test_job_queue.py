@@ -0,0 +1,111 @@
+"""
+Tests for the asynchronous prediction job manager.
+"""
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent / "provider" / "services"))
+
+from job_queue import JobManager, JobQueueFullError
+
+
+def test_job_runs_and_can_be_long_polled():
+    """Test that a submitted job finishes and its result is returned by wait."""
+    manager = JobManager(max_workers=1, max_pending=4, result_ttl_seconds=60)
+    job = manager.submit(lambda: b"result")
+    finished = manager.wait(job.job_id, timeout=5)
+    assert finished.status == JobManager.DONE
+    assert finished.result == b"result"
+    manager.shutdown()
+
+
+def test_failed_job_reports_error():
+    """Test that exceptions in the job function mark the job as failed."""
+    finished_jobs = []
+
+    def fail():
+        raise RuntimeError("boom")
+
+    manager = JobManager(max_workers=1, max_pending=4, result_ttl_seconds=60)
+    job = manager.submit(fail, on_finish=finished_jobs.append)
+    manager.shutdown()
+    assert job.status == JobManager.FAILED
+    assert job.error == "boom"
+    assert [(outcome.job_id, outcome.status) for outcome in finished_jobs] == [(job.job_id, JobManager.FAILED)]
+
+
+def test_failed_completion_callback_fails_the_job():
+    """Test that an exception in on_finish is logged and fails the job instead of being lost, its result withheld."""
+    def on_finish(outcome):
+        raise RuntimeError("cannot record")
+
+    manager = JobManager(max_workers=1, max_pending=4, result_ttl_seconds=60)
+    job = manager.submit(lambda: b"result", on_finish=on_finish)
+    manager.shutdown()
+    assert job.status == JobManager.FAILED
+    assert job.result is None
+    assert "cannot record" in job.error
+    assert manager.pending == 0
+
+
+def test_queue_is_bounded():
+    """Test that submissions beyond max_pending unfinished jobs are rejected."""
+    release = threading.Event()
+    manager = JobManager(max_workers=1, max_pending=1, result_ttl_seconds=60)
+    manager.submit(lambda: release.wait(5) and b"done")
+    with pytest.raises(JobQueueFullError):
+        manager.submit(lambda: b"second")
+    release.set()
+    manager.shutdown()
+
+
+def test_finished_jobs_expire():
+    """Test that finished jobs are forgotten after the TTL."""
+    manager = JobManager(max_workers=1, max_pending=4, result_ttl_seconds=0.01)
+    job = manager.submit(lambda: b"result")
+    manager.wait(job.job_id, timeout=5)
+    time.sleep(0.05)
+    assert manager.get(job.job_id) is None
+    manager.shutdown()
+
+
+def test_spooled_jobs_are_visible_to_other_managers(tmp_path):
+    """Test that a manager sharing the spool directory can long-poll a job it did not run."""
+    owner = JobManager(max_workers=1, max_pending=4, result_ttl_seconds=60, spool_directory=tmp_path)
+    other = JobManager(max_workers=1, max_pending=4, result_ttl_seconds=60, spool_directory=tmp_path)
+    release = threading.Event()
+    job = owner.submit(lambda: release.wait(5) and b"result")
+    assert other.get(job.job_id).status in (JobManager.QUEUED, JobManager.RUNNING)
+    release.set()
+    finished = other.wait(job.job_id, timeout=5)
+    assert finished.status == JobManager.DONE
+    assert finished.result == b"result"
+    assert other.get("../" + job.job_id) is None
+    owner.shutdown()
+    other.shutdown()
+
+
+def test_jobs_of_exited_workers_fail_and_are_swept(tmp_path):
+    """Test that a spooled job whose process exited is reported as failed, then swept with the expired jobs."""
+    exited = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, check=True)
+    orphan_id, expired_id = "a" * 32, "b" * 32
+    (tmp_path / f"{orphan_id}.json").write_text(json.dumps({"status": "running", "error": None, "pid": int(exited.stdout)}))
+    (tmp_path / f"{expired_id}.json").write_text(json.dumps({"status": "done", "error": None, "pid": os.getpid()}))
+    (tmp_path / f"{expired_id}.bin").write_bytes(b"result")
+    (tmp_path / "metrics").mkdir()
+    manager = JobManager(max_workers=1, max_pending=4, result_ttl_seconds=60, spool_directory=tmp_path)
+
+    assert manager.get(orphan_id).status == JobManager.FAILED
+    long_ago = time.time() - 120
+    for path in tmp_path.iterdir():
+        os.utime(path, (long_ago, long_ago))
+    manager.sweep_spool()
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["metrics"]
+    manager.shutdown()
@@ -0,0 +1,46 @@
+"""
+Tests for the cached derivation index.
+"""
+import sys
+import time
+import pytest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent / "provider" / "services"))
+
+bip_utils = pytest.importorskip("bip_utils")
+from key_derivation import DerivationIndex
+
+
+@pytest.fixture(scope="module")
+def account():
+    seed = bip_utils.Bip39SeedGenerator("abandon " * 11 + "about").Generate()
+    return bip_utils.Bip44.FromSeed(seed, bip_utils.Bip44Coins.BITCOIN_TESTNET).Purpose().Coin().Account(0)
+
+
+def _address(account, change, index):
+    return account.Change(change).AddressIndex(index).PublicKey().ToAddress()
+
+
+def test_lookup_finds_positions_in_the_windows(account):
+    """Test that addresses of both chains are found at their position, and only inside the windows."""
+    derivation = DerivationIndex(account.PublicKey().ToExtended())
+    internal = _address(account, bip_utils.Bip44Changes.CHAIN_INT, 4)
+    assert derivation.lookup(internal, {0: (0, 5), 1: (0, 5)}) == (1, 4)
+    assert derivation.lookup(internal, {0: (0, 5), 1: (0, 4)}) is None
+    assert derivation.lookup("unknown", {0: (0, 5), 1: (0, 5)}) is None
+    assert derivation.address(bip_utils.Bip44Changes.CHAIN_EXT, 20) == _address(account, bip_utils.Bip44Changes.CHAIN_EXT, 20)
+
+
+def test_windows_slide_and_are_derived_ahead(account):
+    """Test that a moved window forgets the addresses below it and is derived in the background, with the look-ahead."""
+    derivation = DerivationIndex(account.PublicKey().ToExtended(), lookahead=3)
+    first = _address(account, bip_utils.Bip44Changes.CHAIN_EXT, 1)
+    assert derivation.lookup(first, {0: (0, 4), 1: (0, 2)}) == (0, 1)
+    derivation.prefetch({0: (3, 8), 1: (0, 2)})
+    deadline = time.monotonic() + 10
+    while derivation.derived != {0: 11, 1: 5} and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert derivation.derived == {0: 11, 1: 5}
+    assert derivation.lookup(first, {0: (0, 8), 1: (0, 2)}) is None  # Forgotten once below the window.
+    assert derivation.lookup(_address(account, bip_utils.Bip44Changes.CHAIN_EXT, 10), {0: (3, 11), 1: (0, 2)}) == (0, 10)
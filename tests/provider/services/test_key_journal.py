@@ -0,0 +1,44 @@
+"""
+Tests for the journal of consumed keys.
+"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent / "provider" / "services"))
+
+from key_journal import KeyJournal
+
+
+def test_appends_are_read_by_other_readers(tmp_path):
+    """Test that a journal reads the records appended by another one, once."""
+    writer = KeyJournal(tmp_path / "used.journal", fsync_interval_seconds=0)
+    reader = KeyJournal(tmp_path / "used.journal", fsync_interval_seconds=0)
+    writer.append(["a", "b"])
+    assert writer.read_new() == []
+    assert reader.read_new() == ["a", "b"]
+    writer.append(["c"])
+    assert reader.read_new() == ["c"] and reader.read_new() == []
+    writer.close()
+
+
+def test_partial_line_is_left_and_terminated(tmp_path):
+    """Test that a line cut by a crash is not read, and that the next append does not extend it."""
+    path = tmp_path / "used.journal"
+    path.write_bytes(b"a\nhalf")
+    journal = KeyJournal(path, fsync_interval_seconds=0)
+    assert journal.read_new() == ["a"]
+    journal.append(["b"])
+    assert journal.read_new() == ["half", "b"]
+    journal.close()
+
+
+def test_truncate_is_detected_by_readers(tmp_path):
+    """Test that a reader sees the compaction of the journal by another writer."""
+    writer = KeyJournal(tmp_path / "used.journal", fsync_interval_seconds=0.001)
+    reader = KeyJournal(tmp_path / "used.journal")
+    writer.append(["a", "b"])
+    assert reader.read_new() == ["a", "b"]
+    writer.truncate()
+    assert writer.size() == 0 and writer.offset == 0
+    assert reader.read_new() is None
+    writer.close()
@@ -0,0 +1,48 @@
+"""
+Tests for the indexed key ledger.
+"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent / "provider" / "services"))
+
+from key_ledger import KeyLedger
+
+
+def test_consume_moves_keys_and_keeps_order():
+    """Test that consumed keys leave the valid keys and are appended to the used keys, in order."""
+    ledger = KeyLedger()
+    ledger.load(valid_keys=["a", "b", "c", "d"], used_keys=["z"])
+    assert ledger.consume(["c", "a"])
+    assert ledger.valid_keys == ["b", "d"] and ledger.used_keys == ["z", "c", "a"]
+    assert ledger.is_used("a") and not ledger.is_valid("a")
+    assert not ledger.consume(["derived-elsewhere", "z"])
+    assert ledger.used_keys == ["z", "c", "a", "derived-elsewhere"]
+
+
+def test_positions_follow_the_keys():
+    """Test that positions are kept for generated, loaded and learned keys."""
+    ledger = KeyLedger()
+    ledger.add_valid([("a", (0, 5)), ("b", (0, 6))])
+    assert ledger.positions_changed and ledger.next_index(0) == 7 and ledger.next_index(1, default=3) == 3
+    ledger.mark_positions_saved()
+    ledger.learn_position("x", (1, 2))
+    ledger.consume(["a", "x"])
+    assert ledger.used == {"a": (0, 5), "x": (1, 2)} and ledger.positions_changed
+
+    reloaded = KeyLedger()
+    reloaded.load(valid_keys=["b"], used_keys=["a", "x"], positions={"a": [0, 5], "b": [0, 6]})
+    assert reloaded.position("b") == (0, 6) and reloaded.position("x") is None
+    assert not reloaded.positions_changed
+
+
+def test_highest_used_index_per_chain():
+    """Test that the highest consumed index is tracked per change chain, including positions learned later."""
+    ledger = KeyLedger()
+    ledger.load(used_keys=["old"], positions={"old": (0, 3)})
+    ledger.add_valid([("a", (0, 9)), ("b", (0, 4))])
+    assert ledger.highest_used_index(0) == 3 and ledger.highest_used_index(1) == -1
+    ledger.consume(["b", "derived"])
+    assert ledger.highest_used_index(0) == 4
+    ledger.learn_position("derived", (1, 7))
+    assert ledger.highest_used_index(1) == 7
@@ -1,9 +1,36 @@
 """
 Tests for key manager functionality.
 """
+import os
+import sys
 import pytest
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent / "provider" / "services"))
+
+bip_utils = pytest.importorskip("bip_utils")
+from key_manager import KeyManager
+
+
+class TmpKeyManager(KeyManager):
+    """KeyManager whose key files live in a temporary directory."""
+
+    keys_dir = None
+
+    def _load_config_parameters(self):
+        super()._load_config_parameters()
+        self.server_xpub_file = str(self.keys_dir / "server_xpub.txt")
+        self.valid_keys_file = str(self.keys_dir / "valid.json")
+        self.used_keys_file = str(self.keys_dir / "used.json")
+        self.initial_key_batch_size = 5
+        self.crypto_validation_window_size = 10
+
+
+@pytest.fixture
+def key_manager(tmp_path):
+    TmpKeyManager.keys_dir = tmp_path
+    return TmpKeyManager("test_service")
+
 
 def test_key_manager_file_exists():
     """Test that key_manager.py file exists."""
@@ -40,3 +67,100 @@ def test_keys_directory_exists():
         # Check for service directories
         service_dirs = [d for d in keys_dir.iterdir() if d.is_dir()]
         assert len(service_dirs) > 0, "Keys directory should contain service subdirectories"
+
+
+def test_validate_keys_batch(key_manager):
+    """Test that batch validation rejects unknown and repeated keys."""
+    first, second = key_manager.valid_keys[:2]
+    assert key_manager.validate_keys([first, second, first, "unknown"]) == [True, True, False, False]
+
+
+def test_mark_keys_as_used_batch(key_manager):
+    """Test that a batch of keys is consumed and persisted at once."""
+    batch = key_manager.valid_keys[:3]
+    assert key_manager.mark_keys_as_used(batch)
+    assert key_manager.validate_keys(batch) == [False, False, False]
+    reloaded = TmpKeyManager("test_service")
+    assert reloaded.used_keys == batch
+    assert not set(batch) & set(reloaded.valid_keys)
+
+
+def test_keys_used_by_another_process_are_rejected(key_manager):
+    """Test that keys consumed through another KeyManager on the same files are seen as used."""
+    other = TmpKeyManager("test_service")
+    key = key_manager.valid_keys[0]
+    assert other.mark_keys_as_used([key])
+    assert key_manager.reserve_keys([key]) == [False]
+
+
+def test_reservations_are_shared_between_processes(key_manager):
+    """Test that keys reserved by another live process are rejected, and stale reservations ignored."""
+    import json
+    first, second = key_manager.valid_keys[:2]
+    dead_pid = 2 ** 22 + 1
+    Path(key_manager.reserved_keys_file).write_text(json.dumps({first: os.getppid(), second: dead_pid}))
+    assert key_manager.reserve_keys([first]) == [False]
+    assert key_manager.reserve_keys([second]) == [True]
+    assert json.loads(Path(key_manager.reserved_keys_file).read_text()) == {first: os.getppid(), second: os.getpid()}
+    key_manager.release_keys([second])
+    assert second not in json.loads(Path(key_manager.reserved_keys_file).read_text())
+
+
+def test_key_account_identifies_the_account_xpub(key_manager):
+    """Test that keys are attributed to the account of the service's xPub."""
+    account = key_manager.key_account(key_manager.valid_keys[0])
+    assert account.startswith(f"{key_manager.default_account_index}:") and len(account.split(":")[1]) == 8
+    assert key_manager.key_account(key_manager.valid_keys[1]) == account
+
+
+def test_key_positions_are_saved_with_the_keys(key_manager):
+    """Test that generated and derived key positions are persisted and reloaded."""
+    first = key_manager.valid_keys[0]
+    assert key_manager.ledger.position(first) == (0, 0)
+    internal = key_manager._generate_one_time_keys(3, 1, bip_utils.Bip44Changes.CHAIN_INT)[0]
+    assert key_manager.reserve_keys([internal]) == [True]
+    assert key_manager.mark_keys_as_used([internal])
+    assert key_manager.journal.path.read_text() == f"{internal} 1 3\n"
+
+    reloaded = TmpKeyManager("test_service")
+    assert reloaded.ledger.position(internal) == (1, 3)
+    assert reloaded.ledger.position(key_manager.valid_keys[-1]) == (0, len(key_manager.valid_keys) - 1)
+    assert reloaded.used_keys == [internal]
+
+    positions_file = Path(key_manager.key_positions_file)
+    assert internal not in positions_file.read_text()
+    key_manager.journal_compaction_bytes = 1
+    assert key_manager.mark_keys_as_used([first])
+    assert internal in positions_file.read_text()
+    assert TmpKeyManager("test_service").ledger.position(internal) == (1, 3)
+
+
+def test_consumed_keys_are_journaled_and_compacted(key_manager):
+    """Test that consumed keys are appended to the journal, replayed on load and compacted into used.json."""
+    import json
+    first, second, third = key_manager.valid_keys[:3]
+    assert key_manager.mark_keys_as_used([first, second])
+    assert key_manager.journal.path.read_text() == f"{first}\n{second}\n"
+    assert json.loads(Path(key_manager.used_keys_file).read_text()) == []
+    other = TmpKeyManager("test_service")
+    assert other.used_keys == [first, second]
+
+    key_manager.journal_compaction_bytes = 1
+    assert key_manager.mark_keys_as_used([third])
+    assert key_manager.journal.size() == 0
+    assert json.loads(Path(key_manager.used_keys_file).read_text()) == [first, second, third]
+    assert other.reserve_keys([third]) == [False]
+    assert other.used_keys == [first, second, third]
+
+
+def test_validation_window_slides_above_used_keys(key_manager):
+    """Test that fresh keys past the initial window are accepted once the keys below them are consumed."""
+    window = key_manager.crypto_validation_window_size
+    beyond = key_manager._generate_one_time_keys(window + 2, 1, bip_utils.Bip44Changes.CHAIN_EXT)[0]
+    assert key_manager.validate_key_cryptographically(beyond) is False
+    used = key_manager._generate_one_time_keys(window - 1, 1, bip_utils.Bip44Changes.CHAIN_EXT)[0]
+    assert key_manager.reserve_keys([used]) == [True]
+    assert key_manager.mark_keys_as_used([used])
+    assert key_manager._validation_windows()[0] == (0, 2 * window)
+    assert key_manager.reserve_keys([beyond]) == [True]
+    assert key_manager.ledger.position(beyond) == (0, window + 2)
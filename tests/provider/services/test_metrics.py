@@ -0,0 +1,106 @@
+"""
+Tests for the Prometheus-style metrics registry.
+"""
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent / "provider" / "services"))
+
+import metrics
+from metrics import MetricsRegistry, ServiceMetrics
+
+
+def test_histogram_renders_cumulative_buckets():
+    """Test that histograms render cumulative buckets, sum and count per label set."""
+    registry = MetricsRegistry()
+    histogram = registry.histogram("fhe_test_seconds", "Test histogram.", ("service",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, service="a")
+    histogram.observe(0.5, service="a")
+    histogram.observe(5, service="a")
+    text = registry.render().decode()
+    assert "# TYPE fhe_test_seconds histogram" in text
+    assert 'fhe_test_seconds_bucket{service="a",le="0.1"} 1' in text
+    assert 'fhe_test_seconds_bucket{service="a",le="1"} 2' in text
+    assert 'fhe_test_seconds_bucket{service="a",le="+Inf"} 3' in text
+    assert 'fhe_test_seconds_sum{service="a"} 5.55' in text
+    assert 'fhe_test_seconds_count{service="a"} 3' in text
+
+
+def test_services_share_metric_families():
+    """Test that services sharing a registry report under one family, told apart by label."""
+    registry = MetricsRegistry()
+    first, second = ServiceMetrics(registry, "First"), ServiceMetrics(registry, "Second")
+    first.request_started("predict")
+    first.request_finished("predict", 0.2, 500)
+    second.request_started("predict")
+    second.gauge_function("fhe_predictions_queued", "Queued predictions.", lambda: 3)
+    text = registry.render().decode()
+    assert text.count("# TYPE fhe_requests_in_flight gauge") == 1
+    assert 'fhe_requests_in_flight{service="First",endpoint="predict"} 0' in text
+    assert 'fhe_requests_in_flight{service="Second",endpoint="predict"} 1' in text
+    assert 'fhe_request_errors_total{service="First",endpoint="predict",status="500"} 1' in text
+    assert 'fhe_predictions_queued{service="Second"} 3' in text
+
+
+def test_labels_and_types_are_checked():
+    """Test that wrong labels and conflicting registrations are rejected."""
+    registry = MetricsRegistry()
+    counter = registry.counter("fhe_test_total", "Test counter.", ("service",))
+    with pytest.raises(ValueError):
+        counter.inc(endpoint="predict")
+    with pytest.raises(ValueError):
+        registry.gauge("fhe_test_total", "Conflicting type.", ("service",))
+
+
+def record(registry, amount):
+    registry.counter("fhe_test_total", "Test counter.", ("service",)).inc(amount, service="a")
+    registry.gauge("fhe_test_in_flight", "Test gauge.", ("service",)).set(amount, service="a")
+    registry.histogram("fhe_test_seconds", "Test histogram.", ("service",), buckets=(1.0,)).observe(amount, service="a")
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+@pytest.mark.filterwarnings("ignore:This process .* is multi-threaded")
+def test_directory_is_ignored_without_file_locks(tmp_path, monkeypatch):
+    """Test that without fcntl (Windows) a registry renders its own metrics instead of sharing the directory."""
+    monkeypatch.setattr(metrics, "fcntl", None)
+    registry = MetricsRegistry(directory=tmp_path / "metrics")
+    registry.counter("fhe_test_total", "Test counter.").inc()
+    assert registry.directory is None
+    assert b"fhe_test_total 1" in registry.render()
+
+
+def test_workers_sharing_a_directory_are_summed(tmp_path):
+    """Test that a scrape sums the metrics of the processes sharing the directory (a forked one
+    starting from zero), and keeps the counters but not the gauges of a process that exited."""
+    registry = MetricsRegistry(directory=tmp_path, flush_interval_seconds=60)
+    record(registry, 2)
+    ready_read, ready_write = os.pipe()
+    exit_read, exit_write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            record(registry, 3)
+            registry.flush()
+            os.write(ready_write, b"x")
+            os.read(exit_read, 1)
+        finally:
+            os._exit(0)
+    try:
+        os.read(ready_read, 1)
+        text = registry.render().decode()
+        assert 'fhe_test_total{service="a"} 5' in text
+        assert 'fhe_test_in_flight{service="a"} 5' in text
+        assert 'fhe_test_seconds_count{service="a"} 2' in text
+    finally:
+        os.write(exit_write, b"x")
+        os.waitpid(pid, 0)
+
+    text = registry.render().decode()
+    assert 'fhe_test_total{service="a"} 5' in text
+    assert 'fhe_test_in_flight{service="a"} 2' in text
+    assert 'fhe_test_seconds_bucket{service="a",le="+Inf"} 2' in text
+    assert not (tmp_path / f"{pid}.json").exists()
+    assert registry.render().decode() == text
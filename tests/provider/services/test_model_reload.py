@@ -0,0 +1,45 @@
+"""
+Tests for the detection of retrained model artifacts.
+"""
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent / "provider" / "services"))
+
+from model_reload import ModelWatcher, model_version
+
+
+def test_model_version_follows_server_zip(tmp_path):
+    """Test that the version is a digest of server.zip and None without it."""
+    assert model_version(tmp_path) is None
+    (tmp_path / "server.zip").write_bytes(b"model v1")
+    first = model_version(tmp_path)
+    assert len(first) == 16
+    assert model_version(tmp_path) == first
+    (tmp_path / "server.zip").write_bytes(b"model v2")
+    assert model_version(tmp_path) != first
+
+
+def test_watcher_reports_a_change_once_the_file_is_stable(tmp_path):
+    """Test that a replaced server.zip is reported once, after two identical polls."""
+    artifact = tmp_path / "server.zip"
+    artifact.write_bytes(b"model v1")
+    changes = []
+    watcher = ModelWatcher(tmp_path, interval_seconds=1, on_change=lambda: changes.append(model_version(tmp_path)))
+
+    candidate = watcher.poll()
+    assert candidate is not None and changes == []
+    assert watcher.poll(candidate) is None
+    assert len(changes) == 1
+    assert watcher.poll() is None and len(changes) == 1
+
+    artifact.write_bytes(b"model v2, still being copied")
+    os.utime(artifact, ns=(0, 1))
+    candidate = watcher.poll()
+    artifact.write_bytes(b"model v2")
+    os.utime(artifact, ns=(0, 2))
+    candidate = watcher.poll(candidate)
+    assert len(changes) == 1
+    watcher.poll(candidate)
+    assert changes[-1] == model_version(tmp_path) and len(changes) == 2
@@ -0,0 +1,49 @@
+"""
+Tests for the content-encoding of FHE payloads.
+"""
+import io
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent / "provider" / "services"))
+
+pytest.importorskip("werkzeug")
+from werkzeug.exceptions import RequestEntityTooLarge
+from payload_codec import available_encodings, compress, decompress_stream
+
+
+@pytest.mark.parametrize("encoding", available_encodings())
+def test_roundtrip_spools_large_payloads(encoding):
+    """Test that decompressed parts round-trip and are spooled past the threshold."""
+    payload = bytes(range(256)) * 1000
+    part = decompress_stream(io.BytesIO(compress(payload, encoding)), encoding, spool_threshold=4096)
+    assert part.rolled
+    assert bytes(part.view()) == payload
+    part.close()
+
+
+def test_decompressed_size_is_bounded():
+    """Test that a small compressed part cannot expand past the part size limit."""
+    bomb = compress(b"\0" * 1_000_000, "gzip", level=9)
+    with pytest.raises(RequestEntityTooLarge):
+        decompress_stream(io.BytesIO(bomb), "gzip", spool_threshold=4096, max_size=100_000)
+
+
+def test_corrupt_or_unsupported_data_is_rejected():
+    """Test that corrupt data and unknown encodings raise ValueError."""
+    with pytest.raises(ValueError):
+        decompress_stream(io.BytesIO(b"\x1f\x8b not gzip"), "gzip", spool_threshold=4096)
+    with pytest.raises(ValueError):
+        decompress_stream(io.BytesIO(b"data"), "br", spool_threshold=4096)
+    with pytest.raises(ValueError):
+        compress(b"data", "br")
+
+
+def test_zstd_roundtrip():
+    """Test zstd when the optional zstandard package is installed."""
+    pytest.importorskip("zstandard")
+    assert "zstd" in available_encodings()
+    part = decompress_stream(io.BytesIO(compress(b"abc" * 100, "zstd", level=1)), "zstd", spool_threshold=4096)
+    assert part.view() == b"abc" * 100
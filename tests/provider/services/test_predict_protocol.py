@@ -0,0 +1,53 @@
+"""
+Tests for the binary encoding of prediction requests.
+"""
+import sys
+from pathlib import Path
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent / "provider" / "services"))
+
+from predict_protocol import pack_predict_request, parse_predict_request
+from uploads import BufferPart, read_part
+
+
+def test_round_trip_with_inline_keys_and_with_a_key_id():
+    """Test that both forms of a request decode to the fields they were built from."""
+    parsed = parse_predict_request(pack_predict_request("key-1", b"\x00ciphertext", evaluation_keys=b"keys"))
+    assert parsed.single_use_key == "key-1" and parsed.evaluation_keys_id is None
+    assert bytes(parsed.encrypted_data) == b"\x00ciphertext" and bytes(parsed.evaluation_keys) == b"keys"
+
+    parsed = parse_predict_request(pack_predict_request("key-2", b"ciphertext", evaluation_keys_id="abc123"))
+    assert parsed.evaluation_keys_id == "abc123" and parsed.evaluation_keys is None
+
+
+def test_large_fields_are_views_of_the_body():
+    """Test that the ciphertext is not copied out of the body, and reads back through a BufferPart."""
+    body = bytearray(pack_predict_request("key", b"a" * 1000, evaluation_keys_id="id"))
+    parsed = parse_predict_request(body)
+    body[body.index(b"a")] = ord("b")
+    assert bytes(parsed.encrypted_data[:2]) == b"ba"
+    assert bytes(read_part(FileStorage(BufferPart(parsed.encrypted_data)))) == b"b" + b"a" * 999
+
+
+@pytest.mark.parametrize("body", [
+    b"XXXX\x01",
+    b"AGDP\x02",
+    pack_predict_request("key", b"ciphertext", evaluation_keys_id="id")[:-3],
+    pack_predict_request("key", b"ciphertext", evaluation_keys_id="id") + b"\x00",
+    pack_predict_request("key", b"ciphertext", evaluation_keys=b"")[:-8] + b"\x00" * 8,
+])
+def test_malformed_bodies_are_rejected(body):
+    """Test bad magic, unsupported version, truncation, trailing bytes and missing keys."""
+    with pytest.raises(ValueError):
+        parse_predict_request(body)
+
+
+def test_exactly_one_of_keys_and_key_id():
+    """Test that a request carries either the evaluation keys or their id."""
+    with pytest.raises(ValueError):
+        pack_predict_request("key", b"ciphertext")
+    with pytest.raises(ValueError):
+        pack_predict_request("key", b"ciphertext", evaluation_keys=b"keys", evaluation_keys_id="id")
@@ -0,0 +1,81 @@
+"""
+Tests for resumable evaluation key uploads.
+"""
+import sys
+import hashlib
+import os
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent / "provider" / "services"))
+
+from evaluation_key_store import EvaluationKeyStore
+from resumable_uploads import ResumableUploadStore, UploadError, merge_ranges
+
+
+def test_merge_ranges():
+    """Test that overlapping and adjacent ranges are merged."""
+    assert merge_ranges([(4, 6), (0, 2), (2, 3), (5, 8), (10, 12)]) == [[0, 3], [4, 8], [10, 12]]
+
+
+def test_chunks_in_any_order_complete_the_upload(tmp_path):
+    """Test that chunks sent out of order and twice are tracked, and the result is registered."""
+    data = bytes(range(256)) * 4
+    uploads = ResumableUploadStore(tmp_path / "uploads", max_upload_bytes=4096, max_chunk_bytes=512)
+    upload_id = uploads.create(len(data), sha256=hashlib.sha256(data).hexdigest())
+
+    status = uploads.write_chunk(upload_id, 512, data[512:])
+    assert status["received"] == [[512, 1024]] and status["next_offset"] == 0
+    with pytest.raises(UploadError) as error:
+        uploads.finish(upload_id)
+    assert error.value.status == 409
+
+    uploads.write_chunk(upload_id, 0, data[:300])
+    status = uploads.write_chunk(upload_id, 0, data[:512])
+    assert status["received"] == [[0, 1024]] and status["complete"]
+    assert uploads.status(upload_id) == status
+
+    path, info = uploads.finish(upload_id)
+    store = EvaluationKeyStore(tmp_path / "keys", max_cache_bytes=4096, loader=bytes)
+    key_id, created = store.register_file(path)
+    uploads.remove(upload_id)
+    assert created and key_id == hashlib.sha256(data).hexdigest()
+    assert store.get(key_id) == data
+    with pytest.raises(UploadError) as error:
+        uploads.status(upload_id)
+    assert error.value.status == 404
+
+
+@pytest.mark.parametrize("offset, size, status", [(-1, 10, 400), (1020, 10, 400), (0, 600, 413)])
+def test_chunks_outside_the_upload_are_rejected(tmp_path, offset, size, status):
+    """Test that chunks beyond the upload's bounds or over the chunk limit are rejected."""
+    uploads = ResumableUploadStore(tmp_path, max_upload_bytes=4096, max_chunk_bytes=512)
+    upload_id = uploads.create(1024)
+    with pytest.raises(UploadError) as error:
+        uploads.write_chunk(upload_id, offset, b"x" * size)
+    assert error.value.status == status
+
+
+def test_digest_mismatch_removes_the_upload(tmp_path):
+    """Test that an upload not matching its announced digest is rejected and discarded."""
+    uploads = ResumableUploadStore(tmp_path, max_upload_bytes=4096)
+    upload_id = uploads.create(4, sha256=hashlib.sha256(b"good").hexdigest())
+    uploads.write_chunk(upload_id, 0, b"evil")
+    with pytest.raises(UploadError) as error:
+        uploads.finish(upload_id)
+    assert error.value.status == 400
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_expired_uploads_are_removed(tmp_path):
+    """Test that uploads idle for longer than the expiry are removed, and invalid sizes rejected."""
+    uploads = ResumableUploadStore(tmp_path, max_upload_bytes=4096, expiry_seconds=60)
+    stale = uploads.create(10)
+    for suffix in (".json", ".ranges"):
+        os.utime(tmp_path / f"{stale}{suffix}", (0, 0))
+    fresh = uploads.create(10)
+    assert {path.stem for path in tmp_path.iterdir()} == {fresh}
+    for size in (0, "10", 5000):
+        with pytest.raises(UploadError):
+            uploads.create(size)
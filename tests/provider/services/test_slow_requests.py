@@ -0,0 +1,51 @@
+"""
+Tests for the slow-request profiler and its on-disk ring buffer.
+"""
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent / "provider" / "services"))
+
+from slow_requests import SlowRequestLog, SlowRequestProfiler, StackSampler, main
+
+
+def slow_function():
+    time.sleep(0.2)
+
+
+def test_slow_request_is_recorded_with_stacks_and_stages(tmp_path):
+    """Test that a request over the threshold is recorded with its samples, stages and payloads."""
+    profiler = SlowRequestProfiler(0.1, SlowRequestLog(tmp_path), StackSampler(interval_seconds=0.005))
+    profile = profiler.start()
+    slow_function()
+    profile.add_stage("run", 0.2)
+    profile.add_payload("request", "encrypted_data", 1024)
+    record_id = profiler.finish(profile, service="Test", endpoint="predict", status=200)
+
+    entry = SlowRequestLog(tmp_path).get(record_id)
+    assert entry["endpoint"] == "predict" and entry["duration_seconds"] >= 0.2
+    assert entry["stages"] == {"run": 0.2}
+    assert entry["payloads"] == [{"direction": "request", "part": "encrypted_data", "bytes": 1024}]
+    assert entry["profile"]["samples"] > 0
+    assert any("slow_function" in stack for stack in entry["profile"]["stacks"])
+
+
+def test_fast_request_is_not_recorded(tmp_path):
+    """Test that a request under the threshold leaves no record."""
+    profiler = SlowRequestProfiler(10, SlowRequestLog(tmp_path))
+    assert profiler.finish(profiler.start(), endpoint="predict") is None
+    assert SlowRequestLog(tmp_path).entries() == []
+
+
+def test_log_keeps_the_most_recent_entries(tmp_path, capsys):
+    """Test that the ring buffer drops the oldest records and the CLI lists the others."""
+    log = SlowRequestLog(tmp_path / "Test", max_entries=2)
+    ids = [log.record({"timestamp": time.time(), "duration_seconds": float(i), "endpoint": "predict"}) for i in range(3)]
+    assert [entry["id"] for entry in log.entries()] == ids[1:]
+    assert log.get(ids[0]) is None
+
+    assert main(["--directory", str(tmp_path), "list"]) == 0
+    output = capsys.readouterr().out
+    assert ids[0] not in output and ids[1] in output and ids[2] in output
+    assert main(["--directory", str(tmp_path), "show", ids[0]]) == 1
@@ -0,0 +1,78 @@
+"""
+Tests for the SQLite key store.
+"""
+import json
+import os
+import sys
+import pytest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent / "provider" / "services"))
+
+bip_utils = pytest.importorskip("bip_utils")
+from key_manager import KeyManager
+from sqlite_key_store import SQLiteKeyManager
+
+
+def _in_directory(manager_class, keys_dir):
+    class TmpManager(manager_class):
+        def _load_config_parameters(self):
+            super()._load_config_parameters()
+            self.server_xpub_file = str(keys_dir / "server_xpub.txt")
+            self.valid_keys_file = str(keys_dir / "valid.json")
+            self.used_keys_file = str(keys_dir / "used.json")
+            self.initial_key_batch_size = 5
+            self.crypto_validation_window_size = 10
+    return TmpManager
+
+
+@pytest.fixture
+def key_store(tmp_path):
+    return _in_directory(SQLiteKeyManager, tmp_path)("test_service")
+
+
+def test_reserve_consume_and_release(key_store, tmp_path):
+    """Test that reserved keys are rejected until released, and used keys for good."""
+    first, second, third = key_store.valid_keys[:3]
+    other = _in_directory(SQLiteKeyManager, tmp_path)("test_service")
+    assert key_store.reserve_keys([first, second]) == [True, True]
+    assert other.reserve_keys([second, third]) == [False, True]
+    assert key_store.reserve_keys([third, third]) == [True, False]  # Nothing reserved unless all are valid.
+    assert other.reserve_keys([third]) == [True]
+    assert key_store.reserve_keys([third]) == [False]
+    key_store.release_keys([second])
+    assert key_store.mark_keys_as_used([first])
+    assert other.reserve_keys([first]) == [False]
+    assert other.validate_keys([second, first]) == [True, False]
+    assert other.used_keys == [first]
+    assert key_store.flush_valid_keys()
+    assert first not in json.loads(Path(key_store.valid_keys_file).read_text())
+
+
+def test_reservations_of_dead_processes_are_ignored(key_store):
+    """Test that a key reserved by a process that died can be reserved again."""
+    key = key_store.valid_keys[0]
+    key_store._connection().execute("UPDATE keys SET state = 'reserved', reserved_by = ? WHERE address = ?", (2 ** 22 + 1, key))
+    assert key_store.reserve_keys([key]) == [True]
+    key_store._connection().execute("UPDATE keys SET reserved_by = ? WHERE address = ?", (os.getppid(), key))
+    assert key_store.validate_key(key) is False
+
+
+def test_derived_keys_are_stored_with_their_position(key_store):
+    """Test that a key outside the generated batch is validated by derivation and stored when reserved."""
+    internal = key_store._generate_one_time_keys(2, 1, bip_utils.Bip44Changes.CHAIN_INT)[0]
+    assert key_store.reserve_keys([internal]) == [True]
+    assert key_store.mark_keys_as_used([internal])
+    row = key_store._connection().execute("SELECT change, idx, state FROM keys WHERE address = ?", (internal,)).fetchone()
+    assert row == (1, 2, 'used')
+
+
+def test_json_key_files_are_imported(tmp_path):
+    """Test that the keys of the JSON key files are moved into a new database."""
+    json_manager = _in_directory(KeyManager, tmp_path)("test_service")
+    used = json_manager.valid_keys[:2]
+    assert json_manager.mark_keys_as_used(used)
+    key_store = _in_directory(SQLiteKeyManager, tmp_path)("test_service")
+    assert key_store.used_keys == used
+    assert key_store.valid_keys == json_manager.valid_keys
+    assert key_store.reserve_keys(used) == [False, False]
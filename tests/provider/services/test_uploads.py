@@ -0,0 +1,63 @@
+"""
+Tests for the disk-spooled upload parts.
+"""
+import io
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent / "provider" / "services"))
+
+flask = pytest.importorskip("flask")
+from werkzeug.exceptions import RequestEntityTooLarge
+from asgi_app import PreparsedRequest
+from uploads import SpooledPart, read_part
+
+
+def test_small_part_stays_in_memory():
+    """Test that parts under the threshold are kept in memory and returned as bytes."""
+    part = SpooledPart(spool_threshold=16)
+    part.write(b"small")
+    assert not part.rolled
+    assert part.view() == b"small"
+
+
+def test_large_part_is_spooled_and_memory_mapped():
+    """Test that parts over the threshold move to disk and are returned as a memory map."""
+    part = SpooledPart(spool_threshold=4)
+    part.write(b"abc")
+    part.write(b"defgh")
+    assert part.rolled
+    part.seek(0)
+    assert part.read() == b"abcdefgh"
+    view = part.view()
+    part.close()
+    assert isinstance(view, memoryview)
+    assert bytes(view) == b"abcdefgh"
+
+
+def test_part_size_limit():
+    """Test that writing past max_size is rejected with 413."""
+    part = SpooledPart(spool_threshold=4, max_size=6)
+    part.write(b"abcdef")
+    with pytest.raises(RequestEntityTooLarge):
+        part.write(b"g")
+
+
+def test_flask_uploads_are_spooled_within_limits():
+    """Test that the services' request class spools large parts and enforces the part limit."""
+    app = flask.Flask("test")
+    app.request_class = PreparsedRequest
+    app.config.update(UPLOAD_SPOOL_THRESHOLD=8, UPLOAD_MAX_PART_BYTES=64)
+
+    @app.post("/upload")
+    def upload():
+        content = read_part(flask.request.files["evaluation_keys"])
+        return {"type": type(content).__name__, "size": len(content)}
+
+    client = app.test_client()
+    response = client.post("/upload", data={"evaluation_keys": (io.BytesIO(b"k" * 32), "keys")})
+    assert response.json == {"type": "memoryview", "size": 32}
+    response = client.post("/upload", data={"evaluation_keys": (io.BytesIO(b"k" * 65), "keys")})
+    assert response.status_code == 413
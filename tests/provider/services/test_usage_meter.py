@@ -0,0 +1,45 @@
+"""
+Tests for the per-account usage meter.
+"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent / "provider" / "services"))
+
+from usage_meter import UsageMeter, decode_records, encode_record
+
+HOUR = 3600
+DAY_START = 1_700_006_400  # 2023-11-15T00:00:00Z
+
+
+def test_records_round_trip_and_truncated_tail_is_ignored():
+    """Test the binary layout, and that a record cut short at the end of a file is skipped."""
+    data = encode_record(472224, "0:abcd1234", [2, 3, 1.5, 2.25, 100, 200]) + encode_record(472225, "b", [1, 1, 0, 0, 1, 1])
+    assert list(decode_records(data)) == [
+        (472224, "0:abcd1234", [2, 3, 1.5, 2.25, 100, 200]),
+        (472225, "b", [1, 1, 0.0, 0.0, 1, 1]),
+    ]
+    assert len(list(decode_records(data[:-1]))) == 1
+
+
+def test_usage_is_summed_per_account_and_period(tmp_path):
+    """Test that queries add up the flushed records of several meters, filtered by period and account."""
+    first = UsageMeter(tmp_path, flush_interval_seconds=3600)
+    second = UsageMeter(tmp_path, flush_interval_seconds=0)
+    first.record("heavy", 1, 2.0, 3.0, 1000, 500, timestamp=DAY_START + 10)
+    first.record("heavy", 4, 8.0, 9.0, 4000, 2000, timestamp=DAY_START + HOUR + 10)
+    first.record("light", 1, 0.5, 1.0, 100, 50, timestamp=DAY_START + 20)
+    second.record("heavy", 1, 1.0, 1.0, 10, 10, timestamp=DAY_START - HOUR)
+    assert list(tmp_path.iterdir()) != [] and first.query(account="light")[0]["cpu_seconds"] == 0.5
+
+    totals = second.query()
+    assert [entry["account"] for entry in totals] == ["heavy", "light"]
+    assert totals[0] == {"account": "heavy", "requests": 3, "predictions": 6, "cpu_seconds": 11.0,
+                         "wall_seconds": 13.0, "bytes_in": 5010, "bytes_out": 2510}
+    assert [file.name for file in sorted(tmp_path.iterdir())] == ["2023-11-14.usage", "2023-11-15.usage"]
+
+    first_hour = second.query(since=DAY_START, until=DAY_START + HOUR, by_hour=True)
+    assert [(entry["account"], entry["hour"]) for entry in first_hour] == [
+        ("heavy", "2023-11-15T00:00:00+00:00"), ("light", "2023-11-15T00:00:00+00:00")
+    ]
+    assert second.query(since=DAY_START + HOUR, account="heavy")[0]["predictions"] == 4
@@ -0,0 +1,48 @@
+"""
+Tests for the single-process multi-model host.
+"""
+import sys
+from pathlib import Path
+
+import pytest
+import yaml
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent / "provider"))
+
+pytest.importorskip("flask")
+from model_host import service_slug, model_exists
+
+
+def test_model_host_file_exists():
+    """Test that model_host.py file exists."""
+    host_path = Path(__file__).parent.parent.parent / "provider" / "model_host.py"
+    assert host_path.exists(), "model_host.py should exist"
+
+
+def test_service_slug_from_name():
+    """Test that service names are turned into URL-safe slugs."""
+    assert service_slug({"service_name": "Breast Cancer Screening"}) == "breast-cancer-screening"
+    assert service_slug({"service_name": "Diabetes (v2)"}) == "diabetes-v2"
+
+
+def test_service_slug_from_config():
+    """Test that an explicit slug in the config takes precedence."""
+    assert service_slug({"service_name": "Breast Cancer Screening", "slug": "bcs"}) == "bcs"
+
+
+def test_model_exists(tmp_path):
+    """Test that a service is only servable once server.zip has been generated."""
+    config = {"output_directory": str(tmp_path)}
+    assert not model_exists(config)
+    (tmp_path / "server.zip").touch()
+    assert model_exists(config)
+
+
+def test_configured_service_classes_exist():
+    """Test that every service_class in training_config.yaml points to an existing module."""
+    provider_dir = Path(__file__).parent.parent.parent / "provider"
+    config = yaml.safe_load((provider_dir / "training_config.yaml").read_text())
+    for dataset in config["datasets"]:
+        if "service_class" in dataset:
+            module_path = dataset["service_class"].rsplit(".", 1)[0].replace(".", "/") + ".py"
+            assert (provider_dir.parent / module_path).exists(), f"Missing module for {dataset['service_class']}"
@@ -0,0 +1,90 @@
+"""
+Tests for the pre-fork production launcher.
+"""
+import os
+import signal
+import sys
+import threading
+import time
+from pathlib import Path
+from urllib.request import urlopen
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent / "provider"))
+
+pytest.importorskip("flask")
+from prefork import PreforkServer, RequestCounter, default_worker_count
+
+
+def pid_app(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [str(os.getpid()).encode()]
+
+
+def test_default_worker_count_splits_cores():
+    """Test that the available cores are split between servers, with at least one worker each."""
+    assert default_worker_count() >= 1
+    assert default_worker_count(servers=10_000) == 1
+    assert default_worker_count(servers=2) <= default_worker_count()
+
+
+def test_request_counter_reports_limit_once():
+    """Test that on_limit fires once, when the max_requests-th request starts."""
+    calls = []
+    counter = RequestCounter(pid_app, max_requests=2, on_limit=lambda: calls.append(counter.served))
+    for _ in range(3):
+        body = counter({}, lambda status, headers: None)
+        assert counter.active == 1
+        body.close()
+    assert counter.active == 0
+    assert calls == [1]
+    assert counter.served == 3
+    assert counter.wait_idle(timeout=0)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+def test_workers_are_recycled_after_max_requests():
+    """Test that a worker is replaced once it has served max_requests requests."""
+    server = PreforkServer(pid_app, "127.0.0.1", 0, workers=1, max_requests=1, graceful_timeout=5)
+    server.listen()
+    master_pid = os.fork()
+    if master_pid == 0:
+        try:
+            server.run()
+        finally:
+            os._exit(0)
+    server.socket.close()
+    try:
+        pids = [urlopen(f"http://127.0.0.1:{server.port}/", timeout=10).read() for _ in range(3)]
+        assert len(set(pids)) == 3
+        assert str(master_pid).encode() not in pids
+    finally:
+        os.kill(master_pid, signal.SIGTERM)
+        os.waitpid(master_pid, 0)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+def test_replace_workers_forks_new_workers():
+    """Test that replace_workers, called from a thread of the master (the model watchers), replaces the workers."""
+    server = PreforkServer(pid_app, "127.0.0.1", 0, workers=1, graceful_timeout=5)
+    server.listen()
+    master_pid = os.fork()
+    if master_pid == 0:
+        try:
+            threading.Timer(1.0, server.replace_workers).start()
+            server.run()
+        finally:
+            os._exit(0)
+    server.socket.close()
+    try:
+        first = urlopen(f"http://127.0.0.1:{server.port}/", timeout=10).read()
+        deadline = time.monotonic() + 10
+        pid = first
+        while pid == first and time.monotonic() < deadline:
+            time.sleep(0.1)
+            pid = urlopen(f"http://127.0.0.1:{server.port}/", timeout=10).read()
+        assert pid != first
+    finally:
+        os.kill(master_pid, signal.SIGTERM)
+        os.waitpid(master_pid, 0)